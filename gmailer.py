@@ -6,13 +6,31 @@ import time
 import json
 import logging
 import base64
+import gzip
 import threading
+import signal
+import asyncio
 import queue
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from dataclasses import dataclass, asdict
-from typing import Optional, List, Dict, Any
-from datetime import datetime, timezone
+import sqlite3
+import hashlib
+import html as html_lib
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial, wraps
+from bisect import bisect_left
+import multiprocessing
+from multiprocessing.managers import SyncManager
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, asdict, fields
+from typing import Optional, List, Dict, Any, Iterator, Generator
+from datetime import datetime, timedelta, timezone
 from email.utils import parsedate_to_datetime, parseaddr
+from email import policy
+from email.header import decode_header, make_header
+from email.parser import BytesParser
 import ssl
 import sys
 
@@ -32,43 +50,110 @@ ssl._create_default_https_context = ssl._create_unverified_context
 # os.environ['HTTP_PROXY'] = 'http://your-proxy:port'
 # os.environ['HTTPS_PROXY'] = 'http://your-proxy:port'
 
-import customtkinter as ctk
-import tkinter as tk
-from tkcalendar import DateEntry
+# Тяжелые библиотеки импортируются при первом использовании: GUI (customtkinter, tkcalendar) -
+# в load_gui_modules, pandas/openpyxl - при записи Excel, pdfplumber/docx - при разборе вложений,
+# bs4 - только без lxml. Импорт модуля и запуск из командной строки обходятся без них
+ctk = tk = DateEntry = None
 
-import pandas as pd
-from bs4 import BeautifulSoup
-import pdfplumber
-from docx import Document
-
-# Проверка наличия openpyxl для работы с Excel
+# lxml разбирает HTML на порядок быстрее BeautifulSoup; без него - BeautifulSoup(html.parser)
 try:
-    import openpyxl
+    from lxml import etree as lxml_etree, html as lxml_html
 except ImportError:
-    print("ОШИБКА: openpyxl не установлен. Установите его командой: pip install openpyxl")
-    sys.exit(1)
+    lxml_etree = lxml_html = None
 
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from googleapiclient.http import HttpError
+from googleapiclient.http import HttpError, build_http
 import google_auth_httplib2
 import httplib2
 import urllib3
+# httpx нужен только асинхронному движку; HTTP/2 - при установленном пакете h2 (pip install httpx[http2])
+try:
+    import httpx
+except ImportError:
+    httpx = None
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+# Кэш писем сжимается zstd (pip install zstandard); без пакета - gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # ================= CONFIG =================
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
-MAX_WORKERS = 1  # Минимум для снижения нагрузки на API
-ATTACHMENT_WORKERS = 1
+TOKEN_FILE = 'token.pickle'  # Токен OAuth почтового ящика
+CREDENTIALS_FILE = 'credentials.json'  # Клиент OAuth проекта Google Cloud
+MAX_WORKERS = 8  # Потоки обработки писем; у каждого свой сервис Gmail из ServicePool
+ATTACHMENT_WORKERS = 4  # Потоки загрузки вложений одного письма (тоже со своими сервисами)
+PARSE_WORKERS = os.cpu_count() or 1  # Процессы для разбора PDF/DOCX (CPU-задача, вне GIL)
+ATTACHMENT_PARSE_TIMEOUT = 20  # Предел времени разбора одного файла в рабочем процессе, сек
+ATTACHMENT_MAX_PAGES = 20  # Сколько страниц PDF разбирать
 RETRY_COUNT = 3  # Уменьшено количество попыток
 BATCH_SIZE = 10  # Уменьшено для снижения нагрузки
+BATCH_FETCH = True  # Загружать письма пакетными (batch) HTTP-запросами
+FETCH_BATCH_SIZE = 100  # Максимум запросов messages.get в одном batch-запросе (лимит Gmail API)
+FETCH_FORMAT = 'full'  # 'full' - JSON-дерево частей; 'raw' - письмо RFC822 целиком (с вложениями), разбор пакетом email
+THREAD_FETCH = False  # Загружать письма одной цепочки одним threads.get (выгодно для длинных переписок)
+METADATA_FIRST = True  # При пропуске ответов сначала загружать только заголовки, полностью - лишь оставшиеся письма
+REPLY_FILTER_HEADERS = ['Subject', 'In-Reply-To', 'References']  # Заголовки, по которым письмо признается ответом
+PARTIAL_RESPONSE = True  # Запрашивать у API только используемые поля (параметр fields)
+MESSAGE_PARTS_DEPTH = 4  # Уровни вложенности частей письма в маске полей; глубже части берутся целиком
+HTTP_USER_AGENT = "gmail-export/1.0 (gzip)"  # "gzip" в User-Agent - условие сжатия ответов Google API
 AUTOSAVE_EVERY = 25
-API_DELAY = 0.5  # Задержка между запросами в секундах
-BATCH_DELAY = 2.0  # Задержка между батчами в секундах
-STATE_FILE = "progress_state.json"
+ASYNC_ENGINE = False  # Асинхронный движок (httpx, HTTP/2): сотни запросов в полете без потока на каждый
+ASYNC_CONCURRENCY = 100  # Максимум писем, одновременно загружаемых асинхронным движком
+ASYNC_MAX_CONNECTIONS = 10  # Соединения в пуле httpx; по HTTP/2 запросы мультиплексируются внутри них
+GMAIL_API_URL = "https://gmail.googleapis.com/gmail/v1/users/me"  # REST-адрес Gmail API для асинхронного движка
+MAX_ATTACHMENT_SIZE = 10 * 1024 * 1024  # Вложения больше этого размера не загружаются
+STREAMING_PIPELINE = True  # Потоковый конвейер: список ID, загрузка, вложения, извлечение и запись работают одновременно
+PIPELINE_QUEUE_SIZE = 200  # Емкость очередей между стадиями конвейера (обратное давление)
+SHARDED_EXPORT = False  # Делить диапазон дат на окна (шарды), которые выгружаются параллельно
+SHARD_WORKERS = 4  # Одновременно выгружаемых шардов; ограничитель скорости у всех общий
+SHARD_TARGET_SIZE = 2000  # Окно, где по оценке API больше писем, делится пополам
+SHARD_MIN_SPAN = 3600  # Окно короче этого (сек) больше не делится
+SHARD_MAX_COUNT = 256  # Предел числа шардов (и запросов оценки при планировании)
+SHARD_EARLIEST_DATE = datetime(2004, 4, 1)  # Начало диапазона, если начальная дата не задана (запуск Gmail)
+QUOTA_UNITS_PER_SECOND = 250  # Лимит Gmail API на пользователя (единиц квоты в секунду)
+RATE_LIMIT_START = 50  # Начальная скорость ограничителя (единиц квоты в секунду)
+RATE_LIMIT_MIN = 5  # Минимальная скорость после снижения
+RATE_LIMIT_INCREASE = 1  # Аддитивное увеличение скорости за каждый интервал с успешными ответами
+RATE_LIMIT_INTERVAL = 1.0  # Скорость растет не чаще раза за интервал (емкость корзины - секунда), сек
+RATE_LIMIT_DECREASE = 0.5  # Мультипликативное снижение скорости при 429/5xx
+RATE_LIMIT_BACKOFF = 1.0  # Базовая пауза после 429/5xx (удваивается при повторах), сек
+EXPORT_DB_FILE = "gmail_export.db"  # Состояние выгрузки: записи и статусы писем (SQLite, WAL)
+ATTACHMENT_CACHE_FILE = "attachment_cache.db"  # Постоянный кэш текста вложений
+ATTACHMENT_CACHE_MAX_BYTES = 256 * 1024 * 1024  # Предел размера кэша вложений (LRU-вытеснение)
+OUTPUT_FILE = "gmail_export_final.xlsx"  # Итоговый Excel-файл (в CLI задается параметром --output)
+SYNC_STATE_FILE = "sync_state.json"  # Контрольная точка historyId для инкрементальной синхронизации
+ACCOUNTS_FILE = "accounts.json"  # Ящики для одновременной выгрузки: [{"name": ..., "token": ..., "credentials": ...}]
+ACCOUNTS_DIR = "accounts"  # Каталоги ящиков: база выгрузки, контрольная точка и итоговый файл каждого
+ACCOUNT_WORKERS = 4  # Ящиков, выгружаемых одновременно (по процессу на ящик)
+ACCOUNT_PROCESS_START = 'spawn'  # Запуск процессов ящиков: 'spawn' безопасен при работающих потоках, 'fork' быстрее (Linux)
+PROJECT_QUOTA_PER_SECOND = 20000  # Квота проекта Gmail API (1 200 000 единиц в минуту) на все ящики
+CONSOLIDATED_OUTPUT_FILE = "gmail_export_all.xlsx"  # Общий файл выгрузки всех ящиков
+RECORD_MEMORY_BUDGET = 64 * 1024 * 1024  # Память под записи текущего запуска; сверх нее старые записи уходят на диск
+EXPORT_READ_CHUNK = 1000  # Записей, читаемых из хранилища за раз при построении Excel
+DEDUP_KEY = ('date', 'from_email', 'subject')  # Поля записи, совпадение которых означает одно и то же письмо
+CONTACT_KEY_INN = False  # Контакт - пара (адрес, ИНН): организации, пишущие с одного адреса, - разные контакты
+ARCHIVE_ENABLED = False  # Пополнять локальный архив писем с полнотекстовым поиском (SQLite FTS5)
+ARCHIVE_DB_FILE = "gmail_archive.db"  # Архив писем: не очищается между выгрузками
+ARCHIVE_SEARCH_LIMIT = 50  # Результатов поиска по архиву по умолчанию
+MESSAGE_CACHE_ENABLED = False  # Сохранять загруженные письма и байты вложений для повторного извлечения без API
+MESSAGE_CACHE_FILE = "message_cache.db"  # Сжатый кэш писем (zstd, без пакета zstandard - gzip)
+MESSAGE_CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024  # Предел сжатого размера кэша писем; раньше сохраненные вытесняются
+MESSAGE_CACHE_LEVEL = 3  # Уровень сжатия zstd (gzip - уровень 6)
+REEXTRACT_CHUNK = 100  # Писем в одном задании рабочего процесса при повторном извлечении
+METRICS_ENABLED = True  # Замер стадий выгрузки (время, повторы, трафик, кэши); выключенный почти ничего не стоит
+METRICS_REPORT_FILE = "export_metrics.json"  # Отчет по стадиям в конце запуска
+METRICS_PROM_FILE = "export_metrics.prom"  # Тот же отчет для textfile-коллектора node_exporter (Prometheus)
+METRICS_GUI_INTERVAL = 2.0  # Как часто отправлять сводку метрик в окно программы, сек
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # Границы гистограмм времени, сек
 LOG_FILE = "export_log.txt"
 
 logging.basicConfig(
@@ -79,7 +164,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ================= DATA CLASS =================
-@dataclass
+@dataclass(slots=True)  # Без словаря атрибутов у каждого экземпляра: на больших выгрузках это заметная доля памяти
 class EmailData:
     date: str
     from_email: str
@@ -97,12 +182,274 @@ class EmailData:
     def to_dict(self) -> Dict[str, Any]:
         return asdict(self)
 
+RECORD_COLUMNS = [f.name for f in fields(EmailData)]
+
+class DedupIndex:
+    """Инкрементальный отсев дубликатов записей по ключу DEDUP_KEY.
+    
+    Хранит 16-байтовые дайджесты blake2b ключа, каждая новая запись проверяется один раз за O(1).
+    Дайджест сохраняется в хранилище вместе с записью, поэтому продолжение выгрузки
+    восстанавливает индекс без повторного просмотра истории. Не потокобезопасен.
+    """
+    SEPARATOR = "\x1f"
+    
+    def __init__(self, key: tuple = DEDUP_KEY):
+        unknown = [name for name in key if name not in RECORD_COLUMNS]
+        if not key or unknown:
+            raise ValueError(f"Неизвестные поля ключа дубликатов: {unknown or 'пустой ключ'}")
+        self.key = tuple(key)
+        self._digests = set()
+    
+    def digest_values(self, values: Dict[str, Any]) -> bytes:
+        """Дайджест ключа по словарю полей (имя -> значение)"""
+        text = self.SEPARATOR.join("" if values.get(name) is None else str(values[name]) for name in self.key)
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    
+    def digest(self, record: EmailData) -> bytes:
+        return self.digest_values({name: getattr(record, name) for name in self.key})
+    
+    def add_digest(self, digest: bytes) -> bool:
+        """True, если ключ встретился впервые"""
+        if digest in self._digests:
+            return False
+        self._digests.add(digest)
+        return True
+    
+    def add(self, record: EmailData) -> bool:
+        return self.add_digest(self.digest(record))
+    
+    def update(self, digests):
+        self._digests.update(digests)
+    
+    def __contains__(self, digest: bytes) -> bool:
+        return digest in self._digests
+    
+    def __len__(self) -> int:
+        return len(self._digests)
+
+# ================= METRICS =================
+class _StageTimer:
+    """Замер одной стадии: время от входа в with до выхода попадает в гистограмму стадии"""
+    __slots__ = ('_metrics', '_stage', '_start')
+    
+    def __init__(self, metrics: "Metrics", stage: str):
+        self._metrics = metrics
+        self._stage = stage
+        self._start = 0.0
+    
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self._metrics.observe(self._stage, time.perf_counter() - self._start)
+        return False
+
+_NO_TIMER = nullcontext()  # Общий пустой контекст выключенных метрик
+
+class Metrics:
+    """Метрики выгрузки по стадиям: гистограммы времени, счетчики (повторы по причинам,
+    байты, попадания в кэш, статусы писем) и показатели других счетчиков на момент отчета.
+    
+    Один экземпляр разделяется всеми потоками. Выключенный ничего не накапливает: timer
+    возвращает общий пустой контекст, observe и inc сразу выходят.
+    """
+    PREFIX = "gmail_export"
+    
+    def __init__(self, enabled: bool = METRICS_ENABLED, buckets: tuple = METRICS_BUCKETS):
+        self._lock = threading.Lock()
+        self.buckets = tuple(sorted(buckets))
+        self.enabled = enabled
+        self.reset()
+    
+    def reset(self, enabled: Optional[bool] = None):
+        """Обнуление перед новой выгрузкой; enabled - включить или выключить замеры"""
+        with self._lock:
+            if enabled is not None:
+                self.enabled = enabled
+            self._histograms: Dict[str, Dict[str, Any]] = {}
+            self._counters: Dict[tuple, float] = {}  # (имя, метки) -> значение
+            self._gauges: Dict[str, float] = {}
+            self._started_at = time.time()
+    
+    def timer(self, stage: str):
+        """Контекст замера: with metrics.timer('api_call'): ..."""
+        if not self.enabled:
+            return _NO_TIMER
+        return _StageTimer(self, stage)
+    
+    def observe(self, stage: str, seconds: float):
+        if not self.enabled:
+            return
+        # Корзина i - значения не больше buckets[i]; последняя - все остальные (+Inf)
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = {
+                    'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0, 'max': 0.0
+                }
+            histogram['counts'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+            if seconds > histogram['max']:
+                histogram['max'] = seconds
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        """Счетчик name с метками: metrics.inc('retries', cause='ssl')"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def set_gauges(self, prefix: str, stats: Dict[str, Any]):
+        """Числовые поля get_stats() других счетчиков (трафик, ограничитель, кэши) как показатели"""
+        if not self.enabled:
+            return
+        with self._lock:
+            for name, value in stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self._gauges[f"{prefix}_{name}"] = value
+    
+    def counter_total(self, name: str, **labels) -> float:
+        """Сумма счетчика name по всем меткам (или только по совпадающим с labels)"""
+        with self._lock:
+            return sum(value for (counter, counter_labels), value in self._counters.items()
+                       if counter == name and all(item in counter_labels for item in labels.items()))
+    
+    def _quantile(self, histogram: Dict[str, Any], q: float) -> float:
+        """Оценка квантиля по гистограмме: верхняя граница корзины, где набирается доля q"""
+        target = q * histogram['count']
+        seen = 0
+        for bound, count in zip(self.buckets, histogram['counts']):
+            seen += count
+            if seen >= target:
+                return min(bound, histogram['max'])
+        return histogram['max']
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Все метрики одним словарем (основа JSON-отчета)"""
+        with self._lock:
+            stages = {}
+            for stage, histogram in sorted(self._histograms.items()):
+                cumulative, buckets = 0, {}
+                for bound, count in zip(self.buckets + (float('inf'),), histogram['counts']):
+                    cumulative += count
+                    buckets['+Inf' if bound == float('inf') else str(bound)] = cumulative
+                stages[stage] = {
+                    'count': histogram['count'],
+                    'total': round(histogram['sum'], 6),
+                    'mean': round(histogram['sum'] / histogram['count'], 6),
+                    'p50': round(self._quantile(histogram, 0.5), 6),
+                    'p95': round(self._quantile(histogram, 0.95), 6),
+                    'max': round(histogram['max'], 6),
+                    'buckets': buckets
+                }
+            counters: Dict[str, Any] = {}
+            for (name, labels), value in sorted(self._counters.items()):
+                if labels:
+                    label_text = ",".join(f"{key}={label}" for key, label in labels)
+                    counters.setdefault(name, {})[label_text] = value
+                else:
+                    counters[name] = value
+            return {
+                'started_at': datetime.fromtimestamp(self._started_at).isoformat(timespec='seconds'),
+                'duration': round(time.time() - self._started_at, 3),
+                'stages': stages,
+                'counters': counters,
+                'gauges': dict(sorted(self._gauges.items()))
+            }
+    
+    def to_prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus (для textfile-коллектора node_exporter)"""
+        def escape(value) -> str:
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        
+        def label_set(labels) -> str:
+            return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}" if labels else ""
+        
+        lines = []
+        with self._lock:
+            if self._histograms:
+                name = f"{self.PREFIX}_stage_seconds"
+                lines += [f"# HELP {name} Время стадий выгрузки", f"# TYPE {name} histogram"]
+                for stage, histogram in sorted(self._histograms.items()):
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + (float('inf'),), histogram['counts']):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(float(bound))
+                        lines.append(f'{name}_bucket{{stage="{escape(stage)}",le="{le}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{stage="{escape(stage)}"}} {histogram["sum"]:.6f}')
+                    lines.append(f'{name}_count{{stage="{escape(stage)}"}} {histogram["count"]}')
+            typed = set()
+            for (counter, labels), value in sorted(self._counters.items()):
+                name = f"{self.PREFIX}_{counter}_total"
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{label_set(labels)} {value:g}")
+            for gauge, value in sorted(self._gauges.items()):
+                name = f"{self.PREFIX}_{gauge}"
+                lines += [f"# TYPE {name} gauge", f"{name} {value:g}"]
+        lines.append(f"# TYPE {self.PREFIX}_run_started_seconds gauge")
+        lines.append(f"{self.PREFIX}_run_started_seconds {self._started_at:.0f}")
+        return "\n".join(lines) + "\n"
+    
+    def summary(self) -> str:
+        """Короткая сводка для окна программы: самые долгие стадии, повторы, кэш, трафик"""
+        snapshot = self.snapshot()
+        stages = sorted(snapshot['stages'].items(), key=lambda item: item[1]['total'], reverse=True)
+        parts = [f"{stage} {data['total']:.1f} с (p95 {data['p95']:.3g} с)" for stage, data in stages[:4]]
+        text = "Стадии: " + (", ".join(parts) if parts else "нет данных")
+        retries = self.counter_total('retries')
+        if retries:
+            text += f" | Повторов: {retries:g}"
+        hits = self.counter_total('attachment_cache', result='hit') + self.counter_total('attachment_cache', result='ref_hit')
+        lookups = self.counter_total('attachment_cache')
+        if lookups:
+            text += f" | Кэш вложений: {hits:g} из {lookups:g}"
+        wire_bytes = snapshot['gauges'].get('transfer_wire_bytes')
+        if wire_bytes:
+            text += f" | Трафик: {wire_bytes / 1024 / 1024:.1f} МБ"
+        return text
+    
+    def write_report(self, json_path: str = METRICS_REPORT_FILE, prom_path: Optional[str] = METRICS_PROM_FILE):
+        """JSON-отчет и файл Prometheus. Запись через временный файл: коллектор не увидит половину"""
+        reports = [(json_path, json.dumps(self.snapshot(), ensure_ascii=False, indent=2))]
+        if prom_path:
+            reports.append((prom_path, self.to_prometheus()))
+        for path, content in reports:
+            temp_path = path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(temp_path, path)
+
+metrics = Metrics()
+
+def timed(stage: str):
+    """Декоратор: время каждого вызова функции попадает в гистограмму стадии stage"""
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.observe(stage, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
 # ================= THREAD-SAFE STATE =================
 class ThreadSafeState:
     def __init__(self):
         self._lock = threading.Lock()
         self._processed_ids = set()
+        self._dedup = DedupIndex()
         self._data_buffer = []
+        self._status_buffer = []
         self._total_processed = 0
         self._cancelled = False
     
@@ -115,30 +462,51 @@ class ThreadSafeState:
             self._cancelled = True
     
     def add_processed(self, msg_id: str, data: EmailData):
+        """True, если запись новая. Повтор того же письма (по ID) отбрасывается, а дубликат
+        по ключу записи учитывается как обработанное письмо со статусом 'duplicate'"""
         with self._lock:
-            if msg_id not in self._processed_ids:
-                self._processed_ids.add(msg_id)
-                self._data_buffer.append(data)
+            if msg_id in self._processed_ids:
+                return False
+            self._processed_ids.add(msg_id)
+            is_new = self._dedup.add(data)
+            if is_new:
+                self._data_buffer.append((msg_id, data))
                 self._total_processed += 1
-                return True
-            return False
+            else:
+                self._status_buffer.append((msg_id, 'duplicate', ''))
+        metrics.inc('messages', status='done' if is_new else 'duplicate')
+        return is_new
+    
+    def restore_processed(self, processed_ids: set, dedup: Optional[DedupIndex] = None):
+        """ID, обработанные в прошлых запусках, и индекс дубликатов их записей"""
+        with self._lock:
+            self._processed_ids.update(processed_ids)
+            if dedup is not None:
+                self._dedup = dedup
+    
+    def mark_status(self, msg_id: str, status: str, error: str = ""):
+        """Письмо без записи: пропущено ('skipped'), дубликат ('duplicate') или не обработано из-за ошибки ('failed')"""
+        with self._lock:
+            self._status_buffer.append((msg_id, status, error))
+        metrics.inc('messages', status=status)
     
-    def get_and_clear_buffer(self) -> List[EmailData]:
+    def get_and_clear_buffer(self) -> tuple:
+        """Новые пары (msg_id, запись) и статусы писем без записей с момента прошлого вызова"""
         with self._lock:
-            buffer = self._data_buffer.copy()
-            self._data_buffer = []
-            return buffer
+            buffer, statuses = self._data_buffer, self._status_buffer
+            self._data_buffer, self._status_buffer = [], []
+            return buffer, statuses
     
     def get_stats(self) -> tuple:
         with self._lock:
             return len(self._processed_ids), self._total_processed
 
 # ================= AUTH =================
-def authenticate():
+def authenticate(token_file: str = TOKEN_FILE, credentials_file: str = CREDENTIALS_FILE):
     creds = None
     
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
+    if os.path.exists(token_file):
+        with open(token_file, 'rb') as token:
             creds = pickle.load(token)
     
     if creds and creds.expired and creds.refresh_token:
@@ -149,19 +517,129 @@ def authenticate():
             creds = None
     
     if not creds or not creds.valid:
-        flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        flow = InstalledAppFlow.from_client_secrets_file(credentials_file, SCOPES)
         creds = flow.run_local_server(port=0)
-        with open('token.pickle', 'wb') as token:
+        with open(token_file, 'wb') as token:
             pickle.dump(creds, token)
     
     return creds
 
+class TransferMeter:
+    """Учет трафика Gmail API: байты по сети (до распаковки gzip) и после распаковки"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """Обнуление счетчиков перед новой выгрузкой"""
+        with self._lock:
+            self._requests = 0
+            self._compressed = 0
+            self._wire_bytes = 0
+            self._body_bytes = 0
+            self._messages = 0
+    
+    def add_wire_bytes(self, count: int):
+        with self._lock:
+            self._wire_bytes += count
+    
+    def add_response(self, body_bytes: int, compressed: bool):
+        with self._lock:
+            self._requests += 1
+            self._body_bytes += body_bytes
+            if compressed:
+                self._compressed += 1
+    
+    def count_messages(self, count: int):
+        """Учет загруженных писем - знаменатель для среднего трафика на письмо"""
+        with self._lock:
+            self._messages += count
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            per_message = self._wire_bytes / self._messages if self._messages else 0
+            return {
+                'requests': self._requests,
+                'compressed': self._compressed,
+                'wire_bytes': self._wire_bytes,
+                'body_bytes': self._body_bytes,
+                'messages': self._messages,
+                'bytes_per_message': round(per_message)
+            }
+
+transfer_meter = TransferMeter()
+
+def _count_wire_bytes(response):
+    """Подменяет read() ответа http.client, чтобы учесть тело до распаковки"""
+    read = response.read
+    
+    def counted_read(*args, **kwargs):
+        data = read(*args, **kwargs)
+        transfer_meter.add_wire_bytes(len(data))
+        return data
+    
+    response.read = counted_read
+    return response
+
+class _MeteredHTTPConnection(httplib2.HTTPConnectionWithTimeout):
+    def getresponse(self):
+        return _count_wire_bytes(super().getresponse())
+
+class _MeteredHTTPSConnection(httplib2.HTTPSConnectionWithTimeout):
+    def getresponse(self):
+        return _count_wire_bytes(super().getresponse())
+
+_METERED_CONNECTIONS = {'http': _MeteredHTTPConnection, 'https': _MeteredHTTPSConnection}
+
+def meter_http(http):
+    """Запросы через http идут со сжатием gzip и учитываются в transfer_meter (по образцу set_user_agent)"""
+    request_orig = http.request
+    
+    def request(uri, method="GET", body=None, headers=None,
+                redirections=httplib2.DEFAULT_MAX_REDIRECTS, connection_type=None):
+        headers = dict(headers or {})
+        # Google сжимает ответ, только если "gzip" есть и в Accept-Encoding, и в User-Agent.
+        # Одиночные вызовы googleapiclient так и отправляет, а внешний batch-запрос - нет
+        headers.setdefault('accept-encoding', 'gzip, deflate')
+        user_agent = headers.get('user-agent', '')
+        if 'gzip' not in user_agent:
+            headers['user-agent'] = f"{HTTP_USER_AGENT} {user_agent}".strip()
+        if connection_type is None:
+            connection_type = _METERED_CONNECTIONS.get(uri.split(':', 1)[0].lower())
+        resp, content = request_orig(uri, method=method, body=body, headers=headers,
+                                     redirections=redirections, connection_type=connection_type)
+        # httplib2 распаковывает gzip сам и помечает такой ответ заголовком -content-encoding
+        transfer_meter.add_response(len(content or b''), '-content-encoding' in resp)
+        return resp, content
+    
+    http.request = request
+    return http
+
+_discovery_doc: Optional[Dict] = None  # Описание Gmail API: загружается один раз, дальше сервисы строятся без сети
+_ssl_fallback = False  # Стандартное подключение не удалось - работаем с отключенной проверкой SSL
+
+def _authorized_http(creds, disable_ssl: bool = False):
+    """Отдельный httplib2.Http (со своими keep-alive соединениями) с авторизацией и учетом трафика"""
+    if disable_ssl:
+        http = httplib2.Http(disable_ssl_certificate_validation=True, timeout=60)
+    else:
+        http = build_http()
+    return meter_http(google_auth_httplib2.AuthorizedHttp(creds, http=http))
+
 def create_gmail_service(creds):
     """Создание сервиса Gmail с обходом SSL-проблем"""
+    global _discovery_doc, _ssl_fallback
+    from googleapiclient.discovery import build, build_from_document
+    if _discovery_doc is not None:
+        return build_from_document(_discovery_doc, http=_authorized_http(creds, _ssl_fallback))
+    
     try:
         # Пробуем стандартный способ
         logger.info("Попытка стандартного подключения к Gmail API...")
-        service = build('gmail', 'v1', credentials=creds, cache_discovery=False, static_discovery=False)
+        service = build('gmail', 'v1', http=_authorized_http(creds), cache_discovery=False, static_discovery=False)
+        _discovery_doc = service._rootDesc
         logger.info("Стандартное подключение успешно")
         return service
     except Exception as e:
@@ -170,25 +648,95 @@ def create_gmail_service(creds):
     try:
         # Пробуем с httplib2 и отключенным SSL
         logger.info("Пробуем подключение с отключенной SSL-верификацией...")
-        http = httplib2.Http(disable_ssl_certificate_validation=True, timeout=60)
-        authorized_http = google_auth_httplib2.AuthorizedHttp(creds, http=http)
-        
-        service = build('gmail', 'v1', http=authorized_http, cache_discovery=False, static_discovery=False)
+        service = build('gmail', 'v1', http=_authorized_http(creds, disable_ssl=True),
+                        cache_discovery=False, static_discovery=False)
+        _discovery_doc = service._rootDesc
+        _ssl_fallback = True
         logger.info("Подключение с отключенным SSL успешно")
         return service
     except Exception as e:
         logger.error(f"Все попытки подключения не удались: {e}")
         raise
 
+class ServicePool:
+    """Пул сервисов Gmail для рабочих потоков: httplib2 не потокобезопасен.
+    
+    Каждый сервис в каждый момент используется одним потоком и после работы
+    возвращается в пул вместе со своими keep-alive соединениями. Учетные данные
+    общие; токен обновляется заранее и под блокировкой, одним потоком.
+    """
+    
+    def __init__(self, creds):
+        self.creds = creds
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._idle: List[Any] = []
+        self._created = 0
+    
+    def refresh_credentials(self):
+        if self.creds is None or self.creds.valid:
+            return
+        with self._refresh_lock:
+            if not self.creds.valid:
+                logger.info("Обновление токена доступа")
+                self.creds.refresh(Request())
+    
+    @contextmanager
+    def lease(self):
+        """Сервис в монопольное пользование на время блока with"""
+        self.refresh_credentials()
+        with self._lock:
+            service = self._idle.pop() if self._idle else None
+        if service is None:
+            service = create_gmail_service(self.creds)
+            with self._lock:
+                self._created += 1
+                logger.info(f"Пул сервисов Gmail: создан сервис #{self._created}")
+        try:
+            yield service
+        finally:
+            with self._lock:
+                self._idle.append(service)
+
 # ================= HELPERS =================
+# Признак разметки: "<" перед буквой, "/", "!" или "?" - иначе парсер считает "<" обычным текстом
+HTML_TAG_RE = re.compile(r'<[a-zA-Z!/?]')
+# Невидимые символы (неразрывный пробел str.split() и так считает пробелом)
+INVISIBLE_CHARS_RE = re.compile(r'[\u200b\u200c\u200d\ufeff\u2060]')
+# Теги, текст которых не нужен
+HTML_SKIP_TAGS = ["script", "style", "head", "meta", "link"]
+
+def _html_to_text_lxml(html: str) -> str:
+    """Текст HTML через lxml: без служебных тегов, комментариев и инструкций"""
+    doc = lxml_html.document_fromstring(html)
+    for element in list(doc.iter(lxml_etree.Comment, lxml_etree.ProcessingInstruction, *HTML_SKIP_TAGS)):
+        # Хвост оставляем отдельной строкой, чтобы слова по обе стороны не склеились
+        element.clear(keep_tail=True)
+    return ' '.join(doc.itertext())
+
+def _html_to_text_bs4(html: str) -> str:
+    """Текст HTML через BeautifulSoup"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, "html.parser")
+    for script in soup(HTML_SKIP_TAGS):
+        script.decompose()
+    return soup.get_text(separator=' ', strip=True)
+
 def clean_html(html: str) -> str:
     """Очистка HTML с сохранением текста"""
     if not html:
         return ""
-    soup = BeautifulSoup(html, "html.parser")
-    for script in soup(["script", "style", "head", "meta", "link"]):
-        script.decompose()
-    text = soup.get_text(separator=' ', strip=True)
+    if not HTML_TAG_RE.search(html):
+        # Разметки нет - разбирать нечего, раскодируем только сущности вида &amp;
+        text = html_lib.unescape(html) if '&' in html else html
+    elif lxml_html is not None:
+        try:
+            text = _html_to_text_lxml(html)
+        except (ValueError, lxml_etree.LxmlError):
+            # Пустой документ или объявление кодировки в строке - lxml такое не принимает
+            text = _html_to_text_bs4(html)
+    else:
+        text = _html_to_text_bs4(html)
     text = ' '.join(text.split())
     return text
 
@@ -215,16 +763,15 @@ def format_date(date_str: str) -> str:
         cleaned = re.sub(r'\s*\(.*?\)', '', cleaned)
         return cleaned.strip()
 
-def clean_text(text: str) -> str:
-    """Очистка текста от мусора"""
+def clean_text(text: str, html: bool = True) -> str:
+    """Очистка текста от мусора. html=False - текст заведомо без разметки (уже очищенный)"""
     if not text:
         return ""
     
-    text = clean_html(text)
-    text = re.sub(r'[\u200b\u200c\u200d\ufeff\u00a0\u2060]', '', text)
-    text = ' '.join(text.split())
-    lines = [line.strip() for line in text.split('\n') if line.strip()]
-    text = '\n'.join(lines)
+    if html:
+        text = clean_html(text)
+    # Удаление невидимых символов и схлопывание пробелов
+    text = ' '.join(INVISIBLE_CHARS_RE.sub('', text).split())
     
     if len(text) > 10000:
         text = text[:10000] + "... [текст обрезан]"
@@ -259,119 +806,143 @@ def normalize_phone(phone_str: str) -> str:
     
     return ""
 
+# Паттерны для разных форматов телефонов (более гибкие), компилируются один раз
+PHONE_PATTERNS = [re.compile(p) for p in [
+    r'\+7\s*\(?\d{3}\)?\s*\d{3}[\s\-]?\d{2}[\s\-]?\d{2}',      # +7(XXX)XXX-XX-XX
+    r'\+7\s*\(?\d{3}\)?\s*\d{3}[\s\-]?\d{4}',                  # +7(XXX)XXX-XXXX
+    r'8\s*\(?\d{3}\)?\s*\d{3}[\s\-]?\d{2}[\s\-]?\d{2}',       # 8(XXX)XXX-XX-XX
+    r'8\s*\(?\d{3}\)?\s*\d{3}[\s\-]?\d{4}',                    # 8(XXX)XXX-XXXX
+    r'\+7\s*\d{10}',                                            # +7XXXXXXXXXX
+    r'8\s*\d{10}',                                              # 8XXXXXXXXXX
+    r'\+7\s*\d{3}\s*\d{3}\s*\d{2}\s*\d{2}',                    # +7 XXX XXX XX XX
+    r'\+7\s*\d{3}\s*\d{3}\s*\d{4}',                            # +7 XXX XXX XXXX
+    r'8\s*\d{3}\s*\d{3}\s*\d{2}\s*\d{2}',                      # 8 XXX XXX XX XX
+    r'8\s*\d{3}\s*\d{3}\s*\d{4}',                              # 8 XXX XXX XXXX
+    r'\+7\s*\d{3}[\s\-]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}',       # +7 XXX-XXX-XX-XX
+    r'8\s*\d{3}[\s\-]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}',         # 8 XXX-XXX-XX-XX
+    r'\+7\s*\d{3}[\s\-]?\d{3}[\s\-]?\d{4}',                   # +7 XXX-XXX-XXXX
+    r'8\s*\d{3}[\s\-]?\d{3}[\s\-]?\d{4}',                     # 8 XXX-XXX-XXXX
+]]
+# Общее начало всех паттернов: каждый телефон начинается с "+7" или "8", затем код из 3 цифр
+PHONE_START_RE = re.compile(r'(?:\+7|8)\s*\(?\d{3}')
+# Пробы для каждого первого символа: необязательные опережающие проверки всех паттернов
+# этой группы за один вызов; группа i заполнена, если паттерн совпал в данной позиции
+PHONE_PROBES = {}
+for _prefix in ('+', '8'):
+    _group = [(i, p) for i, p in enumerate(PHONE_PATTERNS) if p.pattern.lstrip('\\').startswith(_prefix)]
+    PHONE_PROBES[_prefix] = ([i for i, _ in _group],
+                             re.compile("".join(f"(?:(?=({p.pattern})))?" for _, p in _group)))
+
+# ИНН: 10 или 12 цифр, но не часть другого числа
+INN_RE = re.compile(r'(?=\d)(?:(?<!\d)\d{10}(?!\d)|(?<!\d)\d{12}(?!\d))')
+# ФИО: ищем русские имена (2-3 слова с заглавной буквы)
+FIO_RE = re.compile(r'\b[А-ЯЁ][а-яё]+\s+[А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?\b')
+# Сайт: URL или доменное имя
+WEBSITE_RE = re.compile(r'(?=[a-zA-Z0-9])(?:https?://)?(?:www\.)?([a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.(?:[a-zA-Z]{2,}))')
+# Популярные почтовые сервисы и соцсети не считаем сайтом компании
+EXCLUDED_WEBSITE_DOMAINS = {'gmail.com', 'mail.ru', 'yandex.ru', 'yahoo.com', 'outlook.com',
+                            'vk.com', 'facebook.com', 'twitter.com', 'instagram.com', 'telegram.org'}
+# Компания: ООО, ИП, ЗАО, ПАО, АО и т.п. - сначала полное название в кавычках
+COMPANY_RES = [re.compile(r'(?=[ОИЗПАНТЧ])' + p, re.IGNORECASE) for p in [
+    r'(ООО|ИП|ЗАО|ПАО|АО|ОАО|НПО|НТЦ|ОП|ТД|ИЧП|ЧП|ЧУП|ТОО|АОЗТ)\s*["«]([^"»\n]{3,50})["»]',
+    r'(ООО|ИП|ЗАО|ПАО|АО|ОАО|НПО|НТЦ|ОП|ТД|ИЧП|ЧП|ЧУП|ТОО|АОЗТ)\s+([А-ЯЁ][А-ЯЁа-яё\s\-]{2,40}?)(?:\s|$|,|\.|«|")',
+]]
+COMPANY_QUOTES_RE = re.compile(r'["«»"]')
+# Адрес: обычно содержит слова типа "г.", "ул.", "д.", "офис", "помещ."
+ADDRESS_RES = [re.compile(p, re.IGNORECASE) for p in [
+    # Индекс в начале (6 цифр) + адрес
+    r'\d{6}[^,\n]*(?:,\s*[^,\n]+){0,5}(?:,\s*(?:г\.|город|г\s)[^,\n]+)?(?:,\s*(?:ул\.|улица|пр\.|проспект|пер\.|переулок|вн\.тер\.г\.)[^,\n]+)?(?:,\s*(?:д\.|дом)[^,\n]+)?(?:,\s*(?:лит\.|литера|лит)[^,\n]+)?(?:,\s*(?:помещ\.|помещение|офис|оф\.)[^,\n]+)?',
+    # Адрес без индекса, начинающийся с города или улицы
+    r'(?=[гупв])(?:г\.|город|г\s|ул\.|улица|пр\.|проспект|пер\.|переулок|вн\.тер\.г\.)[^,\n]+(?:,\s*[^,\n]+){0,6}(?:,\s*(?:д\.|дом)[^,\n]+)?(?:,\s*(?:лит\.|литера|лит)[^,\n]+)?(?:,\s*(?:помещ\.|помещение|офис|оф\.)[^,\n]+)?',
+]]
+ADDRESS_LEADING_RE = re.compile(r'^[,\s]+')
+ADDRESS_TRAILING_RE = re.compile(r'[,\s]+$')
+
+def scan_phones(text: str) -> List[str]:
+    """Все телефоны текста (нормализованные, отсортированные) за один проход.
+    
+    Дешевый паттерн общего начала перескакивает к следующей позиции, где может начинаться
+    телефон; проба проверяет там все паттерны с тем же первым символом сразу. Паттерн
+    засчитывается, только если позиция не внутри его предыдущего совпадения, поэтому
+    результат совпадает с последовательным re.findall по каждому паттерну. Все паттерны
+    берут префикс и ровно 10 цифр, так что совпадения в одной позиции дают один номер.
+    """
+    next_allowed = [0] * len(PHONE_PATTERNS)
+    found = set()
+    match = PHONE_START_RE.search(text)
+    while match:
+        pos = match.start()
+        indices, probe = PHONE_PROBES[text[pos]]
+        groups = probe.match(text, pos).groups()
+        phone = None
+        for i, matched in zip(indices, groups):
+            if matched is not None and next_allowed[i] <= pos:
+                next_allowed[i] = pos + len(matched)
+                phone = matched
+        if phone:
+            normalized = normalize_phone(phone)
+            if normalized:
+                found.add(normalized)
+        match = PHONE_START_RE.search(text, pos + 1)
+    return sorted(found)
+
 def extract_data(text: str) -> tuple:
     """Извлечение телефона, ИНН, ФИО, сайта, компании и адреса с валидацией"""
     if not text:
         return "", "", "", "", "", ""
     
-    # Телефон: находим все телефоны в различных форматах
-    # Паттерны для разных форматов телефонов (более гибкие)
-    phone_patterns = [
-        r'\+7\s*\(?\d{3}\)?\s*\d{3}[\s\-]?\d{2}[\s\-]?\d{2}',      # +7(XXX)XXX-XX-XX
-        r'\+7\s*\(?\d{3}\)?\s*\d{3}[\s\-]?\d{4}',                  # +7(XXX)XXX-XXXX
-        r'8\s*\(?\d{3}\)?\s*\d{3}[\s\-]?\d{2}[\s\-]?\d{2}',       # 8(XXX)XXX-XX-XX
-        r'8\s*\(?\d{3}\)?\s*\d{3}[\s\-]?\d{4}',                    # 8(XXX)XXX-XXXX
-        r'\+7\s*\d{10}',                                            # +7XXXXXXXXXX
-        r'8\s*\d{10}',                                              # 8XXXXXXXXXX
-        r'\+7\s*\d{3}\s*\d{3}\s*\d{2}\s*\d{2}',                    # +7 XXX XXX XX XX
-        r'\+7\s*\d{3}\s*\d{3}\s*\d{4}',                            # +7 XXX XXX XXXX
-        r'8\s*\d{3}\s*\d{3}\s*\d{2}\s*\d{2}',                      # 8 XXX XXX XX XX
-        r'8\s*\d{3}\s*\d{3}\s*\d{4}',                              # 8 XXX XXX XXXX
-        r'\+7\s*\d{3}[\s\-]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}',       # +7 XXX-XXX-XX-XX
-        r'8\s*\d{3}[\s\-]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}',         # 8 XXX-XXX-XX-XX
-        r'\+7\s*\d{3}[\s\-]?\d{3}[\s\-]?\d{4}',                   # +7 XXX-XXX-XXXX
-        r'8\s*\d{3}[\s\-]?\d{3}[\s\-]?\d{4}',                     # 8 XXX-XXX-XXXX
-    ]
-    
-    all_phones = []
-    seen_phones = set()
-    
-    for pattern in phone_patterns:
-        matches = re.findall(pattern, text)
-        for match in matches:
-            normalized = normalize_phone(match)
-            if normalized and normalized not in seen_phones:
-                all_phones.append(normalized)
-                seen_phones.add(normalized)
-    
-    # Сортируем и объединяем через запятую
-    phones_str = ", ".join(sorted(all_phones)) if all_phones else ""
-    
-    # ИНН: 10 или 12 цифр, но не часть другого числа
-    inn_pattern = r'(?<!\d)\d{10}(?!\d)|(?<!\d)\d{12}(?!\d)'
-    inns = re.findall(inn_pattern, text)
-    inn = inns[0] if inns else ""
-    
-    # ФИО: ищем русские имена (2-3 слова с заглавной буквы)
-    fio_pattern = r'\b[А-ЯЁ][а-яё]+\s+[А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?\b'
-    fio_matches = re.findall(fio_pattern, text)
+    # Телефон: все телефоны через запятую в нормализованном формате
+    phones_str = ", ".join(scan_phones(text))
+    
+    inn_match = INN_RE.search(text)
+    inn = inn_match.group(0) if inn_match else ""
+    
     # Берем первое найденное ФИО, но пропускаем слишком короткие (меньше 6 символов)
     fio = ""
-    for match in fio_matches:
-        if len(match.strip()) >= 6:
-            fio = match.strip()
+    for match in FIO_RE.finditer(text):
+        if len(match.group(0).strip()) >= 6:
+            fio = match.group(0).strip()
             break
     
-    # Сайт: URL или доменное имя
-    website_pattern = r'(?:https?://)?(?:www\.)?([a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.(?:[a-zA-Z]{2,}))'
-    websites = re.findall(website_pattern, text)
-    # Фильтруем популярные почтовые сервисы и соцсети
-    exclude_domains = ['gmail.com', 'mail.ru', 'yandex.ru', 'yahoo.com', 'outlook.com', 
-                       'vk.com', 'facebook.com', 'twitter.com', 'instagram.com', 'telegram.org']
     website = ""
-    for w in websites:
-        if w.lower() not in exclude_domains:
-            website = w.lower()
+    for match in WEBSITE_RE.finditer(text):
+        if match.group(1).lower() not in EXCLUDED_WEBSITE_DOMAINS:
+            website = match.group(1).lower()
             break
     
-    # Компания: ищем ООО, ИП, ЗАО, ПАО, АО и т.п.
-    # Ищем полное название компании с кавычками
-    company_patterns = [
-        r'(ООО|ИП|ЗАО|ПАО|АО|ОАО|НПО|НТЦ|ОП|ТД|ИЧП|ЧП|ЧУП|ТОО|АОЗТ)\s*["«]([^"»\n]{3,50})["»]',
-        r'(ООО|ИП|ЗАО|ПАО|АО|ОАО|НПО|НТЦ|ОП|ТД|ИЧП|ЧП|ЧУП|ТОО|АОЗТ)\s+([А-ЯЁ][А-ЯЁа-яё\s\-]{2,40}?)(?:\s|$|,|\.|«|")',
-    ]
-    
     company = ""
-    for pattern in company_patterns:
-        matches = re.findall(pattern, text, re.IGNORECASE)
-        if matches:
+    for pattern in COMPANY_RES:
+        match = pattern.search(text)
+        if match:
             # Берем первое найденное название компании
-            prefix = matches[0][0].upper()
-            comp_name = matches[0][1].strip()
+            prefix = match.group(1).upper()
             # Очищаем название от лишних символов
-            comp_name = re.sub(r'["«»"]', '', comp_name).strip()
+            comp_name = COMPANY_QUOTES_RE.sub('', match.group(2).strip()).strip()
             if comp_name:
                 company = f"{prefix} {comp_name}".strip()
                 break
     
-    # Адрес: ищем адреса (обычно содержат слова типа "г.", "ул.", "д.", "офис", "помещ.")
-    # Ищем строки с индексами или адресными словами
-    address_patterns = [
-        # Индекс в начале (6 цифр) + адрес
-        r'\d{6}[^,\n]*(?:,\s*[^,\n]+){0,5}(?:,\s*(?:г\.|город|г\s)[^,\n]+)?(?:,\s*(?:ул\.|улица|пр\.|проспект|пер\.|переулок|вн\.тер\.г\.)[^,\n]+)?(?:,\s*(?:д\.|дом)[^,\n]+)?(?:,\s*(?:лит\.|литера|лит)[^,\n]+)?(?:,\s*(?:помещ\.|помещение|офис|оф\.)[^,\n]+)?',
-        # Адрес без индекса, начинающийся с города или улицы
-        r'(?:г\.|город|г\s|ул\.|улица|пр\.|проспект|пер\.|переулок|вн\.тер\.г\.)[^,\n]+(?:,\s*[^,\n]+){0,6}(?:,\s*(?:д\.|дом)[^,\n]+)?(?:,\s*(?:лит\.|литера|лит)[^,\n]+)?(?:,\s*(?:помещ\.|помещение|офис|оф\.)[^,\n]+)?',
-    ]
-    
     address = ""
     found_addresses = []
-    for pattern in address_patterns:
-        matches = re.findall(pattern, text, re.IGNORECASE)
-        if matches:
-            found_addresses.extend(matches)
+    for pattern in ADDRESS_RES:
+        found_addresses.extend(pattern.findall(text))
     
     if found_addresses:
         # Берем самый длинный адрес (обычно он самый полный)
         address = max(found_addresses, key=len).strip()
         # Очищаем от лишних символов в конце и начале
-        address = re.sub(r'^[,\s]+', '', address)
-        address = re.sub(r'[,\s]+$', '', address)
+        address = ADDRESS_LEADING_RE.sub('', address)
+        address = ADDRESS_TRAILING_RE.sub('', address)
         # Ограничиваем длину адреса
         if len(address) > 200:
             address = address[:200] + "..."
     
     return phones_str, inn, fio, website, company, address
 
+def message_headers(msg: Dict) -> Dict[str, str]:
+    """Заголовки письма из ответа messages.get в виде словаря с именами в нижнем регистре"""
+    return {h['name'].lower(): h['value'] for h in msg.get('payload', {}).get('headers', [])}
+
 def is_reply_message(headers: dict) -> bool:
     """Определяет, является ли письмо ответом на другое письмо"""
     # Проверяем заголовки In-Reply-To и References
@@ -388,42 +959,226 @@ def is_reply_message(headers: dict) -> bool:
                 subject_lower.startswith('fwd') or
                 subject_lower.startswith('fw:'))
 
+# ================= RATE LIMITER =================
+class RateLimiter:
+    """Адаптивный ограничитель скорости (token bucket + AIMD) в единицах квоты Gmail API.
+    
+    Скорость растет аддитивно (на RATE_LIMIT_INCREASE за интервал RATE_LIMIT_INTERVAL, а не
+    за каждый ответ), пока ответы успешные, и снижается мультипликативно при 429/5xx.
+    Один экземпляр разделяется всеми рабочими потоками.
+    """
+    
+    def __init__(self, start_rate: float = RATE_LIMIT_START, min_rate: float = RATE_LIMIT_MIN,
+                 max_rate: float = QUOTA_UNITS_PER_SECOND):
+        self._lock = threading.Lock()
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self._rate = min(max(start_rate, min_rate), max_rate)
+        self._tokens = self._rate
+        self._last_refill = time.monotonic()
+        self._last_increase = self._last_refill
+        self._blocked_until = 0.0
+        self._consecutive_throttles = 0
+        self._throttle_count = 0
+        self._wait_time = 0.0
+        self._scheduler = None
+        self._account = ""
+    
+    def attach_scheduler(self, scheduler, account: str):
+        """Кроме своей квоты (на пользователя) запросы ждут доли общей квоты проекта"""
+        with self._lock:
+            self._scheduler = scheduler
+            self._account = account
+    
+    def _refill(self, now: float):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        # Емкость корзины - одна секунда на текущей скорости
+        self._tokens = min(self._rate, self._tokens + elapsed * self._rate)
+    
+    def reserve(self, units: int = 5) -> float:
+        """Неблокирующая попытка: 0, если units единиц квоты списаны, иначе сколько секунд подождать.
+        
+        Ожидание выполняет вызывающий: поток - time.sleep, корутина - asyncio.sleep.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._blocked_until:
+                wait = self._blocked_until - now
+                self._wait_time += wait
+                return wait
+            # Запрос дороже емкости корзины (batch) уходит в долг, который отрабатывается позже
+            needed = min(units, self._rate)
+            if self._tokens < needed:
+                wait = (needed - self._tokens) / self._rate
+                self._wait_time += wait
+                return wait
+            # Своя квота есть - списываем ее сразу, чтобы другие потоки ее не заняли
+            self._tokens -= units
+            scheduler, account = self._scheduler, self._account
+        if scheduler is None:
+            return 0.0
+        # Доля квоты проекта - вызов через прокси в другой процесс, поэтому вне блокировки:
+        # остальные потоки не ждут его ответа
+        wait = scheduler.reserve(account, units)
+        if wait:
+            with self._lock:
+                # Доля не выделена - своя квота возвращается в корзину
+                self._tokens = min(self._rate, self._tokens + units)
+                self._wait_time += wait
+        return wait
+    
+    def acquire(self, units: int = 5):
+        """Блокирует поток, пока в корзине не наберется units единиц квоты"""
+        waited = 0.0
+        while True:
+            wait = self.reserve(units)
+            if not wait:
+                break
+            waited += wait
+            time.sleep(wait)
+        if waited:
+            metrics.observe('rate_limit_wait', waited)
+    
+    async def acquire_async(self, units: int = 5):
+        """То же, что acquire, но ожидание не занимает поток"""
+        waited = 0.0
+        while True:
+            wait = self.reserve(units)
+            if not wait:
+                break
+            waited += wait
+            await asyncio.sleep(wait)
+        if waited:
+            metrics.observe('rate_limit_wait', waited)
+    
+    def on_success(self):
+        with self._lock:
+            self._consecutive_throttles = 0
+            now = time.monotonic()
+            if now - self._last_increase >= RATE_LIMIT_INTERVAL:
+                self._last_increase = now
+                self._rate = min(self.max_rate, self._rate + RATE_LIMIT_INCREASE)
+    
+    def on_throttle(self):
+        """Ответ 429/5xx: снижаем скорость и приостанавливаем все потоки"""
+        with self._lock:
+            self._throttle_count += 1
+            self._consecutive_throttles += 1
+            self._rate = max(self.min_rate, self._rate * RATE_LIMIT_DECREASE)
+            self._tokens = min(self._tokens, 0.0)
+            # Рост возобновляется через полный интервал после снижения
+            self._last_increase = time.monotonic()
+            backoff = min(RATE_LIMIT_BACKOFF * 2 ** (self._consecutive_throttles - 1), 60)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + backoff)
+            logger.warning(f"Ограничение API: скорость снижена до {self._rate:.1f} ед/сек, пауза {backoff:.1f} сек")
+    
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                'rate': round(self._rate, 1),
+                'throttles': self._throttle_count,
+                'wait_time': round(self._wait_time, 1)
+            }
+
+rate_limiter = RateLimiter()
+
+class QuotaScheduler:
+    """Справедливое деление квоты проекта между почтовыми ящиками.
+    
+    Каждый ящик, обращавшийся к API за последние ACTIVE_WINDOW секунд, получает равную
+    долю PROJECT_QUOTA_PER_SECOND (своя корзина токенов), поэтому занятый ящик не вытесняет
+    остальные. Работает в процессе-менеджере, ящики обращаются к нему через прокси.
+    """
+    ACTIVE_WINDOW = 5.0
+    
+    def __init__(self, units_per_second: float = PROJECT_QUOTA_PER_SECOND):
+        self._lock = threading.Lock()
+        self.units_per_second = units_per_second
+        self._buckets: Dict[str, List[float]] = {}  # ящик -> [токены, время пополнения, последний запрос]
+        self._granted: Dict[str, int] = {}
+    
+    def reserve(self, account: str, units: int) -> float:
+        """0, если units единиц выделены ящику, иначе сколько секунд подождать"""
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._buckets.setdefault(account, [0.0, now, now])
+            bucket[2] = now
+            active = sum(1 for b in self._buckets.values() if now - b[2] <= self.ACTIVE_WINDOW)
+            share = self.units_per_second / max(1, active)
+            bucket[0] = min(share, bucket[0] + (now - bucket[1]) * share)
+            bucket[1] = now
+            needed = min(units, share)
+            if bucket[0] >= needed:
+                bucket[0] -= units
+                self._granted[account] = self._granted.get(account, 0) + units
+                return 0.0
+            return (needed - bucket[0]) / share
+    
+    def get_stats(self) -> Dict[str, int]:
+        """Выделено единиц квоты по ящикам"""
+        with self._lock:
+            return dict(self._granted)
+
+def _is_throttle_status(status: int) -> bool:
+    return status == 429 or status >= 500
+
 # ================= SAFE API CALLS =================
-def safe_api_call(func, *args, **kwargs):
+def _throttle_cause(status: int) -> str:
+    """Причина повтора для метрик: 429 отдельно от ошибок сервера"""
+    return 'http_429' if status == 429 else 'http_5xx'
+
+def _retry_pause(seconds: float):
+    """Пауза перед повтором запроса; суммарное время пауз учитывается в метриках"""
+    metrics.inc('backoff_seconds', seconds)
+    time.sleep(seconds)
+
+def safe_api_call(func, *args, quota_units: int = 5, stage: str = 'api_call', **kwargs):
+    """Вызов Gmail API с повторами. quota_units - стоимость запроса в единицах квоты,
+    stage - стадия в метриках, куда попадает время запроса"""
     last_exception = None
-    
-    # Добавляем задержку перед каждым запросом для снижения нагрузки
-    time.sleep(API_DELAY)
+    throttled = False
     
     for attempt in range(RETRY_COUNT):
         try:
-            if attempt > 0:
+            if attempt > 0 and not throttled:
                 delay = min(2 ** attempt + 3, 30)
                 logger.info(f"Повторная попытка через {delay} секунд (попытка {attempt+1}/{RETRY_COUNT})")
-                time.sleep(delay)
-            
-            request = func(*args, **kwargs)
+                _retry_pause(delay)
+            throttled = False
             
-            if hasattr(request, 'execute'):
-                return request.execute()
-            return request
+            # Ограничитель скорости заменяет фиксированную задержку перед каждым запросом
+            rate_limiter.acquire(quota_units)
+            with metrics.timer(stage):
+                request = func(*args, **kwargs)
+                
+                if hasattr(request, 'execute'):
+                    result = request.execute()
+                else:
+                    result = request
+            rate_limiter.on_success()
+            return result
             
         except (ssl.SSLError, urllib3.exceptions.SSLError) as e:
             error_str = str(e)
             logger.warning(f"SSL Error (attempt {attempt+1}/{RETRY_COUNT}): {error_str[:100]}")
+            metrics.inc('retries', cause='ssl')
             last_exception = e
             
             # Для SSL ошибок делаем меньше попыток
             if attempt >= 2:
                 logger.error(f"SSL ошибка после {attempt+1} попыток, пропускаем")
                 return None
-            time.sleep(3)
+            _retry_pause(3)
             
         except HttpError as e:
-            if e.resp.status in [429, 503, 500]:
+            if _is_throttle_status(e.resp.status):
                 logger.warning(f"HTTP {e.resp.status} (attempt {attempt+1}/{RETRY_COUNT})")
+                metrics.inc('retries', cause=_throttle_cause(e.resp.status))
                 last_exception = e
-                time.sleep(5)
+                throttled = True
+                rate_limiter.on_throttle()
                 continue
             raise
             
@@ -431,284 +1186,1676 @@ def safe_api_call(func, *args, **kwargs):
             error_str = str(e)
             if "IncompleteRead" in error_str or "Remote end closed" in error_str:
                 logger.warning(f"Сетевая ошибка (attempt {attempt+1}/{RETRY_COUNT}): {e}")
+                metrics.inc('retries', cause='network')
                 last_exception = e
-                time.sleep(3)
+                _retry_pause(3)
                 continue
             
             if "SSL" in error_str or "DECRYPTION_FAILED" in error_str or "WRONG_VERSION_NUMBER" in error_str:
                 logger.warning(f"SSL-related error (attempt {attempt+1}/{RETRY_COUNT}): {error_str[:100]}")
+                metrics.inc('retries', cause='ssl')
                 last_exception = e
                 if attempt >= 2:
                     return None
-                time.sleep(3)
+                _retry_pause(3)
                 continue
                 
             logger.warning(f"API error (attempt {attempt+1}/{RETRY_COUNT}): {e}")
+            metrics.inc('retries', cause='other')
             last_exception = e
             if attempt < RETRY_COUNT - 1:
-                time.sleep(2)
+                _retry_pause(2)
                 continue
     
     logger.error(f"Все попытки исчерпаны: {last_exception}")
     raise last_exception if last_exception else Exception("Неизвестная ошибка API")
 
-# ================= ATTACHMENTS =================
-def parse_attachment(service, msg_id: str, part: Dict) -> str:
-    MAX_ATTACHMENT_SIZE = 10 * 1024 * 1024
-    
-    try:
-        filename = part.get("filename", "").lower()
-        if not filename:
-            return ""
-        
-        att_id = part['body'].get('attachmentId')
-        if not att_id:
-            return ""
-        
-        size = int(part['body'].get('size', 0))
-        if size > MAX_ATTACHMENT_SIZE:
-            return f"[Вложение слишком большое: {filename}]"
-        
-        attachment = safe_api_call(
-            service.users().messages().attachments().get,
-            userId='me', messageId=msg_id, id=att_id
-        )
-        
-        if attachment is None:
-            return "[Ошибка загрузки вложения: SSL ошибка]"
-        
-        file_data = base64.urlsafe_b64decode(attachment['data'])
-        text = ""
-        
-        if filename.endswith(".pdf"):
-            with pdfplumber.open(io.BytesIO(file_data)) as pdf:
-                for i, page in enumerate(pdf.pages):
-                    if i > 20:
-                        text += "\n[Обрезано после 20 страниц]"
-                        break
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + "\n"
-                        
-        elif filename.endswith((".docx", ".doc")):
-            doc = Document(io.BytesIO(file_data))
-            for para in doc.paragraphs:
-                text += para.text + "\n"
-                
-        elif filename.endswith(".txt"):
-            text = file_data.decode('utf-8', errors='ignore')
-            
-        return clean_text(text)
-        
-    except Exception as e:
-        logger.error(f"Attachment error: {e}")
-        return f"[Ошибка вложения: {str(e)}]"
+def is_message_gone(error: Exception) -> bool:
+    """Письмо удалено после получения списка (404): повторять загрузку бессмысленно"""
+    if isinstance(error, HttpError):
+        return error.resp.status == 404
+    # httpx.HTTPStatusError асинхронного движка
+    return getattr(getattr(error, 'response', None), 'status_code', None) == 404
 
-# ================= MESSAGE PROCESSING =================
-def process_message(service, msg_id: str, state: ThreadSafeState, skip_replies: bool = False, skip_text: bool = False) -> Optional[EmailData]:
-    if state.is_cancelled():
-        return None
+def _is_retryable_batch_error(error: Exception) -> bool:
+    """Можно ли повторить элемент batch-запроса, завершившийся ошибкой"""
+    if isinstance(error, HttpError):
+        return _is_throttle_status(error.resp.status)
+    return True
+
+def _message_parts_mask(depth: int) -> str:
+    """Маска полей части письма: parts рекурсивны, на последнем уровне вложенные части берутся целиком"""
+    part_fields = "partId,mimeType,filename,body(data,attachmentId,size)"
+    mask = f"{part_fields},parts"
+    for _ in range(depth):
+        mask = f"{part_fields},parts({mask})"
+    return mask
+
+# Маски полей (partial response) - только то, что читает экспорт
+MESSAGE_FIELDS = f"id,threadId,payload(headers(name,value),{_message_parts_mask(MESSAGE_PARTS_DEPTH)})"
+FIELD_MASKS = {
+    'full': MESSAGE_FIELDS,
+    'thread': f"id,messages({MESSAGE_FIELDS})",
+    'metadata': "id,threadId,payload/headers",
+    'raw': "id,threadId,raw",
+    'list': "messages(id,threadId),nextPageToken,resultSizeEstimate",
+    'estimate': "messages/id,resultSizeEstimate",
+    'history': "history/messagesAdded/message(id,threadId,labelIds),nextPageToken",
+    'attachment': "data,size",
+    'profile': "historyId",
+}
+
+def field_mask(kind: str) -> Dict[str, str]:
+    """Параметр fields для вызова API (пустой, если PARTIAL_RESPONSE выключен)"""
+    return {'fields': FIELD_MASKS[kind]} if PARTIAL_RESPONSE else {}
+
+def _message_get_params(msg_format: str) -> Dict[str, Any]:
+    """Параметры messages.get для формата: в режиме metadata - только заголовки фильтра ответов"""
+    if msg_format == 'metadata':
+        return {'format': msg_format, 'metadataHeaders': REPLY_FILTER_HEADERS, **field_mask('metadata')}
+    return {'format': msg_format, **field_mask(msg_format)}
+
+def execute_batched(service, keys: List[str], make_request, quota_units: int = 5) -> tuple:
+    """Выполнение однотипных запросов пакетами до FETCH_BATCH_SIZE в одном HTTP-запросе.
     
-    try:
-        msg = safe_api_call(
-            service.users().messages().get,
-            userId='me', id=msg_id, format='full'
-        )
-        
-        if msg is None:
-            logger.warning(f"Пропуск письма {msg_id} из-за SSL ошибки")
-            return None
-        
-        payload = msg.get('payload', {})
-        headers = {h['name'].lower(): h['value'] for h in payload.get('headers', [])}
-        
-        # Проверяем, является ли письмо ответом
-        if skip_replies and is_reply_message(headers):
-            logger.info(f"Пропуск ответа: {msg_id}")
-            return None
-        
-        subject = headers.get('subject', 'Без темы')
-        subject = clean_text(subject)
-        
-        date_str = format_date(headers.get('date', ''))
-        
-        sender_raw = headers.get('from', 'Неизвестно')
-        sender = extract_email_from_sender(sender_raw)
-        
-        body = ""
-        has_attachments = False
-        attachment_tasks = []
-        
-        def process_parts(parts):
-            nonlocal body, has_attachments
-            for part in parts:
-                mime_type = part.get('mimeType', '')
-                
-                if mime_type == 'text/plain' and part['body'].get('data'):
-                    try:
-                        decoded = base64.urlsafe_b64decode(part['body']['data'])
-                        body += decoded.decode('utf-8', errors='ignore')
-                    except Exception as e:
-                        logger.warning(f"Ошибка декодирования text/plain: {e}")
-                    
-                elif mime_type == 'text/html' and part['body'].get('data'):
-                    try:
-                        decoded = base64.urlsafe_b64decode(part['body']['data'])
-                        html = decoded.decode('utf-8', errors='ignore')
-                        body += clean_html(html)
-                    except Exception as e:
-                        logger.warning(f"Ошибка декодирования text/html: {e}")
-                    
-                elif part.get('filename'):
-                    has_attachments = True
-                    attachment_tasks.append(part)
-                
-                if 'parts' in part:
-                    process_parts(part['parts'])
+    make_request(key) строит запрос API для ключа. Возвращает (results, errors): словари
+    key -> ответ и key -> исключение. Элементы с временными ошибками (429/5xx, сеть)
+    повторяются отдельными batch-запросами.
+    """
+    results: Dict[str, Dict] = {}
+    errors: Dict[str, Exception] = {}
+    
+    def callback(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+        else:
+            results[request_id] = response
+    
+    def build_batch(chunk: List[str]):
+        batch = service.new_batch_http_request(callback=callback)
+        for key in chunk:
+            batch.add(make_request(key), request_id=key)
+        return batch
+    
+    pending = list(keys)
+    for attempt in range(RETRY_COUNT):
+        if not pending:
+            break
+        if attempt > 0:
+            # Пауза перед повтором задается ограничителем скорости (rate_limiter.acquire)
+            logger.info(f"Повтор batch-запроса для {len(pending)} элементов (попытка {attempt+1}/{RETRY_COUNT})")
+            metrics.inc('retries', len(pending), cause='batch_item')
         
-        if 'parts' in payload:
-            process_parts(payload['parts'])
-        elif payload.get('body', {}).get('data'):
+        for start in range(0, len(pending), FETCH_BATCH_SIZE):
+            chunk = pending[start:start + FETCH_BATCH_SIZE]
+            for key in chunk:
+                errors.pop(key, None)
+            failure = Exception("batch-запрос не выполнен (SSL ошибка)")
             try:
-                decoded = base64.urlsafe_b64decode(payload['body']['data'])
-                body = decoded.decode('utf-8', errors='ignore')
+                # Каждый вложенный запрос расходует квоту как отдельный вызов
+                safe_api_call(build_batch, chunk, quota_units=quota_units * len(chunk), stage='api_batch')
             except Exception as e:
-                logger.warning(f"Ошибка декодирования тела письма: {e}")
-        
-        body = clean_text(body)
-        
-        # Если установлена галочка "не читать текст", не обрабатываем вложения
-        # Но нам все равно нужно прочитать текст для извлечения данных
-        if not skip_text and attachment_tasks and not state.is_cancelled():
-            with ThreadPoolExecutor(max_workers=ATTACHMENT_WORKERS) as pool:
-                futures = [
-                    pool.submit(parse_attachment, service, msg_id, p) 
-                    for p in attachment_tasks
-                ]
-                for future in futures:
-                    try:
-                        att_text = future.result(timeout=30)
-                        if att_text:
-                            body += "\n\n[ВЛОЖЕНИЕ]:\n" + att_text
-                    except Exception as e:
-                        logger.error(f"Attachment processing error: {e}")
-        
-        body = clean_text(body)
-        
-        # Извлекаем данные из текста (телефон, ИНН, ФИО, сайт, компания, адрес)
-        phone, inn, fio, website, company, address = extract_data(body)
-        
-        # Если установлена галочка "не читать текст", очищаем текст после извлечения данных
-        if skip_text:
-            body = ""
-        
-        return EmailData(
-            date=date_str,
-            from_email=sender,
-            subject=subject,
-            phone=phone,
-            inn=inn,
-            text=body,
-            fio=fio,
-            website=website,
-            company=company,
-            address=address,
-            has_attachments=has_attachments,
-            processed_at=datetime.now().isoformat()
-        )
-        
-    except Exception as e:
-        logger.error(f"Message processing error {msg_id}: {e}")
-        return None
-
-# ================= STATE MANAGEMENT =================
-def save_state(data: List[EmailData], processed_ids: set, output_file: str = "emails_chunk"):
-    try:
-        state = {
-            "processed_ids": list(processed_ids),
-            "last_save": datetime.now().isoformat(),
-            "count": len(data)
-        }
-        
-        temp_state = STATE_FILE + ".tmp"
-        with open(temp_state, 'w', encoding='utf-8') as f:
-            json.dump(state, f)
-        os.replace(temp_state, STATE_FILE)
+                logger.error(f"Ошибка batch-запроса ({len(chunk)} элементов): {e}")
+                failure = e
+            for key in chunk:
+                if key not in results and key not in errors:
+                    errors[key] = failure
+            if any(isinstance(errors.get(key), HttpError) and _is_throttle_status(errors[key].resp.status) for key in chunk):
+                rate_limiter.on_throttle()
         
-        if data:
-            df = pd.DataFrame([d.to_dict() for d in data])
-            temp_excel = f"{output_file}.tmp.xlsx"
-            final_excel = f"{output_file}.xlsx"
-            try:
-                logger.info(f"Создание Excel файла: {final_excel} ({len(data)} записей)")
-                df.to_excel(temp_excel, index=False, engine='openpyxl')
-                
-                if os.path.exists(temp_excel):
-                    file_size = os.path.getsize(temp_excel)
-                    logger.info(f"Временный файл создан: {temp_excel}, размер: {file_size} байт")
-                    
-                    if os.path.exists(final_excel):
-                        try:
-                            os.remove(final_excel)
-                            logger.info(f"Удален старый файл: {final_excel}")
-                        except Exception as remove_err:
-                            logger.warning(f"Не удалось удалить старый файл {final_excel}: {remove_err}")
-                            backup_name = f"{output_file}_old_{int(time.time())}.xlsx"
-                            try:
-                                os.rename(final_excel, backup_name)
-                                logger.info(f"Старый файл переименован в: {backup_name}")
-                            except:
-                                pass
-                    
-                    os.replace(temp_excel, final_excel)
-                    
-                    if os.path.exists(final_excel):
-                        abs_path = os.path.abspath(final_excel)
-                        logger.info(f"✓ Excel файл успешно сохранен: {abs_path} ({len(data)} записей)")
-                    else:
-                        logger.error(f"Файл не найден после переименования: {final_excel}")
-                else:
-                    logger.error(f"Временный файл не создан: {temp_excel}")
-            except PermissionError as perm_error:
-                error_msg = f"Нет доступа к файлу {final_excel}. Возможно, файл открыт в другой программе: {perm_error}"
-                logger.error(error_msg)
-                raise Exception(error_msg)
-            except Exception as excel_error:
-                logger.error(f"Ошибка создания Excel файла {final_excel}: {excel_error}", exc_info=True)
-                raise
-            
-    except Exception as e:
-        logger.error(f"State save error: {e}")
-        raise
+        pending = [key for key in pending if key in errors and _is_retryable_batch_error(errors[key])]
+    
+    return results, errors
 
-def load_state() -> tuple:
-    if not os.path.exists(STATE_FILE):
-        return set(), []
+def fetch_messages_batch(service, msg_ids: List[str], msg_format: str = 'full') -> tuple:
+    """Пакетная загрузка писем: до FETCH_BATCH_SIZE вызовов messages.get в одном HTTP-запросе.
     
-    try:
-        with open(STATE_FILE, 'r', encoding='utf-8') as f:
-            state = json.load(f)
-        processed_ids = set(state.get("processed_ids", []))
-        
-        data = []
-        if os.path.exists("emails_chunk.xlsx"):
-            df = pd.read_excel("emails_chunk.xlsx")
-            data = [EmailData(**row) for row in df.to_dict('records')]
-            
-        return processed_ids, data
-    except Exception as e:
-        logger.error(f"State load error: {e}")
-        return set(), []
+    Возвращает (messages, errors): словари msg_id -> письмо и msg_id -> исключение.
+    """
+    messages, errors = execute_batched(
+        service, msg_ids,
+        lambda msg_id: service.users().messages().get(userId='me', id=msg_id, **_message_get_params(msg_format))
+    )
+    
+    for msg_id, error in errors.items():
+        logger.warning(f"Batch: не удалось загрузить письмо {msg_id}: {error}")
+    if msg_format != 'metadata':
+        transfer_meter.count_messages(len(messages))
+    logger.info(f"Batch-загрузка: успешно {len(messages)}, с ошибками {len(errors)} из {len(msg_ids)}")
+    return messages, errors
+
+def fetch_messages(service, msg_ids: List[str], msg_format: str = 'full', batch: bool = True) -> tuple:
+    """Загрузка писем batch-запросами или по одному. Возвращает (messages, errors) как fetch_messages_batch"""
+    if batch:
+        return fetch_messages_batch(service, msg_ids, msg_format)
+    messages: Dict[str, Dict] = {}
+    errors: Dict[str, Exception] = {}
+    for msg_id in msg_ids:
+        try:
+            msg = safe_api_call(service.users().messages().get, userId='me', id=msg_id,
+                                **_message_get_params(msg_format))
+            if msg is None:
+                errors[msg_id] = Exception("SSL ошибка")
+            else:
+                messages[msg_id] = msg
+        except Exception as e:
+            errors[msg_id] = e
+    if msg_format != 'metadata':
+        transfer_meter.count_messages(len(messages))
+    return messages, errors
+
+def group_by_thread(msg_ids: List[str], thread_of: Dict[str, str]) -> List[str]:
+    """Порядок ID, в котором письма одной цепочки идут подряд (чтобы попадать в один пакет)"""
+    groups: Dict[str, List[str]] = {}
+    for msg_id in msg_ids:
+        groups.setdefault(thread_of.get(msg_id) or msg_id, []).append(msg_id)
+    return [msg_id for ids in groups.values() for msg_id in ids]
+
+def fetch_messages_by_thread(service, msg_ids: List[str], thread_of: Dict[str, str],
+                             msg_format: str = 'full', batch: bool = True) -> tuple:
+    """Загрузка писем цепочками: один threads.get вместо messages.get на каждое письмо.
+    
+    threads.get стоит 10 единиц квоты против 5 у messages.get, поэтому цепочкой грузятся
+    только цепочки с двумя и более письмами из msg_ids, остальные письма - по одному.
+    Из цепочки берутся только письма из msg_ids: прочие не прошли фильтр по датам или
+    уже выгружены. Возвращает (messages, errors) как fetch_messages_batch.
+    """
+    by_thread: Dict[str, List[str]] = {}
+    for msg_id in msg_ids:
+        thread_id = thread_of.get(msg_id)
+        if thread_id:
+            by_thread.setdefault(thread_id, []).append(msg_id)
+    thread_ids = [thread_id for thread_id, ids in by_thread.items() if len(ids) > 1]
+    grouped = {msg_id for thread_id in thread_ids for msg_id in by_thread[thread_id]}
+    singles = [msg_id for msg_id in msg_ids if msg_id not in grouped]
+    
+    messages, errors = fetch_messages(service, singles, msg_format, batch) if singles else ({}, {})
+    if not thread_ids:
+        return messages, errors
+    
+    params = {'format': msg_format, **field_mask('thread')}
+    if batch:
+        threads, thread_errors = execute_batched(
+            service, thread_ids,
+            lambda thread_id: service.users().threads().get(userId='me', id=thread_id, **params),
+            quota_units=10
+        )
+    else:
+        threads, thread_errors = {}, {}
+        for thread_id in thread_ids:
+            try:
+                thread = safe_api_call(service.users().threads().get, userId='me', id=thread_id,
+                                       quota_units=10, **params)
+                if thread is None:
+                    thread_errors[thread_id] = Exception("SSL ошибка")
+                else:
+                    threads[thread_id] = thread
+            except Exception as e:
+                thread_errors[thread_id] = e
+    
+    thread_messages = 0
+    for thread_id in thread_ids:
+        if thread_id in thread_errors:
+            logger.warning(f"Не удалось загрузить цепочку {thread_id}: {thread_errors[thread_id]}")
+            for msg_id in by_thread[thread_id]:
+                errors[msg_id] = thread_errors[thread_id]
+            continue
+        found = {m['id']: m for m in threads[thread_id].get('messages', [])}
+        for msg_id in by_thread[thread_id]:
+            if msg_id in found:
+                messages[msg_id] = found[msg_id]
+                thread_messages += 1
+            else:
+                errors[msg_id] = Exception(f"письмо не найдено в цепочке {thread_id}")
+    
+    transfer_meter.count_messages(thread_messages)
+    logger.info(f"Загрузка цепочками: {len(thread_ids)} threads.get вместо {len(grouped)} messages.get, "
+                f"по одному: {len(singles)}")
+    return messages, errors
+
+def split_replies(service, msg_ids: List[str], batch: bool = True) -> tuple:
+    """Первая фаза двухфазной загрузки: по одним заголовкам (format='metadata') отделяет ответы.
+    
+    Возвращает (kept_ids, reply_ids). Письма, заголовки которых загрузить не удалось, остаются
+    для полной загрузки - ошибка там будет учтена как обычно.
+    """
+    headers_only, _ = fetch_messages(service, msg_ids, 'metadata', batch)
+    kept_ids, reply_ids = [], []
+    for msg_id in msg_ids:
+        msg = headers_only.get(msg_id)
+        if msg is not None and is_reply_message(message_headers(msg)):
+            reply_ids.append(msg_id)
+        else:
+            kept_ids.append(msg_id)
+    logger.info(f"Фильтр по заголовкам: ответов {len(reply_ids)}, к полной загрузке {len(kept_ids)} из {len(msg_ids)}")
+    return kept_ids, reply_ids
+
+# ================= MESSAGE CACHE =================
+def compress_blob(data: bytes) -> tuple:
+    """Сжатие для кэша писем: (кодек, данные)"""
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=MESSAGE_CACHE_LEVEL).compress(data)
+    return 'gzip', gzip.compress(data, compresslevel=6)
+
+def decompress_blob(codec: str, data: bytes) -> bytes:
+    if codec == 'gzip':
+        return gzip.decompress(data)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Кэш писем сжат zstd: установите пакет zstandard (pip install zstandard)")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Неизвестный кодек кэша писем: {codec}")
+
+class MessageCache:
+    """Постоянный кэш загруженных писем (ответ messages.get как есть) и байтов их вложений (SQLite).
+    
+    Данные сжаты zstd или gzip, кодек хранится у каждой строки. По кэшу разбор и извлечение
+    данных повторяются без обращений к API (ReextractEngine). Сжатый размер ограничен:
+    вытесняются письма, сохраненные раньше всех, вместе с их вложениями.
+    """
+    
+    def __init__(self, path: str = MESSAGE_CACHE_FILE, max_bytes: int = MESSAGE_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "msg_id TEXT PRIMARY KEY, codec TEXT NOT NULL, payload BLOB NOT NULL, size INTEGER NOT NULL, "
+                "stored_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_stored_at ON messages(stored_at)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS attachments ("
+                "msg_id TEXT NOT NULL, part_key TEXT NOT NULL, codec TEXT NOT NULL, data BLOB NOT NULL, "
+                "size INTEGER NOT NULL, PRIMARY KEY (msg_id, part_key))"
+            )
+        self._total_bytes = None  # Считается при первой записи: чтению размер кэша не нужен
+    
+    def _ensure_total(self):
+        if self._total_bytes is None:
+            self._total_bytes = self._conn.execute(
+                "SELECT (SELECT COALESCE(SUM(size), 0) FROM messages) + (SELECT COALESCE(SUM(size), 0) FROM attachments)"
+            ).fetchone()[0]
+    
+    def put_messages(self, items: List[tuple]):
+        """Сохранение пар (msg_id, ответ messages.get) одной транзакцией"""
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for msg_id, msg in items:
+            codec, payload = compress_blob(json.dumps(msg, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+            rows.append((msg_id, codec, payload, len(payload), now))
+        with self._lock, self._conn:
+            self._ensure_total()
+            for msg_id, _, _, size, _ in rows:
+                existing = self._conn.execute("SELECT size FROM messages WHERE msg_id = ?", (msg_id,)).fetchone()
+                self._total_bytes += size - (existing[0] if existing else 0)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO messages (msg_id, codec, payload, size, stored_at) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+    
+    def get_message(self, msg_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT codec, payload FROM messages WHERE msg_id = ?", (msg_id,)).fetchone()
+        return json.loads(decompress_blob(*row)) if row else None
+    
+    def put_attachment(self, msg_id: str, part_key: str, data: bytes):
+        codec, blob = compress_blob(data)
+        with self._lock, self._conn:
+            self._ensure_total()
+            existing = self._conn.execute(
+                "SELECT size FROM attachments WHERE msg_id = ? AND part_key = ?", (msg_id, part_key)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO attachments (msg_id, part_key, codec, data, size) VALUES (?, ?, ?, ?, ?)",
+                (msg_id, part_key, codec, blob, len(blob))
+            )
+            self._total_bytes += len(blob) - (existing[0] if existing else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+    
+    def has_attachment(self, msg_id: str, part_key: str) -> bool:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM attachments WHERE msg_id = ? AND part_key = ?", (msg_id, part_key)
+            ).fetchone() is not None
+    
+    def get_attachment(self, msg_id: str, part_key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT codec, data FROM attachments WHERE msg_id = ? AND part_key = ?", (msg_id, part_key)
+            ).fetchone()
+        return decompress_blob(*row) if row else None
+    
+    def message_ids(self) -> List[str]:
+        """ID писем в кэше в порядке сохранения"""
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT msg_id FROM messages ORDER BY stored_at, rowid")]
+    
+    def _evict(self):
+        """Удаляет письма, сохраненные раньше всех, с их вложениями, пока кэш не займет 90% предела"""
+        target = int(self.max_bytes * 0.9)
+        rows = self._conn.execute(
+            "SELECT m.msg_id, m.size + COALESCE((SELECT SUM(a.size) FROM attachments a WHERE a.msg_id = m.msg_id), 0) "
+            "FROM messages m ORDER BY m.stored_at, m.rowid"
+        )
+        evicted = []
+        for msg_id, size in rows:
+            if self._total_bytes <= target:
+                break
+            evicted.append((msg_id,))
+            self._total_bytes -= size
+        self._conn.executemany("DELETE FROM messages WHERE msg_id = ?", evicted)
+        self._conn.executemany("DELETE FROM attachments WHERE msg_id = ?", evicted)
+        logger.info(f"Кэш писем: вытеснено {len(evicted)} писем")
+    
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            self._ensure_total()
+            messages, attachments = self._conn.execute(
+                "SELECT (SELECT COUNT(*) FROM messages), (SELECT COUNT(*) FROM attachments)"
+            ).fetchone()
+            return {'messages': messages, 'attachments': attachments, 'bytes': self._total_bytes}
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# ================= ATTACHMENTS =================
+class AttachmentCache:
+    """Постоянный кэш извлеченного текста вложений (SQLite).
+    
+    Основной ключ - хэш содержимого файла, поэтому одинаковые вложения из разных
+    писем разбираются один раз. Дополнительное соответствие (ID письма, часть письма)
+    позволяет не скачивать вложение повторно. Размер ограничен, вытесняются
+    давно не использованные записи (LRU).
+    """
+    
+    def __init__(self, path: str = ATTACHMENT_CACHE_FILE, max_bytes: int = ATTACHMENT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                "content_hash TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_last_access ON blobs(last_access)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS refs ("
+                "msg_id TEXT NOT NULL, part_key TEXT NOT NULL, content_hash TEXT NOT NULL, "
+                "PRIMARY KEY (msg_id, part_key))"
+            )
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        self.hits = 0
+        self.ref_hits = 0
+        self.misses = 0
+    
+    def _touch(self, content_hash: str) -> Optional[str]:
+        row = self._conn.execute("SELECT text FROM blobs WHERE content_hash = ?", (content_hash,)).fetchone()
+        if row is None:
+            return None
+        with self._conn:
+            self._conn.execute("UPDATE blobs SET last_access = ? WHERE content_hash = ?", (time.time(), content_hash))
+        return row[0]
+    
+    def get_by_ref(self, msg_id: str, part_key: str) -> Optional[str]:
+        """Текст вложения письма, которое уже встречалось (без скачивания)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content_hash FROM refs WHERE msg_id = ? AND part_key = ?", (msg_id, part_key)
+            ).fetchone()
+            text = self._touch(row[0]) if row else None
+            if text is not None:
+                self.ref_hits += 1
+            return text
+    
+    def get(self, content_hash: str, msg_id: str, part_key: str) -> Optional[str]:
+        """Текст по хэшу содержимого; при попадании запоминает ссылку письма на него"""
+        with self._lock:
+            text = self._touch(content_hash)
+            if text is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO refs (msg_id, part_key, content_hash) VALUES (?, ?, ?)",
+                    (msg_id, part_key, content_hash)
+                )
+            return text
+    
+    def put(self, content_hash: str, text: str, msg_id: str, part_key: str):
+        size = len(text.encode('utf-8'))
+        with self._lock, self._conn:
+            existing = self._conn.execute("SELECT size FROM blobs WHERE content_hash = ?", (content_hash,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO blobs (content_hash, text, size, last_access) VALUES (?, ?, ?, ?)",
+                (content_hash, text, size, time.time())
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO refs (msg_id, part_key, content_hash) VALUES (?, ?, ?)",
+                (msg_id, part_key, content_hash)
+            )
+            self._total_bytes += size - (existing[0] if existing else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+    
+    def _evict(self):
+        """Удаляет давно не использованные записи, пока кэш не займет 90% предела"""
+        target = int(self.max_bytes * 0.9)
+        rows = self._conn.execute("SELECT content_hash, size FROM blobs ORDER BY last_access").fetchall()
+        evicted = []
+        for content_hash, size in rows:
+            if self._total_bytes <= target:
+                break
+            evicted.append((content_hash,))
+            self._total_bytes -= size
+        self._conn.executemany("DELETE FROM blobs WHERE content_hash = ?", evicted)
+        self._conn.executemany("DELETE FROM refs WHERE content_hash = ?", evicted)
+        logger.info(f"Кэш вложений: вытеснено {len(evicted)} записей")
+    
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'ref_hits': self.ref_hits,
+                'misses': self.misses,
+                'bytes': self._total_bytes
+            }
+
+_attachment_cache: Optional[AttachmentCache] = None
+_attachment_cache_lock = threading.Lock()
+
+def get_attachment_cache() -> AttachmentCache:
+    global _attachment_cache
+    with _attachment_cache_lock:
+        if _attachment_cache is None:
+            _attachment_cache = AttachmentCache()
+        return _attachment_cache
+
+def extract_attachment_text(filename: str, file_data: bytes, max_pages: int = ATTACHMENT_MAX_PAGES,
+                            timeout: float = ATTACHMENT_PARSE_TIMEOUT) -> str:
+    """Извлечение текста из файла вложения (PDF, DOCX, TXT).
+    
+    Выполняется в рабочем процессе: лимиты страниц и времени проверяются здесь же.
+    """
+    deadline = time.monotonic() + timeout
+    text = ""
+    
+    if filename.endswith(".pdf"):
+        import pdfplumber
+        with pdfplumber.open(io.BytesIO(file_data)) as pdf:
+            for i, page in enumerate(pdf.pages):
+                if i > max_pages:
+                    text += f"\n[Обрезано после {max_pages} страниц]"
+                    break
+                if time.monotonic() > deadline:
+                    text += f"\n[Обрезано по таймауту {timeout} сек]"
+                    break
+                page_text = page.extract_text()
+                if page_text:
+                    text += page_text + "\n"
+                    
+    elif filename.endswith((".docx", ".doc")):
+        from docx import Document
+        doc = Document(io.BytesIO(file_data))
+        for para in doc.paragraphs:
+            if time.monotonic() > deadline:
+                text += f"\n[Обрезано по таймауту {timeout} сек]"
+                break
+            text += para.text + "\n"
+            
+    elif filename.endswith(".txt"):
+        text = file_data.decode('utf-8', errors='ignore')
+        
+    return clean_text(text, html=False)
+
+# Очередь рабочего процесса разбора для сообщений о начале задач (задается инициализатором)
+_parse_started = None
+
+def _init_parse_worker(started):
+    global _parse_started
+    _parse_started = started
+
+def _run_parse_job(job_id: int, filename: str, file_data: bytes) -> str:
+    """Задача рабочего процесса: PID сообщается до разбора, чтобы зависший процесс можно было завершить"""
+    _parse_started.put((job_id, os.getpid()))
+    return extract_attachment_text(filename, file_data)
+
+class ParsePool:
+    """Пул процессов разбора вложений с учетом, какой процесс какую задачу выполняет.
+    
+    Зависший в C-коде разбор (pdfplumber) не проверяет лимит времени, и shutdown его не остановит.
+    Пул с зависшей задачей выводится из работы: новых задач он не принимает, начатые и
+    ожидающие разборы дорабатывают, после них завершается только процесс зависшей задачи.
+    Завершить его раньше нельзя - смерть рабочего процесса ломает весь пул.
+    """
+    
+    def __init__(self, workers: int):
+        self._started = multiprocessing.SimpleQueue()
+        self._executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_parse_worker,
+                                             initargs=(self._started,))
+        self._lock = threading.Lock()
+        self._next_job = 0
+        self._jobs: Dict[Any, int] = {}  # незавершенные задачи: future -> номер задачи
+        self._pids: Dict[int, int] = {}  # номер начатой задачи -> PID ее процесса
+        self._hung: set = set()
+        self.retired = False
+    
+    def submit(self, filename: str, file_data: bytes):
+        """Future с текстом вложения; RuntimeError - пул уже выведен из работы"""
+        with self._lock:
+            job_id = self._next_job
+            self._next_job += 1
+            future = self._executor.submit(_run_parse_job, job_id, filename, file_data)
+            self._jobs[future] = job_id
+        future.add_done_callback(self._job_done)
+        return future
+    
+    def _collect_pids(self):
+        # Вызывается под self._lock; заодно опустошает канал, чтобы рабочие процессы не блокировались
+        while not self._started.empty():
+            job_id, pid = self._started.get()
+            self._pids[job_id] = pid
+    
+    def _job_done(self, future):
+        with self._lock:
+            self._collect_pids()
+            self._pids.pop(self._jobs.pop(future, None), None)
+            self._hung.discard(future)
+            self._reap()
+    
+    def abandon(self, future):
+        """Задача не уложилась в лимит времени. Еще не начатая просто отменяется (ее задержал
+        чужой зависший разбор), начатая считается зависшей, и пул выводится из работы"""
+        if future.cancel():
+            return
+        with self._lock:
+            self._collect_pids()
+            if future not in self._jobs:
+                return
+            self._hung.add(future)
+            if not self.retired:
+                self.retired = True
+                self._executor.shutdown(wait=False)
+            self._reap()
+    
+    def _reap(self):
+        # Вызывается под self._lock: процессы зависших задач завершаются, когда остальные задачи готовы
+        if not self.retired or any(future not in self._hung for future in self._jobs):
+            return
+        for future in self._hung:
+            pid = self._pids.pop(self._jobs[future], None)
+            if pid is None:
+                continue
+            logger.warning(f"Завершение зависшего процесса разбора вложений {pid}")
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+_parse_pool: Optional[ParsePool] = None
+_parse_pool_lock = threading.Lock()
+
+def get_parse_pool() -> ParsePool:
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None or _parse_pool.retired:
+            _parse_pool = ParsePool(PARSE_WORKERS)
+        return _parse_pool
+
+def _drop_parse_pool(pool: ParsePool):
+    """Сломанный пул (сбой рабочего процесса) заменяется; пул, уже замененный другим потоком, не трогаем"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is pool:
+            _parse_pool = None
+    pool.shutdown(wait=False)
+
+def shutdown_parse_pool():
+    """Остановка пула разбора с ожиданием рабочих процессов. Нужна процессу, который сам
+    запущен через multiprocessing: при его завершении atexit-обработчики пула не вызываются"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown(wait=True)
+        _parse_pool = None
+
+@timed('attachment_parse')
+def parse_attachment_data(filename: str, file_data: bytes) -> str:
+    """Разбор скачанного вложения в пуле процессов (сетевые потоки не блокируются на GIL).
+    
+    Лимит времени в рабочем процессе проверяется между страницами, поэтому зависшая страница
+    ловится здесь: пул с зависшей задачей выводится из работы, вызывающему - TimeoutError.
+    В текущем процессе не разбираем никогда: зависший разбор там не остановить.
+    """
+    # Запас сверх лимита рабочего процесса - на очередь и передачу данных
+    timeout = ATTACHMENT_PARSE_TIMEOUT * 3
+    for attempt in range(2):
+        pool = get_parse_pool()
+        try:
+            future = pool.submit(filename, file_data)
+        except RuntimeError:
+            # Пул только что выведен из работы другим потоком
+            continue
+        try:
+            return future.result(timeout=timeout)
+        except FuturesTimeoutError:
+            logger.warning(f"Разбор вложения {filename} не завершился за {timeout} сек, пул разбора заменяется")
+            pool.abandon(future)
+            raise TimeoutError(f"разбор {filename} не завершился за {timeout} сек")
+        except BrokenProcessPool:
+            # Сбой рабочего процесса - повторяем в новом пуле
+            logger.warning(f"Пул разбора вложений остановлен, повторяем разбор {filename} в новом пуле")
+            _drop_parse_pool(pool)
+    raise RuntimeError(f"пул разбора вложений недоступен, {filename} не разобран")
+
+def parse_attachment(service, msg_id: str, part: Dict, message_cache: Optional[MessageCache] = None) -> str:
+    """Текст вложения. С кэшем писем скачанные байты сохраняются в нем для повторного извлечения"""
+    try:
+        filename = part.get("filename", "").lower()
+        if not filename:
+            return ""
+        
+        # В raw-режиме байты вложения уже есть в письме, загружать их не нужно
+        content = part.get('content')
+        att_id = part['body'].get('attachmentId')
+        if content is None and not att_id:
+            return ""
+        
+        size = int(part['body'].get('size', 0))
+        if size > MAX_ATTACHMENT_SIZE:
+            return f"[Вложение слишком большое: {filename}]"
+        if content is None and service is None:
+            # Загрузка без сервиса невозможна (асинхронный движок передает байты сам)
+            return f"[Вложение не загружено: {filename}]"
+        
+        # attachmentId может меняться между запросами письма, номер части - нет
+        cache = get_attachment_cache()
+        part_key = part.get('partId') or att_id
+        cached_text = cache.get_by_ref(msg_id, part_key)
+        # Кэшу писем нужны сами байты вложения: одного текста из кэша вложений ему мало
+        if cached_text is not None and (message_cache is None or content is not None
+                                        or message_cache.has_attachment(msg_id, part_key)):
+            metrics.inc('attachment_cache', result='ref_hit')
+            return cached_text
+        
+        if content is not None:
+            file_data = content
+        else:
+            attachment = safe_api_call(
+                service.users().messages().attachments().get,
+                userId='me', messageId=msg_id, id=att_id, stage='attachment_download', **field_mask('attachment')
+            )
+            
+            if attachment is None:
+                return "[Ошибка загрузки вложения: SSL ошибка]"
+            
+            file_data = base64.urlsafe_b64decode(attachment['data'])
+            metrics.inc('attachment_bytes', len(file_data))
+            if message_cache is not None:
+                message_cache.put_attachment(msg_id, part_key, file_data)
+        
+        # Результат разбора зависит и от содержимого, и от типа файла
+        content_hash = hashlib.sha256(file_data).hexdigest() + os.path.splitext(filename)[1]
+        cached_text = cache.get(content_hash, msg_id, part_key)
+        if cached_text is not None:
+            metrics.inc('attachment_cache', result='hit')
+            return cached_text
+        
+        metrics.inc('attachment_cache', result='miss')
+        text = parse_attachment_data(filename, file_data)
+        cache.put(content_hash, text, msg_id, part_key)
+        return text
+        
+    except Exception as e:
+        logger.error(f"Attachment error: {e}")
+        return f"[Ошибка вложения: {str(e)}]"
+
+# ================= MESSAGE PROCESSING =================
+@dataclass
+class ParsedMessage:
+    """Письмо после разбора заголовков и тела, до обработки вложений и извлечения данных"""
+    msg_id: str
+    date: str
+    from_email: str
+    subject: str
+    body: str
+    attachment_parts: List[Dict]
+    has_attachments: bool = False
+
+@timed('parse')
+def parse_message(msg: Dict, msg_id: str, skip_replies: bool = False) -> Optional[ParsedMessage]:
+    """Разбор заголовков и тела письма. None - письмо пропущено (ответ при skip_replies)"""
+    if 'raw' in msg:
+        return parse_raw_message(msg, msg_id, skip_replies)
+    payload = msg.get('payload', {})
+    headers = message_headers(msg)
+    
+    # Проверяем, является ли письмо ответом
+    if skip_replies and is_reply_message(headers):
+        logger.info(f"Пропуск ответа: {msg_id}")
+        return None
+    
+    subject = headers.get('subject', 'Без темы')
+    subject = clean_text(subject)
+    
+    date_str = format_date(headers.get('date', ''))
+    
+    sender_raw = headers.get('from', 'Неизвестно')
+    sender = extract_email_from_sender(sender_raw)
+    
+    body = ""
+    has_attachments = False
+    attachment_parts = []
+    
+    def process_parts(parts):
+        nonlocal body, has_attachments
+        for part in parts:
+            mime_type = part.get('mimeType', '')
+            
+            if mime_type == 'text/plain' and part['body'].get('data'):
+                try:
+                    decoded = base64.urlsafe_b64decode(part['body']['data'])
+                    body += decoded.decode('utf-8', errors='ignore')
+                except Exception as e:
+                    logger.warning(f"Ошибка декодирования text/plain: {e}")
+                
+            elif mime_type == 'text/html' and part['body'].get('data'):
+                try:
+                    decoded = base64.urlsafe_b64decode(part['body']['data'])
+                    html = decoded.decode('utf-8', errors='ignore')
+                    body += clean_html(html)
+                except Exception as e:
+                    logger.warning(f"Ошибка декодирования text/html: {e}")
+                
+            elif part.get('filename'):
+                has_attachments = True
+                attachment_parts.append(part)
+            
+            if 'parts' in part:
+                process_parts(part['parts'])
+    
+    if 'parts' in payload:
+        process_parts(payload['parts'])
+    elif payload.get('body', {}).get('data'):
+        try:
+            decoded = base64.urlsafe_b64decode(payload['body']['data'])
+            body = decoded.decode('utf-8', errors='ignore')
+        except Exception as e:
+            logger.warning(f"Ошибка декодирования тела письма: {e}")
+    
+    return ParsedMessage(
+        msg_id=msg_id,
+        date=date_str,
+        from_email=sender,
+        subject=subject,
+        body=clean_text(body),
+        attachment_parts=attachment_parts,
+        has_attachments=has_attachments
+    )
+
+def _part_text(part) -> str:
+    """Текст части письма в ее charset; без charset или при неизвестной кодировке - как utf-8"""
+    payload = part.get_payload(decode=True) or b""
+    try:
+        return payload.decode(part.get_content_charset() or 'utf-8', errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='ignore')
+
+def _decode_header_value(value: Optional[str]) -> str:
+    """Значение заголовка с раскодированными фрагментами RFC 2047 (=?utf-8?B?...?=)"""
+    if value is None:
+        return ""
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return str(value)
+
+def parse_raw_message(msg: Dict, msg_id: str, skip_replies: bool = False) -> Optional[ParsedMessage]:
+    """Разбор письма format='raw': RFC822 целиком, один проход пакетом email.
+    
+    Разбор в policy.compat32: policy.default заново разбирает заголовок при каждом
+    обращении и на порядок медленнее. Кодировки учитываются явно: заголовки
+    раскодируются по RFC 2047, текстовые части - по своему charset. Вложения берутся
+    из самого письма (part['content']) без отдельной загрузки.
+    """
+    message = BytesParser(policy=policy.compat32).parsebytes(base64.urlsafe_b64decode(msg['raw']))
+    headers = {name.lower(): value for name, value in message.items()}
+    headers['subject'] = _decode_header_value(headers.get('subject', 'Без темы'))
+    
+    # Проверяем, является ли письмо ответом
+    if skip_replies and is_reply_message(headers):
+        logger.info(f"Пропуск ответа: {msg_id}")
+        return None
+    
+    body = ""
+    attachment_parts = []
+    for index, part in enumerate(message.walk()):
+        if part.is_multipart():
+            continue
+        filename = part.get_filename()
+        content_type = part.get_content_type()
+        # Правило как в process_parts для 'full': текстовая часть с содержимым идет в тело,
+        # даже если у нее есть имя файла. Вложением она становится, только если явно
+        # помечена как attachment - такие части Gmail отдает по attachmentId, без данных
+        in_body = bool(part.get_payload()) and not (filename and part.get_content_disposition() == 'attachment')
+        if content_type == 'text/plain' and in_body:
+            body += _part_text(part)
+        elif content_type == 'text/html' and in_body:
+            body += clean_html(_part_text(part))
+        elif filename:
+            content = part.get_payload(decode=True) or b""
+            attachment_parts.append({
+                'partId': str(index),
+                'filename': _decode_header_value(filename),
+                'mimeType': content_type,
+                'body': {'size': len(content)},
+                'content': content,
+            })
+    
+    return ParsedMessage(
+        msg_id=msg_id,
+        date=format_date(str(headers.get('date', ''))),
+        from_email=extract_email_from_sender(_decode_header_value(headers.get('from', 'Неизвестно'))),
+        subject=clean_text(headers['subject']),
+        body=clean_text(body),
+        attachment_parts=attachment_parts,
+        has_attachments=bool(attachment_parts)
+    )
+
+ATTACHMENT_MARKER = "[ВЛОЖЕНИЕ]:"  # Начало текста вложения в теле письма
+
+@timed('attachments')
+def process_attachments(service, parsed: ParsedMessage, state: ThreadSafeState,
+                        services: Optional[ServicePool] = None, message_cache: Optional[MessageCache] = None) -> bool:
+    """Загрузка и разбор вложений, их текст добавляется к телу письма.
+    
+    Несколько вложений загружаются параллельно, только если есть services: каждый поток
+    берет из пула свой сервис (httplib2.Http не потокобезопасен). Без пула - по очереди через service.
+    False - вложения не обработаны из-за остановки: запись письма была бы неполной.
+    """
+    if not parsed.attachment_parts:
+        return True
+    if state.is_cancelled():
+        return False
+    
+    def load(part: Dict) -> str:
+        try:
+            with services.lease() as leased:
+                return parse_attachment(leased, parsed.msg_id, part, message_cache)
+        except Exception as e:
+            logger.error(f"Attachment processing error: {e}")
+            return ""
+    
+    if services is None or ATTACHMENT_WORKERS == 1 or len(parsed.attachment_parts) == 1:
+        texts = [parse_attachment(service, parsed.msg_id, part, message_cache) for part in parsed.attachment_parts]
+    else:
+        # Ожидание не ограничиваем: загрузку ограничивает таймаут HTTP, разбор - пул процессов
+        with ThreadPoolExecutor(max_workers=ATTACHMENT_WORKERS) as pool:
+            texts = list(pool.map(load, parsed.attachment_parts))
+    for att_text in texts:
+        if att_text:
+            parsed.body += f"\n\n{ATTACHMENT_MARKER}\n" + att_text
+    return True
+
+@timed('extract')
+def build_email_data(parsed: ParsedMessage, skip_text: bool = False) -> EmailData:
+    """Извлечение данных из текста письма и формирование записи"""
+    body = clean_text(parsed.body, html=False)
+    
+    # Извлекаем данные из текста (телефон, ИНН, ФИО, сайт, компания, адрес)
+    phone, inn, fio, website, company, address = extract_data(body)
+    
+    # Если установлена галочка "не читать текст", очищаем текст после извлечения данных
+    if skip_text:
+        body = ""
+    
+    return EmailData(
+        date=parsed.date,
+        from_email=parsed.from_email,
+        subject=parsed.subject,
+        phone=phone,
+        inn=inn,
+        text=body,
+        fio=fio,
+        website=website,
+        company=company,
+        address=address,
+        has_attachments=parsed.has_attachments,
+        processed_at=datetime.now().isoformat()
+    )
+
+def process_message(service, msg_id: str, state: ThreadSafeState, skip_replies: bool = False, skip_text: bool = False,
+                    msg: Optional[Dict] = None, msg_format: str = 'full',
+                    services: Optional[ServicePool] = None,
+                    message_cache: Optional[MessageCache] = None) -> Optional[EmailData]:
+    """Обработка письма. Если письмо уже загружено (batch-режим), оно передается в msg.
+    С кэшем писем письмо и байты вложений сохраняются для повторного извлечения"""
+    if state.is_cancelled():
+        return None
+    
+    try:
+        if msg is None:
+            msg = safe_api_call(
+                service.users().messages().get,
+                userId='me', id=msg_id, **_message_get_params(msg_format)
+            )
+            if msg is not None:
+                transfer_meter.count_messages(1)
+        
+        if msg is None:
+            logger.warning(f"Пропуск письма {msg_id} из-за SSL ошибки")
+            return None
+        if message_cache is not None:
+            message_cache.put_messages([(msg_id, msg)])
+        
+        parsed = parse_message(msg, msg_id, skip_replies)
+        if parsed is None:
+            return None
+        
+        # Если установлена галочка "не читать текст", не обрабатываем вложения
+        # Но нам все равно нужно прочитать текст для извлечения данных
+        if not skip_text and not process_attachments(service, parsed, state, services, message_cache):
+            return None
+        
+        return build_email_data(parsed, skip_text)
+        
+    except Exception as e:
+        logger.error(f"Message processing error {msg_id}: {e}")
+        return None
+
+# ================= STATE MANAGEMENT =================
+def _as_bool(value) -> bool:
+    """has_attachments из SQLite хранится текстом"""
+    return value in (1, '1', True, 'True')
+
+def _append_sheet(workbook, title: Optional[str], columns: List[str], rows) -> int:
+    """Лист книги write_only: заголовок полужирным, строки - по мере поступления. Возвращает число строк"""
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+    
+    sheet = workbook.create_sheet(title)
+    header_font = Font(bold=True)
+    header = []
+    for name in columns:
+        cell = WriteOnlyCell(sheet, value=name)
+        cell.font = header_font
+        header.append(cell)
+    sheet.append(header)
+    
+    flag_index = columns.index('has_attachments') if 'has_attachments' in columns else None
+    count = 0
+    for row in rows:
+        if flag_index is not None:
+            row = list(row)
+            row[flag_index] = _as_bool(row[flag_index])
+        sheet.append(row)
+        count += 1
+    return count
+
+@timed('xlsx_write')
+def write_records_xlsx(path: str, rows, columns: List[str] = RECORD_COLUMNS, contacts=None) -> int:
+    """Потоковая запись кортежей полей (в порядке columns) в Excel без DataFrame.
+    
+    Книга открывается в режиме write_only: строки сразу уходят во временный XML на диске.
+    Дубликаты отсеяны раньше - при добавлении записей (DedupIndex). contacts - строки
+    (в порядке CONTACT_COLUMNS) для второго листа. Возвращает число строк записей.
+    """
+    from openpyxl import Workbook
+    
+    workbook = Workbook(write_only=True)
+    count = _append_sheet(workbook, "Sheet1", columns, rows)  # Имя листа - как у прежнего pandas.to_excel
+    if contacts is not None:
+        _append_sheet(workbook, "contacts", CONTACT_COLUMNS, contacts)
+    workbook.save(path)
+    return count
+
+# ----- Контакты -----
+CONTACT_COLUMNS = ['email', 'inn', 'phones', 'fio', 'company', 'address', 'website',
+                   'first_seen', 'last_seen', 'message_count']
+CONTACT_TEXT_FIELDS = ['fio', 'company', 'address', 'website']  # Берутся из более нового письма
+
+def _merge_list(current: str, new: str) -> str:
+    """Объединение списков через запятую (телефоны, ИНН) с сохранением порядка появления"""
+    items = dict.fromkeys(item.strip() for item in f"{current},{new}".split(",") if item.strip())
+    return ", ".join(items)
+
+def sortable_date(date: str) -> str:
+    """Дата письма из format_date в сортируемом виде 'ГГГГ-ММ-ДД ЧЧ:ММ'; пустая строка, если не разобрана"""
+    try:
+        return datetime.strptime(date, "%d %b %Y %H:%M").strftime("%Y-%m-%d %H:%M")
+    except (TypeError, ValueError):
+        return ""
+
+def contact_key(record: EmailData, with_inn: bool = CONTACT_KEY_INN) -> tuple:
+    """Ключ контакта: (адрес отправителя, ИНН или пустая строка)"""
+    return (record.from_email or "").strip().lower(), (record.inn or "") if with_inn else ""
+
+def merge_contact(contact: Optional[Dict[str, Any]], record: EmailData, key: tuple) -> Dict[str, Any]:
+    """Контакт после учета еще одного письма: телефоны и ИНН объединяются, ФИО, компания,
+    адрес и сайт - непустые значения более нового письма, даты первого и последнего письма - крайние"""
+    seen = sortable_date(record.date)
+    if contact is None:
+        contact = dict.fromkeys(CONTACT_COLUMNS, "")
+        contact.update(email=key[0], first_seen=seen, last_seen=seen, message_count=0)
+    else:
+        contact = dict(contact)
+    newer = seen >= contact['last_seen']
+    contact['phones'] = _merge_list(contact['phones'], record.phone)
+    contact['inn'] = _merge_list(contact['inn'], record.inn)
+    for name in CONTACT_TEXT_FIELDS:
+        value = getattr(record, name)
+        if value and (newer or not contact[name]):
+            contact[name] = value
+    if seen:
+        contact['first_seen'] = min(contact['first_seen'] or seen, seen)
+        contact['last_seen'] = max(contact['last_seen'], seen)
+    contact['message_count'] += 1
+    return contact
+
+def merge_contact_rows(contact: Optional[Dict[str, Any]], other: Dict[str, Any]) -> Dict[str, Any]:
+    """Объединение двух контактов одного ключа (листы контактов разных ящиков) по правилам merge_contact:
+    ФИО, компания, адрес и сайт - из контакта с более поздним последним письмом. Письмо, пришедшее
+    в несколько ящиков, учтено в message_count каждого из них"""
+    if contact is None:
+        return dict(other)
+    merged = dict(contact)
+    newer = other['last_seen'] >= contact['last_seen']
+    merged['phones'] = _merge_list(contact['phones'], other['phones'])
+    merged['inn'] = _merge_list(contact['inn'], other['inn'])
+    for name in CONTACT_TEXT_FIELDS:
+        if other[name] and (newer or not merged[name]):
+            merged[name] = other[name]
+    merged['first_seen'] = min(filter(None, (contact['first_seen'], other['first_seen'])), default="")
+    merged['last_seen'] = max(contact['last_seen'], other['last_seen'])
+    merged['message_count'] = contact['message_count'] + other['message_count']
+    return merged
+
+class ExportStore:
+    """Состояние выгрузки в SQLite (WAL): извлеченные записи и статусы обработанных писем.
+    
+    Контрольная точка - одна транзакция с новыми строками, ее стоимость O(размер порции);
+    итоговый Excel строится один раз в конце или по запросу (export_xlsx) потоковым чтением порций.
+    """
+    COLUMNS = RECORD_COLUMNS
+    
+    def __init__(self, path: str = EXPORT_DB_FILE, dedup_key: tuple = DEDUP_KEY,
+                 contact_inn: bool = CONTACT_KEY_INN):
+        self.path = path
+        self._dedup = DedupIndex(dedup_key)
+        self.contact_inn = contact_inn
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        columns = ", ".join(f"{name} TEXT" for name in self.COLUMNS)
+        with self._conn:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY AUTOINCREMENT, msg_id TEXT, {columns}, "
+                "dedup_key BLOB)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_records_msg_id ON records(msg_id)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            # Контакты накапливаются между выгрузками; contact_messages - письма, уже учтенные в контактах
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS contacts ("
+                "email TEXT NOT NULL, inn_key TEXT NOT NULL, inn TEXT, phones TEXT, fio TEXT, company TEXT, "
+                "address TEXT, website TEXT, first_seen TEXT, last_seen TEXT, message_count INTEGER NOT NULL, "
+                "updated_at TEXT, PRIMARY KEY (email, inn_key))"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS contact_messages (msg_id TEXT PRIMARY KEY)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS processed ("
+                "msg_id TEXT PRIMARY KEY, status TEXT NOT NULL, error TEXT, updated_at TEXT)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS shards ("
+                "start_ts INTEGER NOT NULL, end_ts INTEGER NOT NULL, estimate INTEGER NOT NULL, "
+                "status TEXT NOT NULL, PRIMARY KEY (start_ts, end_ts))"
+            )
+        self._migrate_dedup_keys()
+    
+    def _migrate_dedup_keys(self):
+        """Дайджесты ключа дубликатов для записей без них (база прежней версии) или после смены DEDUP_KEY.
+        Однократный проход: повторные записи с тем же ключом удаляются, остается первая"""
+        key_definition = json.dumps(self._dedup.key)
+        with self._lock, self._conn:
+            record_columns = {row[1] for row in self._conn.execute("PRAGMA table_info(records)")}
+            if 'dedup_key' not in record_columns:
+                self._conn.execute("ALTER TABLE records ADD COLUMN dedup_key BLOB")
+            stored = self._conn.execute("SELECT value FROM meta WHERE name = 'dedup_key'").fetchone()
+            key_changed = stored is not None and stored[0] != key_definition
+            self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('dedup_key', ?)", (key_definition,))
+            condition = "" if key_changed else " WHERE dedup_key IS NULL"
+            rows = self._conn.execute(f"SELECT id, {', '.join(self._dedup.key)} FROM records{condition}").fetchall()
+            if not rows:
+                return
+            seen = DedupIndex(self._dedup.key)
+            if not key_changed:
+                seen.update(row[0] for row in self._conn.execute(
+                    "SELECT dedup_key FROM records WHERE dedup_key IS NOT NULL"))
+            updates, duplicates = [], []
+            for row in sorted(rows):
+                digest = seen.digest_values(dict(zip(self._dedup.key, row[1:])))
+                if seen.add_digest(digest):
+                    updates.append((digest, row[0]))
+                else:
+                    duplicates.append((row[0],))
+            self._conn.executemany("UPDATE records SET dedup_key = ? WHERE id = ?", updates)
+            self._conn.executemany("DELETE FROM records WHERE id = ?", duplicates)
+        logger.info(f"Индекс дубликатов перестроен: ключей {len(updates)}, удалено повторов {len(duplicates)}")
+    
+    def load_dedup_index(self) -> DedupIndex:
+        """Индекс дубликатов по сохраненным записям (дайджесты читаются готовыми)"""
+        index = DedupIndex(self._dedup.key)
+        with self._lock:
+            index.update(row[0] for row in self._conn.execute("SELECT dedup_key FROM records"))
+        return index
+    
+    @timed('checkpoint')
+    def append(self, entries: List[tuple], statuses: Optional[List[tuple]] = None) -> int:
+        """Атомарно дописывает пары (msg_id, запись) с дайджестом ключа дубликатов
+        и статусы (msg_id, status, error)"""
+        statuses = statuses or []
+        if not entries and not statuses:
+            return 0
+        now = datetime.now().isoformat()
+        placeholders = ", ".join("?" for _ in self.COLUMNS)
+        rows = [(msg_id,) + tuple(getattr(r, name) for name in self.COLUMNS) + (self._dedup.digest(r),)
+                for msg_id, r in entries]
+        status_rows = [(msg_id, 'done', '', now) for msg_id, _ in entries]
+        status_rows += [(msg_id, status, error, now) for msg_id, status, error in statuses]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"INSERT INTO records (msg_id, {', '.join(self.COLUMNS)}, dedup_key) VALUES (?, {placeholders}, ?)", rows
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO processed (msg_id, status, error, updated_at) VALUES (?, ?, ?, ?)",
+                status_rows
+            )
+            self._upsert_contacts(entries, now)
+        return len(rows)
+    
+    def _upsert_contacts(self, entries: List[tuple], now: str):
+        """Учет новых записей в контактах (внутри транзакции контрольной точки). Каждое письмо
+        учитывается один раз: повторная выгрузка того же периода счетчики не увеличивает"""
+        contacts = {}
+        for msg_id, record in entries:
+            key = contact_key(record, self.contact_inn)
+            if not key[0]:
+                continue
+            if not self._conn.execute("INSERT OR IGNORE INTO contact_messages (msg_id) VALUES (?)", (msg_id,)).rowcount:
+                continue
+            if key not in contacts:
+                row = self._conn.execute(
+                    f"SELECT {', '.join(CONTACT_COLUMNS)} FROM contacts WHERE email = ? AND inn_key = ?", key
+                ).fetchone()
+                contacts[key] = dict(zip(CONTACT_COLUMNS, row)) if row else None
+            contacts[key] = merge_contact(contacts[key], record, key)
+        if not contacts:
+            return
+        updated = ", ".join(f"{name} = excluded.{name}" for name in CONTACT_COLUMNS[1:])
+        self._conn.executemany(
+            f"INSERT INTO contacts (inn_key, {', '.join(CONTACT_COLUMNS)}, updated_at) "
+            f"VALUES (?, {', '.join('?' for _ in CONTACT_COLUMNS)}, ?) "
+            f"ON CONFLICT (email, inn_key) DO UPDATE SET {updated}, updated_at = excluded.updated_at",
+            [(key[1],) + tuple(contact[name] for name in CONTACT_COLUMNS) + (now,) for key, contact in contacts.items()]
+        )
+    
+    def contact_count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM contacts").fetchone()[0]
+    
+    def iter_contact_rows(self, chunk_size: int = EXPORT_READ_CHUNK) -> Iterator[tuple]:
+        """Контакты кортежами в порядке CONTACT_COLUMNS, по адресу, порциями по chunk_size строк"""
+        last_key = ("", "")
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT email, inn_key, {', '.join(CONTACT_COLUMNS)} FROM contacts "
+                    "WHERE (email, inn_key) > (?, ?) ORDER BY email, inn_key LIMIT ?",
+                    last_key + (chunk_size,)
+                ).fetchall()
+            if not rows:
+                return
+            last_key = rows[-1][:2]
+            for row in rows:
+                yield row[2:]
+    
+    def load_processed_ids(self) -> set:
+        """ID, которые не нужно обрабатывать повторно (письма с ошибками повторяются)"""
+        with self._lock:
+            rows = self._conn.execute("SELECT msg_id FROM processed WHERE status IN ('done', 'skipped', 'duplicate')").fetchall()
+        return {row[0] for row in rows}
+    
+    def load_failed_ids(self) -> List[str]:
+        """ID писем, которые прошлые запуски не смогли обработать"""
+        with self._lock:
+            rows = self._conn.execute("SELECT msg_id FROM processed WHERE status = 'failed' ORDER BY updated_at").fetchall()
+        return [row[0] for row in rows]
+    
+    def status_counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM processed GROUP BY status").fetchall())
+    
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+    
+    def load_shards(self) -> List[tuple]:
+        """План выгрузки по периодам: (start_ts, end_ts, estimate, status) в порядке дат"""
+        with self._lock:
+            return self._conn.execute("SELECT start_ts, end_ts, estimate, status FROM shards ORDER BY start_ts").fetchall()
+    
+    def save_shard_plan(self, shards: List[tuple]):
+        """Новый план (start_ts, end_ts, estimate) вместо прежнего; пустые окна сразу завершены"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM shards")
+            self._conn.executemany(
+                "INSERT INTO shards (start_ts, end_ts, estimate, status) VALUES (?, ?, ?, ?)",
+                [(start, end, estimate, 'done' if estimate == 0 else 'pending') for start, end, estimate in shards]
+            )
+    
+    def mark_shard_done(self, start_ts: int, end_ts: int):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE shards SET status = 'done' WHERE start_ts = ? AND end_ts = ?", (start_ts, end_ts))
+    
+    def _row_to_record(self, row) -> EmailData:
+        record = EmailData(**dict(zip(self.COLUMNS, row)))
+        record.has_attachments = _as_bool(record.has_attachments)
+        return record
+    
+    def load_records(self) -> List[EmailData]:
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM records ORDER BY id").fetchall()
+        return [self._row_to_record(row) for row in rows]
+    
+    def iter_rows(self, chunk_size: int = EXPORT_READ_CHUNK) -> Iterator[tuple]:
+        """Записи кортежами полей в порядке добавления, порциями по chunk_size строк.
+        Блокировка берется на время чтения порции, запись в хранилище между порциями не ждет"""
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT id, {', '.join(self.COLUMNS)} FROM records WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, chunk_size)
+                ).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            for row in rows:
+                yield row[1:]
+    
+    def to_dataframe(self) -> "pd.DataFrame":
+        import pandas as pd
+        with self._lock:
+            df = pd.read_sql_query(f"SELECT {', '.join(self.COLUMNS)} FROM records ORDER BY id", self._conn)
+        df['has_attachments'] = df['has_attachments'].isin(['1', 'True'])
+        return df
+    
+    def write_xlsx(self, path: str) -> int:
+        """Потоковая запись всех записей (и листа контактов) в Excel-файл path. Возвращает число строк записей"""
+        return write_records_xlsx(path, self.iter_rows(), contacts=self.iter_contact_rows())
+    
+    def export_xlsx(self, path: str) -> int:
+        """Построение Excel-файла по запросу (через временный файл). Возвращает число строк"""
+        temp_path = path[:-len(".xlsx")] + ".tmp.xlsx" if path.endswith(".xlsx") else path + ".tmp"
+        count = self.write_xlsx(temp_path)
+        os.replace(temp_path, path)
+        return count
+    
+    def clear(self):
+        """Сброс состояния после успешной выгрузки (контакты и письма с ошибками сохраняются:
+        последние повторяются при следующем запуске)"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM records")
+            self._conn.execute("DELETE FROM processed WHERE status != 'failed'")
+            self._conn.execute("DELETE FROM shards")
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class RecordSpool:
+    """Записи текущего запуска с ограниченным расходом памяти.
+    
+    Запись хранится кортежем полей, текст письма (основная часть объема) - отдельно от
+    остальных полей. Когда оценка занятой памяти превышает бюджет, старшая половина записей
+    переносится во временную базу SQLite (тексты - в отдельную таблицу). Итерация отдает
+    записи в порядке добавления: сначала выгруженные на диск, затем оставшиеся в памяти.
+    """
+    TEXT_INDEX = RECORD_COLUMNS.index('text')
+    
+    def __init__(self, budget_bytes: int = RECORD_MEMORY_BUDGET):
+        self.budget_bytes = budget_bytes
+        self._rows = []  # Поля без текста
+        self._texts = []  # Тексты, параллельно _rows
+        self._sizes = []  # Оценка памяти каждой записи
+        self._memory_bytes = 0
+        self._spilled = 0
+        self._path = None
+        self._conn = None
+    
+    def __len__(self) -> int:
+        return self._spilled + len(self._rows)
+    
+    @staticmethod
+    def _estimate_size(row: tuple, text: str) -> int:
+        return sys.getsizeof(row) + sys.getsizeof(text) + sum(sys.getsizeof(value) for value in row)
+    
+    def append(self, record: EmailData):
+        values = tuple(getattr(record, name) for name in RECORD_COLUMNS)
+        row = values[:self.TEXT_INDEX] + values[self.TEXT_INDEX + 1:]
+        text = values[self.TEXT_INDEX]
+        size = self._estimate_size(row, text)
+        self._rows.append(row)
+        self._texts.append(text)
+        self._sizes.append(size)
+        self._memory_bytes += size
+        if self._memory_bytes > self.budget_bytes:
+            self._spill(max(1, len(self._rows) // 2))
+    
+    def extend(self, records: List[EmailData]):
+        for record in records:
+            self.append(record)
+    
+    def _open_spill(self):
+        fd, self._path = tempfile.mkstemp(prefix="gmail_spool_", suffix=".db")
+        os.close(fd)
+        self._conn = sqlite3.connect(self._path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        columns = ", ".join(f"c{i}" for i in range(len(RECORD_COLUMNS) - 1))
+        self._conn.execute(f"CREATE TABLE rows (seq INTEGER PRIMARY KEY, {columns})")
+        self._conn.execute("CREATE TABLE texts (seq INTEGER PRIMARY KEY, text TEXT)")
+    
+    def _spill(self, count: int):
+        """Перенос count старших записей из памяти во временную базу"""
+        if self._conn is None:
+            self._open_spill()
+        start = self._spilled
+        placeholders = ", ".join("?" for _ in range(len(RECORD_COLUMNS)))
+        with self._conn:
+            self._conn.executemany(
+                f"INSERT INTO rows VALUES ({placeholders})",
+                [(start + i,) + row for i, row in enumerate(self._rows[:count])]
+            )
+            self._conn.executemany(
+                "INSERT INTO texts VALUES (?, ?)",
+                [(start + i, text) for i, text in enumerate(self._texts[:count])]
+            )
+        self._memory_bytes -= sum(self._sizes[:count])
+        del self._rows[:count], self._texts[:count], self._sizes[:count]
+        self._spilled += count
+        logger.info(f"Записи выгружены на диск: {count}, всего на диске {self._spilled}, "
+                    f"в памяти {len(self._rows)} ({self._memory_bytes // 1024} КБ)")
+    
+    def _join(self, row: tuple, text: str) -> tuple:
+        return row[:self.TEXT_INDEX] + (text,) + row[self.TEXT_INDEX:]
+    
+    def iter_rows(self, chunk_size: int = EXPORT_READ_CHUNK) -> Iterator[tuple]:
+        """Кортежи полей в порядке RECORD_COLUMNS"""
+        for start in range(0, self._spilled, chunk_size):
+            chunk = self._conn.execute(
+                "SELECT rows.*, texts.text FROM rows JOIN texts USING (seq) "
+                "WHERE seq >= ? AND seq < ? ORDER BY seq", (start, start + chunk_size)
+            ).fetchall()
+            for values in chunk:
+                yield self._join(values[1:-1], values[-1])
+        for row, text in zip(self._rows, self._texts):
+            yield self._join(row, text)
+    
+    def __iter__(self) -> Iterator[EmailData]:
+        flag_index = RECORD_COLUMNS.index('has_attachments')
+        for values in self.iter_rows():
+            record = EmailData(*values)
+            record.has_attachments = _as_bool(values[flag_index])
+            yield record
+    
+    def get_stats(self) -> Dict[str, int]:
+        return {'records': len(self), 'in_memory': len(self._rows), 'spilled': self._spilled,
+                'memory_bytes': self._memory_bytes}
+    
+    def close(self):
+        """Удаление временной базы"""
+        self._rows, self._texts, self._sizes = [], [], []
+        self._memory_bytes = 0
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            try:
+                os.remove(self._path)
+            except OSError as e:
+                logger.warning(f"Не удалось удалить временный файл записей {self._path}: {e}")
+
+def load_state(store: ExportStore) -> tuple:
+    """Обработанные ID и число записей, сохраненных прошлым незавершенным запуском"""
+    try:
+        return store.load_processed_ids(), store.count()
+    except Exception as e:
+        logger.error(f"State load error: {e}")
+        return set(), 0
+
+def load_sync_checkpoint() -> Optional[str]:
+    """Последний сохраненный historyId почтового ящика"""
+    if not os.path.exists(SYNC_STATE_FILE):
+        return None
+    try:
+        with open(SYNC_STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f).get("history_id")
+    except Exception as e:
+        logger.error(f"Sync checkpoint load error: {e}")
+        return None
+
+def save_sync_checkpoint(history_id: str):
+    try:
+        temp_state = SYNC_STATE_FILE + ".tmp"
+        with open(temp_state, 'w', encoding='utf-8') as f:
+            json.dump({"history_id": history_id, "last_sync": datetime.now().isoformat()}, f)
+        os.replace(temp_state, SYNC_STATE_FILE)
+        logger.info(f"Контрольная точка синхронизации сохранена: historyId={history_id}")
+    except Exception as e:
+        logger.error(f"Sync checkpoint save error: {e}")
+
+def shard_query(start_ts: int, end_ts: int) -> str:
+    """Запрос Gmail для окна [start_ts, end_ts). Границы перекрываются на секунду:
+    письмо на границе попадет в оба окна, дубликат отсеивается при слиянии"""
+    return f"after:{start_ts - 1} before:{end_ts}"
+
+# ================= ARCHIVE =================
+class MessageArchive:
+    """Локальный архив выгруженных писем с поиском за миллисекунды.
+    
+    Поля письма лежат в таблице messages с B-tree индексами по дате, адресу и ИНН,
+    телефоны - по одному в message_phones. Тема, текст и текст вложений проиндексированы
+    FTS5 (внешнее содержимое - сами строки messages, текст не дублируется).
+    Письмо добавляется один раз: архив пополняется от выгрузки к выгрузке.
+    """
+    FIELDS = ['msg_id', 'sent_at', 'date', 'from_email', 'subject', 'phone', 'inn', 'fio', 'website',
+              'company', 'address', 'has_attachments', 'body', 'attachments', 'processed_at']
+    RESULT_FIELDS = ['msg_id', 'date', 'from_email', 'subject', 'phone', 'inn', 'fio', 'company', 'address']
+    
+    def __init__(self, path: str = ARCHIVE_DB_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, msg_id TEXT NOT NULL UNIQUE, "
+                    "sent_at TEXT, date TEXT, from_email TEXT, subject TEXT, phone TEXT, inn TEXT, fio TEXT, "
+                    "website TEXT, company TEXT, address TEXT, has_attachments INTEGER, body TEXT, "
+                    "attachments TEXT, processed_at TEXT)"
+                )
+                self._conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_sent_at ON messages(sent_at)")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_from ON messages(from_email, sent_at)")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_inn ON messages(inn)")
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS message_phones (phone TEXT NOT NULL, message_id INTEGER NOT NULL, "
+                    "PRIMARY KEY (phone, message_id)) WITHOUT ROWID"
+                )
+                self._conn.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+                    "subject, body, attachments, content='messages', content_rowid='id')"
+                )
+        except sqlite3.OperationalError as e:
+            self._conn.close()
+            raise RuntimeError(f"SQLite {sqlite3.sqlite_version} без поддержки FTS5: {e}") from e
+    
+    @timed('archive')
+    def add(self, entries: List[tuple]) -> int:
+        """Добавление пар (msg_id, запись) одной транзакцией; уже архивированные письма пропускаются"""
+        added = 0
+        with self._lock, self._conn:
+            for msg_id, record in entries:
+                body, _, attachments = (record.text or "").partition(ATTACHMENT_MARKER)
+                values = {name: getattr(record, name) for name in RECORD_COLUMNS if name in self.FIELDS}
+                values.update(msg_id=msg_id, sent_at=sortable_date(record.date), body=body.strip(),
+                              attachments=attachments.strip(), has_attachments=int(bool(record.has_attachments)))
+                cursor = self._conn.execute(
+                    f"INSERT OR IGNORE INTO messages ({', '.join(self.FIELDS)}) "
+                    f"VALUES ({', '.join('?' for _ in self.FIELDS)})",
+                    [values[name] for name in self.FIELDS]
+                )
+                if not cursor.rowcount:
+                    continue
+                row_id = cursor.lastrowid
+                self._conn.execute(
+                    "INSERT INTO messages_fts (rowid, subject, body, attachments) VALUES (?, ?, ?, ?)",
+                    (row_id, values['subject'], values['body'], values['attachments'])
+                )
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO message_phones (phone, message_id) VALUES (?, ?)",
+                    [(phone.strip(), row_id) for phone in (record.phone or "").split(",") if phone.strip()]
+                )
+                added += 1
+        return added
+    
+    @staticmethod
+    def fts_query(text: str) -> str:
+        """Запрос FTS5 из слов пользователя: каждое слово - фраза в кавычках (спецсимволы не ломают
+        синтаксис), слово со звездочкой на конце ищется по префиксу. Слова объединяются по И"""
+        terms = []
+        for word in text.split():
+            prefix = word.endswith("*")
+            word = word.rstrip("*")
+            if word:
+                terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+        return " ".join(terms)
+    
+    def search(self, text: Optional[str] = None, phone: Optional[str] = None, inn: Optional[str] = None,
+               email: Optional[str] = None, start_date: Optional[datetime] = None,
+               end_date: Optional[datetime] = None, limit: int = ARCHIVE_SEARCH_LIMIT) -> List[Dict[str, Any]]:
+        """Поиск писем: условия объединяются по И. text - по теме, тексту и вложениям
+        (результаты по релевантности, с фрагментом), остальные - точные совпадения по индексам
+        (результаты от новых к старым). end_date включительно"""
+        columns = ", ".join(f"m.{name}" for name in self.RESULT_FIELDS)
+        conditions, params = [], []
+        query_text = self.fts_query(text) if text else ""
+        if query_text:
+            sql = (f"SELECT {columns}, snippet(messages_fts, -1, '[', ']', '…', 12) FROM messages_fts "
+                   "JOIN messages m ON m.id = messages_fts.rowid")
+            conditions.append("messages_fts MATCH ?")
+            params.append(query_text)
+            order = "messages_fts.rank"
+        else:
+            sql = f"SELECT {columns}, '' FROM messages m"
+            order = "m.sent_at DESC"
+        if phone:
+            conditions.append("m.id IN (SELECT message_id FROM message_phones WHERE phone = ?)")
+            params.append(normalize_phone(phone) or phone.strip())
+        if inn:
+            conditions.append("m.inn = ?")
+            params.append(inn.strip())
+        if email:
+            conditions.append("m.from_email = ?")
+            params.append(email.strip().lower())
+        if start_date:
+            conditions.append("m.sent_at >= ?")
+            params.append(start_date.strftime("%Y-%m-%d"))
+        if end_date:
+            conditions.append("m.sent_at < ?")
+            params.append((end_date + timedelta(days=1)).strftime("%Y-%m-%d"))
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY {order} LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [dict(zip(self.RESULT_FIELDS + ['snippet'], row)) for row in rows]
+    
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# ================= EXPORT ENGINE =================
+_PIPELINE_DONE = object()  # Маркер конца потока в очередях конвейера
+
+def _fetch_failure_item(msg_id: str, error: Exception) -> tuple:
+    """Элемент конвейера для письма, которое не удалось загрузить. Удаленное письмо - пропущенное,
+    а не ошибка: иначе оно повторялось бы вечно и не давало сдвинуть контрольную точку"""
+    if is_message_gone(error):
+        return (msg_id, None, 'skipped', "[Письмо удалено - пропущено]")
+    return (msg_id, None, 'failed', "[Ошибка загрузки - пропущено]")
 
-# ================= EXPORT ENGINE =================
 class ExportEngine:
-    def __init__(self, gui_queue: queue.Queue, skip_replies: bool = False, skip_text: bool = False):
+    def __init__(self, gui_queue: queue.Queue, skip_replies: bool = False, skip_text: bool = False,
+                 batch_fetch: bool = BATCH_FETCH, incremental: bool = False, streaming: bool = STREAMING_PIPELINE,
+                 metadata_first: bool = METADATA_FIRST, fetch_format: str = FETCH_FORMAT,
+                 thread_fetch: bool = THREAD_FETCH, output_file: str = OUTPUT_FILE,
+                 sharded: bool = SHARDED_EXPORT, token_file: str = TOKEN_FILE,
+                 credentials_file: str = CREDENTIALS_FILE, archive: bool = ARCHIVE_ENABLED,
+                 message_cache: bool = MESSAGE_CACHE_ENABLED, metrics_enabled: bool = METRICS_ENABLED):
         self.gui_queue = gui_queue
         self.state = ThreadSafeState()
         self.service = None
         self._stop_event = threading.Event()
         self.skip_replies = skip_replies
         self.skip_text = skip_text
+        self.batch_fetch = batch_fetch
+        self.incremental = incremental
+        self._listing_complete = False
+        self.streaming = streaming
+        self.fetch_format = fetch_format
+        self.output_file = output_file
+        self.token_file = token_file
+        self.credentials_file = credentials_file
+        # История изменений (инкрементальный режим) не делится по датам
+        self.sharded = sharded and not incremental
+        # threads.get не поддерживает format='raw'
+        self.thread_fetch = thread_fetch and fetch_format != 'raw'
+        # Двухфазная загрузка имеет смысл только при пропуске ответов. Цепочка приходит
+        # целиком одним запросом, поэтому при загрузке цепочками фильтр по заголовкам не нужен
+        self.metadata_first = metadata_first and skip_replies and not self.thread_fetch
+        self._thread_of: Dict[str, str] = {}
+        self.creds = None
+        self.services: Optional[ServicePool] = None
+        self.store: Optional[ExportStore] = None
+        self.archive_enabled = archive
+        self.archive: Optional[MessageArchive] = None
+        self.message_cache_enabled = message_cache
+        self.message_cache: Optional[MessageCache] = None
+        self.metrics_enabled = metrics_enabled
+        self._last_metrics = 0.0
         
     def stop(self):
         self._stop_event.set()
@@ -725,9 +2872,44 @@ class ExportEngine:
                 'current_from': current_from,
                 'speed': self._calculate_speed(processed)
             })
+            self._send_metrics()
         except:
             pass
     
+    def _collect_metric_gauges(self):
+        """Показатели счетчиков, которые ведутся отдельно: трафик, ограничитель, кэши"""
+        metrics.set_gauges('transfer', transfer_meter.get_stats())
+        metrics.set_gauges('rate_limiter', rate_limiter.get_stats())
+        # Кэш вложений открывается при первом вложении - без вложений его не создаем
+        if _attachment_cache is not None:
+            metrics.set_gauges('attachment_cache', _attachment_cache.get_stats())
+        if self.message_cache is not None:
+            metrics.set_gauges('message_cache', self.message_cache.get_stats())
+    
+    def _send_metrics(self, force: bool = False):
+        """Сводка метрик в окно программы - не чаще METRICS_GUI_INTERVAL"""
+        if not metrics.enabled:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_metrics < METRICS_GUI_INTERVAL:
+            return
+        self._last_metrics = now
+        self._collect_metric_gauges()
+        self.gui_queue.put({'type': 'metrics', 'summary': metrics.summary()})
+    
+    def _write_metrics_report(self):
+        """Отчет по стадиям в конце запуска: JSON и файл для Prometheus"""
+        if not metrics.enabled:
+            return
+        try:
+            self._send_metrics(force=True)
+            metrics.write_report(METRICS_REPORT_FILE, METRICS_PROM_FILE)
+            logger.info(f"Метрики выгрузки: {os.path.abspath(METRICS_REPORT_FILE)}, {os.path.abspath(METRICS_PROM_FILE)}")
+            self.gui_queue.put({'type': 'status', 'message': f"Отчет по стадиям: {os.path.abspath(METRICS_REPORT_FILE)}"})
+        except Exception as e:
+            # Отчет - дополнение к выгрузке: его сбой не должен ее портить
+            logger.error(f"Ошибка записи отчета метрик: {e}")
+    
     def _calculate_speed(self, processed: int) -> float:
         if not hasattr(self, '_start_time'):
             self._start_time = time.time()
@@ -740,60 +2922,206 @@ class ExportEngine:
         if start_date:
             query_parts.append(f"after:{start_date.strftime('%Y/%m/%d')}")
         if end_date:
-            next_day = end_date + pd.Timedelta(days=1)
+            next_day = end_date + timedelta(days=1)
             query_parts.append(f"before:{next_day.strftime('%Y/%m/%d')}")
             
         return " ".join(query_parts)
     
-    def fetch_message_ids(self, query: str) -> List[str]:
-        all_ids = []
+    def iter_message_id_pages(self, query: str, service=None) -> Generator[List[str], None, bool]:
+        """Постраничное получение ID писем (messages.list, до 500 на страницу).
+        Возвращает True, если получен весь список (не прерван остановкой или SSL ошибкой)"""
+        service = service or self.service
+        listed = 0
         next_page = None
         
         while not self._stop_event.is_set():
             try:
                 result = safe_api_call(
-                    self.service.users().messages().list,
+                    service.users().messages().list,
                     userId='me', 
                     q=query,
                     maxResults=500,
-                    pageToken=next_page
+                    pageToken=next_page,
+                    **field_mask('list')
                 )
                 
                 if result is None:
                     logger.error("Не удалось получить список писем из-за SSL ошибки")
-                    break
+                    return False
                 
-                messages = result.get('messages', [])
-                all_ids.extend([m['id'] for m in messages])
+                page_ids = []
+                for message in result.get('messages', []):
+                    page_ids.append(message['id'])
+                    if message.get('threadId'):
+                        self._thread_of[message['id']] = message['threadId']
+                listed += len(page_ids)
                 
                 self.gui_queue.put({
                     'type': 'status',
-                    'message': f"Загружено ID: {len(all_ids)}"
+                    'message': f"Загружено ID: {listed}"
                 })
                 
+                yield page_ids
+                
                 next_page = result.get('nextPageToken')
                 if not next_page:
-                    break
-                
-                # Добавляем небольшую задержку между запросами страниц для снижения нагрузки
-                time.sleep(API_DELAY)
+                    return True
                     
             except Exception as e:
                 logger.error(f"Fetch error: {e}")
                 raise
-                
+        return False
+    
+    def fetch_message_ids(self, query: str) -> List[str]:
+        all_ids = []
+        for page_ids in self.iter_message_id_pages(query):
+            all_ids.extend(page_ids)
+        return all_ids
+    
+    def iter_id_pages(self, query: str, service=None) -> Iterator[List[str]]:
+        """Страницы ID для обработки: новые письма по historyId (инкрементальный режим) или полный список.
+        Список получен целиком - self._listing_complete"""
+        self._listing_complete = False
+        if self.incremental:
+            checkpoint = load_sync_checkpoint()
+            if checkpoint:
+                self.gui_queue.put({'type': 'status', 'message': f'Инкрементальная синхронизация с historyId {checkpoint}...'})
+                history_ids = self.fetch_history_message_ids(checkpoint, service=service)
+                if history_ids is not None:
+                    # Остановка прерывает получение истории на середине
+                    complete = not self._stop_event.is_set()
+                    # Письма с ошибками прошлых запусков в истории уже не появятся - повторяем их явно
+                    seen = set(history_ids)
+                    retry_ids = [msg_id for msg_id in self.store.load_failed_ids() if msg_id not in seen]
+                    if retry_ids:
+                        logger.info(f"Повтор писем с ошибками прошлых запусков: {len(retry_ids)}")
+                    yield history_ids + retry_ids
+                    self._listing_complete = complete
+                    return
+                self.gui_queue.put({'type': 'status', 'message': 'Контрольная точка устарела, полная выгрузка списка писем'})
+            else:
+                self.gui_queue.put({'type': 'status', 'message': 'Контрольной точки нет, полная выгрузка списка писем'})
+        self._listing_complete = yield from self.iter_message_id_pages(query, service=service)
+    
+    def get_history_id(self) -> Optional[str]:
+        """Текущий historyId почтового ящика (контрольная точка для следующего запуска)"""
+        try:
+            profile = safe_api_call(self.service.users().getProfile, userId='me', quota_units=1,
+                                    **field_mask('profile'))
+            return profile.get('historyId') if profile else None
+        except Exception as e:
+            logger.warning(f"Не удалось получить historyId: {e}")
+            return None
+    
+    def fetch_history_message_ids(self, start_history_id: str, service=None) -> Optional[List[str]]:
+        """ID писем, добавленных после start_history_id (history.list).
+        
+        Возвращает None, если контрольная точка устарела и нужен полный список.
+        Фильтр по датам к истории не применяется: берутся все новые письма.
+        """
+        service = service or self.service
+        all_ids = []
+        seen = set()
+        next_page = None
+        
+        while not self._stop_event.is_set():
+            try:
+                result = safe_api_call(
+                    service.users().history().list,
+                    userId='me',
+                    startHistoryId=start_history_id,
+                    historyTypes=['messageAdded'],
+                    maxResults=500,
+                    pageToken=next_page,
+                    quota_units=2,
+                    **field_mask('history')
+                )
+            except HttpError as e:
+                if e.resp.status == 404:
+                    logger.warning(f"Контрольная точка historyId={start_history_id} устарела")
+                    return None
+                raise
+            
+            if result is None:
+                logger.error("Не удалось получить историю изменений из-за SSL ошибки")
+                return None
+            
+            for record in result.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    message = added.get('message', {})
+                    msg_id = message.get('id')
+                    labels = set(message.get('labelIds', []))
+                    # messages.list по умолчанию не возвращает спам, корзину и черновики
+                    if not msg_id or msg_id in seen or labels & {'SPAM', 'TRASH', 'DRAFT'}:
+                        continue
+                    seen.add(msg_id)
+                    all_ids.append(msg_id)
+                    if message.get('threadId'):
+                        self._thread_of[msg_id] = message['threadId']
+            
+            self.gui_queue.put({
+                'type': 'status',
+                'message': f"Новых писем в истории: {len(all_ids)}"
+            })
+            
+            next_page = result.get('nextPageToken')
+            if not next_page:
+                break
+        
         return all_ids
     
+    def _fetch_messages(self, service, msg_ids: List[str]) -> tuple:
+        """Полная загрузка писем в выбранном режиме: цепочками, batch-запросами или по одному"""
+        if self.thread_fetch:
+            return fetch_messages_by_thread(service, msg_ids, self._thread_of, self.fetch_format, self.batch_fetch)
+        return fetch_messages(service, msg_ids, self.fetch_format, self.batch_fetch)
+    
+    def _process_leased(self, msg_id: str, msg: Optional[Dict]) -> Optional[EmailData]:
+        """process_message в рабочем потоке: со своим сервисом из пула"""
+        with self.services.lease() as service:
+            return process_message(service, msg_id, self.state, self.skip_replies, self.skip_text,
+                                   msg, self.fetch_format, self.services, self.message_cache)
+    
     def process_batch(self, batch_ids: List[str], batch_start_index: int = 0, total_count: int = 0) -> List[EmailData]:
         results = []
         batch_start_time = time.time()
         BATCH_TIMEOUT = 600  # 10 минут на батч
         
-        logger.info(f"Обработка батча из {len(batch_ids)} писем (skip_replies={self.skip_replies}, skip_text={self.skip_text})")
+        logger.info(f"Обработка батча из {len(batch_ids)} писем (skip_replies={self.skip_replies}, skip_text={self.skip_text}, batch_fetch={self.batch_fetch}, format={self.fetch_format})")
+        
+        # В batch-режиме и при загрузке цепочками письма батча загружаются заранее, несколькими запросами
+        prefetched: Dict[str, Dict] = {}
+        completed_count = 0
+        if self.metadata_first and not self._stop_event.is_set():
+            batch_ids, reply_ids = split_replies(self.service, batch_ids, self.batch_fetch)
+            for msg_id in reply_ids:
+                self.state.mark_status(msg_id, 'skipped')
+                completed_count += 1
+                self.log_progress(
+                    processed=batch_start_index + completed_count,
+                    total=total_count,
+                    current_id=msg_id,
+                    current_subject="[Ответ - пропущено]",
+                    current_from=""
+                )
+        if (self.batch_fetch or self.thread_fetch) and not self._stop_event.is_set():
+            prefetched, fetch_errors = self._fetch_messages(self.service, batch_ids)
+            for msg_id, error in fetch_errors.items():
+                logger.error(f"Ошибка загрузки письма {msg_id}: {error}")
+                gone = is_message_gone(error)
+                self.state.mark_status(msg_id, 'skipped' if gone else 'failed', str(error))
+                completed_count += 1
+                self.log_progress(
+                    processed=batch_start_index + completed_count,
+                    total=total_count,
+                    current_id=msg_id,
+                    current_subject="[Письмо удалено - пропущено]" if gone else "[Ошибка загрузки - пропущено]",
+                    current_from=""
+                )
+            batch_ids = [mid for mid in batch_ids if mid in prefetched]
         
         # Если MAX_WORKERS = 1, обрабатываем последовательно для снижения нагрузки
         if MAX_WORKERS == 1:
-            completed_count = 0
             for msg_id in batch_ids:
                 if time.time() - batch_start_time > BATCH_TIMEOUT:
                     logger.warning(f"Таймаут батча ({BATCH_TIMEOUT} сек), прерываем обработку")
@@ -804,7 +3132,9 @@ class ExportEngine:
                     break
                 
                 try:
-                    result = process_message(self.service, msg_id, self.state, self.skip_replies, self.skip_text)
+                    result = process_message(self.service, msg_id, self.state, self.skip_replies, self.skip_text,
+                                             msg=prefetched.get(msg_id), msg_format=self.fetch_format,
+                                             services=self.services, message_cache=self.message_cache)
                     if result and self.state.add_processed(msg_id, result):
                         results.append(result)
                         completed_count += 1
@@ -823,6 +3153,7 @@ class ExportEngine:
                 except Exception as e:
                     error_str = str(e)
                     logger.error(f"Ошибка обработки письма {msg_id}: {error_str}")
+                    self.state.mark_status(msg_id, 'failed', error_str)
                     completed_count += 1
                     current_index = batch_start_index + completed_count
                     self.log_progress(
@@ -836,11 +3167,10 @@ class ExportEngine:
             # Параллельная обработка для MAX_WORKERS > 1
             with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
                 future_to_id = {
-                    executor.submit(process_message, self.service, mid, self.state, self.skip_replies, self.skip_text): mid 
+                    executor.submit(self._process_leased, mid, prefetched.get(mid)): mid
                     for mid in batch_ids
                 }
                 
-                completed_count = 0
                 for future in as_completed(future_to_id):
                     if time.time() - batch_start_time > BATCH_TIMEOUT:
                         logger.warning(f"Таймаут батча ({BATCH_TIMEOUT} сек), прерываем обработку")
@@ -873,6 +3203,7 @@ class ExportEngine:
                             
                     except TimeoutError:
                         logger.error(f"Таймаут при обработке письма {msg_id}")
+                        self.state.mark_status(msg_id, 'failed', "timeout")
                         completed_count += 1
                         current_index = batch_start_index + completed_count
                         self.log_progress(
@@ -885,6 +3216,7 @@ class ExportEngine:
                     except Exception as e:
                         error_str = str(e)
                         logger.error(f"Ошибка обработки письма {msg_id}: {error_str}")
+                        self.state.mark_status(msg_id, 'failed', error_str)
                         completed_count += 1
                         current_index = batch_start_index + completed_count
                         self.log_progress(
@@ -899,7 +3231,453 @@ class ExportEngine:
         logger.info(f"Батч завершен: обработано {completed_count}/{len(batch_ids)} писем, получено {len(results)} результатов")
         return results
     
+    def _can_advance_checkpoint(self) -> bool:
+        """Следующий инкрементальный запуск начнет историю с новой контрольной точки, поэтому она
+        сдвигается, только если список писем получен целиком и ни одно письмо не осталось с ошибкой.
+        Иначе остается прежняя: недополученные письма попадут в список при следующем запуске"""
+        if self._stop_event.is_set() or not self._listing_complete:
+            logger.warning("Контрольная точка синхронизации не сдвинута: список писем получен не полностью")
+            return False
+        failed = self.store.status_counts().get('failed', 0)
+        if failed:
+            logger.warning(f"Контрольная точка синхронизации не сдвинута: писем с ошибками {failed}")
+            self.gui_queue.put({
+                'type': 'status',
+                'message': f'Писем с ошибками: {failed} - они будут повторены при следующей выгрузке'
+            })
+            return False
+        return True
+    
+    def _report_no_messages(self, new_history_id: Optional[str]):
+        if not self._listing_complete and not self._stop_event.is_set():
+            self.gui_queue.put({'type': 'error', 'message': 'Не удалось получить список писем'})
+            return
+        if self.incremental:
+            if new_history_id and self._can_advance_checkpoint():
+                save_sync_checkpoint(new_history_id)
+            # Не ошибка: ящик уже синхронизирован
+            self.gui_queue.put({'type': 'complete', 'count': 0, 'file': '', 'message': 'Новых писем не найдено'})
+            return
+        self.gui_queue.put({'type': 'error', 'message': 'Писем не найдено'})
+    
+    def _write_initial_file(self, existing_count: int):
+        """Финальный файл из данных прошлого запуска, чтобы он был доступен с самого начала"""
+        if not existing_count:
+            return
+        try:
+            logger.info(f"Создание начального файла из существующих данных: {existing_count} записей")
+            init_file = self.output_file
+            count = self.store.export_xlsx(init_file)
+            logger.info(f"Начальный файл создан: {os.path.abspath(init_file)}")
+            self.gui_queue.put({
+                'type': 'status',
+                'message': f'Начальный файл создан: {count} записей'
+            })
+        except Exception as init_err:
+            logger.warning(f"Не удалось создать начальный файл: {init_err}")
+    
+    def _save_interrupted(self):
+        try:
+            self._flush_records()
+            stored_count = self.store.count()
+            if not stored_count:
+                return
+            logger.info(f"Сохранение данных перед прерыванием: {stored_count} записей")
+            interrupted_file = "gmail_export_interrupted.xlsx"
+            self.store.export_xlsx(interrupted_file)
+            abs_path = os.path.abspath(interrupted_file)
+            logger.info(f"Создан файл после прерывания: {abs_path}")
+            self.gui_queue.put({
+                'type': 'status',
+                'message': f'Создан файл после прерывания: {abs_path}'
+            })
+        except Exception as save_err:
+            logger.error(f"Ошибка сохранения при прерывании: {save_err}")
+    
+    def _flush_records(self) -> int:
+        """Контрольная точка: новые записи и статусы писем одной транзакцией; записи - и в архив"""
+        entries, statuses = self.state.get_and_clear_buffer()
+        appended = self.store.append(entries, statuses)
+        if self.archive is not None and entries:
+            try:
+                self.archive.add(entries)
+            except sqlite3.Error as e:
+                # Архив - дополнение к выгрузке: его сбой не должен ее останавливать
+                logger.error(f"Ошибка записи в архив {self.archive.path}: {e}")
+        return appended
+    
+    def _save_batch_progress(self, processed_count: int):
+        """Сохранение очередной порции результатов в хранилище состояния"""
+        logger.info(f"Ограничитель скорости: {rate_limiter.get_stats()}")
+        try:
+            appended = self._flush_records()
+            if appended:
+                logger.info(f"✓ В хранилище добавлено {appended} записей, обработано {processed_count}")
+                self.gui_queue.put({'type': 'autosave', 'count': processed_count})
+        except Exception as save_err:
+            logger.error(f"Ошибка автосохранения: {save_err}")
+    
+    # ----- Потоковый конвейер -----
+    def _run_pipeline(self, query: str, processed_ids: set, all_data: RecordSpool) -> int:
+        """Потоковая обработка: стадии связаны ограниченными очередями с обратным давлением.
+        
+        список ID -> загрузка и разбор писем -> вложения -> извлечение данных -> запись.
+        Запись выполняется в текущем потоке. Возвращает число найденных писем.
+        """
+        chunk_size = FETCH_BATCH_SIZE if self.batch_fetch else BATCH_SIZE
+        id_queue = queue.Queue(maxsize=max(1, PIPELINE_QUEUE_SIZE // chunk_size))
+        parsed_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        extract_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        write_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        
+        self._listed_total = 0
+        self._already_processed = 0
+        self._pipeline_error = None
+        
+        # httplib2 не потокобезопасен: у каждой сетевой стадии свой клиент
+        stages = [
+            threading.Thread(target=self._stage_list, args=(query, processed_ids, chunk_size, id_queue,
+                                                            create_gmail_service(self.creds)),
+                             name="pipeline-list", daemon=True),
+            threading.Thread(target=self._stage_fetch, args=(id_queue, parsed_queue, self.service),
+                             name="pipeline-fetch", daemon=True),
+            threading.Thread(target=self._stage_attachments, args=(parsed_queue, extract_queue,
+                                                                   create_gmail_service(self.creds)),
+                             name="pipeline-attachments", daemon=True),
+            threading.Thread(target=self._stage_extract, args=(extract_queue, write_queue),
+                             name="pipeline-extract", daemon=True),
+        ]
+        for stage in stages:
+            stage.start()
+        
+        self._stage_write(write_queue, all_data, chunk_size)
+        
+        for stage in stages:
+            stage.join(timeout=5)
+        
+        self._raise_pipeline_error()
+        if self._stop_event.is_set():
+            logger.warning("Процесс прерван пользователем")
+            self._save_interrupted()
+        return self._listed_total
+    
+    def _raise_pipeline_error(self):
+        """Сбой стадии конвейера - сбой всей выгрузки: иначе неполный список писем
+        выглядел бы как успешная выгрузка (итоговый файл, очистка состояния, контрольная точка)"""
+        if self._pipeline_error is not None:
+            raise self._pipeline_error
+    
+    def _stage_list(self, query: str, processed_ids: set, chunk_size: int, out_queue: queue.Queue, service):
+        try:
+            for page_ids in self.iter_id_pages(query, service=service):
+                self._listed_total += len(page_ids)
+                remaining = [mid for mid in page_ids if mid not in processed_ids]
+                self._already_processed += len(page_ids) - len(remaining)
+                if self.thread_fetch:
+                    remaining = group_by_thread(remaining, self._thread_of)
+                for start in range(0, len(remaining), chunk_size):
+                    if self._stop_event.is_set():
+                        return
+                    out_queue.put(remaining[start:start + chunk_size])
+        except Exception as e:
+            logger.error(f"Ошибка стадии получения списка: {e}", exc_info=True)
+            self.gui_queue.put({'type': 'status', 'message': f'Ошибка получения списка писем: {e}'})
+            self._pipeline_error = e
+        finally:
+            out_queue.put(_PIPELINE_DONE)
+    
+    def _fetch_items(self, service, chunk: List[str]) -> Iterator[tuple]:
+        """Загрузка и разбор порции писем: элементы (msg_id, parsed, status, note) в порядке chunk"""
+        reply_ids = set()
+        try:
+            fetch_ids = chunk
+            if self.metadata_first:
+                fetch_ids, replies = split_replies(service, chunk, self.batch_fetch)
+                reply_ids = set(replies)
+            messages, errors = self._fetch_messages(service, fetch_ids)
+            if self.message_cache is not None:
+                self.message_cache.put_messages(list(messages.items()))
+        except Exception as e:
+            messages, errors = {}, {msg_id: e for msg_id in chunk}
+        
+        for msg_id in chunk:
+            if msg_id in reply_ids:
+                yield (msg_id, None, 'skipped', "[Ответ - пропущено]")
+                continue
+            if msg_id in errors:
+                logger.error(f"Ошибка загрузки письма {msg_id}: {errors[msg_id]}")
+                yield _fetch_failure_item(msg_id, errors[msg_id])
+                continue
+            try:
+                parsed = parse_message(messages[msg_id], msg_id, self.skip_replies)
+                if parsed is None:
+                    yield (msg_id, None, 'skipped', "[Ответ - пропущено]")
+                else:
+                    yield (msg_id, parsed, '', "")
+            except Exception as e:
+                logger.error(f"Message processing error {msg_id}: {e}")
+                yield (msg_id, None, 'failed', "[Ошибка - пропущено]")
+    
+    def _attach_item(self, item: tuple, service) -> tuple:
+        msg_id, parsed, status, note = item
+        if parsed is not None and not self.skip_text:
+            try:
+                if not process_attachments(service, parsed, self.state, self.services, self.message_cache):
+                    return (msg_id, None, 'interrupted', "[Остановлено - будет обработано при продолжении]")
+            except Exception as e:
+                logger.error(f"Attachment processing error {msg_id}: {e}")
+        return item
+    
+    def _extract_item(self, item: tuple) -> tuple:
+        msg_id, parsed, status, note = item
+        if parsed is None:
+            return item
+        try:
+            return (msg_id, build_email_data(parsed, self.skip_text), '', "")
+        except Exception as e:
+            logger.error(f"Message processing error {msg_id}: {e}")
+            return (msg_id, None, 'failed', "[Ошибка - пропущено]")
+    
+    def _stage_fetch(self, in_queue: queue.Queue, out_queue: queue.Queue, service):
+        while True:
+            chunk = in_queue.get()
+            if chunk is _PIPELINE_DONE:
+                out_queue.put(_PIPELINE_DONE)
+                return
+            if self._stop_event.is_set():
+                continue
+            for item in self._fetch_items(service, chunk):
+                out_queue.put(item)
+    
+    def _stage_attachments(self, in_queue: queue.Queue, out_queue: queue.Queue, service):
+        while True:
+            item = in_queue.get()
+            if item is _PIPELINE_DONE:
+                out_queue.put(_PIPELINE_DONE)
+                return
+            if self._stop_event.is_set():
+                continue
+            out_queue.put(self._attach_item(item, service))
+    
+    def _stage_extract(self, in_queue: queue.Queue, out_queue: queue.Queue):
+        while True:
+            item = in_queue.get()
+            if item is _PIPELINE_DONE:
+                out_queue.put(_PIPELINE_DONE)
+                return
+            out_queue.put(self._extract_item(item))
+    
+    def _stage_write(self, in_queue: queue.Queue, all_data: RecordSpool, flush_every: int):
+        handled = 0
+        while True:
+            item = in_queue.get()
+            if item is _PIPELINE_DONE:
+                break
+            if callable(item):
+                # Действие после записи всех предыдущих элементов (завершение шарда)
+                item()
+                continue
+            # После остановки сюда доходят только уже обработанные письма - их сохраняем
+            msg_id, data, status, note = item
+            handled += 1
+            total = self._listed_total
+            processed = self._already_processed + handled
+            
+            # Прерванное остановкой письмо не получает статуса и обрабатывается при продолжении
+            if data is None and status != 'interrupted':
+                self.state.mark_status(msg_id, status, note)
+            if data is not None and self.state.add_processed(msg_id, data):
+                all_data.append(data)
+                subject_preview = data.subject[:50] + "..." if len(data.subject) > 50 else data.subject
+                from_preview = data.from_email[:30] + "..." if len(data.from_email) > 30 else data.from_email
+                self.log_progress(
+                    processed=processed,
+                    total=total,
+                    current_id=msg_id,
+                    current_subject=subject_preview,
+                    current_from=from_preview
+                )
+            else:
+                self.log_progress(processed=processed, total=total, current_id=msg_id,
+                                  current_subject=note, current_from="")
+            
+            if handled % flush_every == 0:
+                self._save_batch_progress(processed)
+        
+        self._save_batch_progress(self._already_processed + handled)
+    
+    # ----- Выгрузка по периодам (шарды) -----
+    def _shard_bounds(self, start_date: Optional[datetime], end_date: Optional[datetime]) -> tuple:
+        """Диапазон выгрузки в секундах Unix: [начало первого дня, конец последнего дня)"""
+        start = datetime.combine(start_date, datetime.min.time()) if start_date else SHARD_EARLIEST_DATE
+        # Без конечной даты - до конца сегодняшнего дня, чтобы план шардов совпадал при продолжении в тот же день
+        last_day = end_date or datetime.now()
+        end = datetime.combine(last_day, datetime.min.time()) + timedelta(days=1)
+        return int(start.timestamp()), int(end.timestamp())
+    
+    def estimate_messages(self, query: str, service) -> int:
+        """Оценка числа писем по запросу (resultSizeEstimate); 0 - писем точно нет"""
+        result = safe_api_call(service.users().messages().list, userId='me', q=query, maxResults=1,
+                               **field_mask('estimate'))
+        if result is None:
+            # Оценка неизвестна: окно остается целым
+            return SHARD_TARGET_SIZE
+        if not result.get('messages'):
+            return 0
+        return max(1, result.get('resultSizeEstimate', 0))
+    
+    def plan_shards(self, start_ts: int, end_ts: int, service) -> List[tuple]:
+        """Адаптивное деление диапазона по плотности писем: окно, где по оценке больше
+        SHARD_TARGET_SIZE писем, делится пополам. Возвращает [(start_ts, end_ts, estimate)],
+        окна покрывают весь диапазон (пустые - с оценкой 0)"""
+        planned = []
+        pending = [(start_ts, end_ts, self.estimate_messages(shard_query(start_ts, end_ts), service))]
+        while pending:
+            start, end, estimate = pending.pop()
+            splittable = (estimate > SHARD_TARGET_SIZE and end - start > SHARD_MIN_SPAN
+                          and len(planned) + len(pending) + 2 <= SHARD_MAX_COUNT)
+            if not splittable or self._stop_event.is_set():
+                planned.append((start, end, estimate))
+                continue
+            middle = (start + end) // 2
+            for window in ((start, middle), (middle, end)):
+                pending.append(window + (self.estimate_messages(shard_query(*window), service),))
+        return sorted(planned)
+    
+    def _run_sharded(self, start_date: Optional[datetime], end_date: Optional[datetime],
+                     processed_ids: set, all_data: RecordSpool) -> int:
+        """Выгрузка по периодам: шарды (окна дат) получают свой список ID и обрабатываются
+        в SHARD_WORKERS потоках под общим ограничителем скорости; запись - в текущем потоке.
+        Письма на границах окон отсеиваются при слиянии, завершенные шарды при продолжении
+        пропускаются. Возвращает число найденных писем."""
+        start_ts, end_ts = self._shard_bounds(start_date, end_date)
+        shards = self.store.load_shards()
+        if shards and shards[0][0] == start_ts and max(shard[1] for shard in shards) == end_ts:
+            logger.info("Продолжение выгрузки по сохраненному плану шардов")
+        else:
+            self.gui_queue.put({'type': 'status', 'message': 'Планирование шардов по плотности писем...'})
+            self.store.save_shard_plan(self.plan_shards(start_ts, end_ts, self.service))
+            shards = self.store.load_shards()
+        
+        # Крупные шарды первыми - потоки заканчивают примерно одновременно
+        pending = sorted(((start, end, estimate) for start, end, estimate, status in shards if status != 'done'),
+                         key=lambda shard: -shard[2])
+        finished_estimate = sum(shard[2] for shard in shards if shard[3] == 'done')
+        self.gui_queue.put({
+            'type': 'status',
+            'message': f'Шардов: {len(shards)}, к выгрузке: {len(pending)}, оценка писем: {sum(s[2] for s in shards)}'
+        })
+        logger.info(f"План шардов: {len(shards)}, к выгрузке {len(pending)}")
+        
+        self._listed_total = 0
+        self._already_processed = 0
+        self._count_lock = threading.Lock()
+        self._claimed: set = set()
+        shard_queue = queue.Queue()
+        for shard in pending:
+            shard_queue.put(shard)
+        write_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        
+        workers = [
+            threading.Thread(target=self._shard_worker, args=(shard_queue, processed_ids, write_queue),
+                             name=f"shard-{i + 1}", daemon=True)
+            for i in range(min(SHARD_WORKERS, len(pending)))
+        ]
+        for worker in workers:
+            worker.start()
+        
+        def close_when_done():
+            for worker in workers:
+                worker.join()
+            write_queue.put(_PIPELINE_DONE)
+        
+        threading.Thread(target=close_when_done, name="shard-merge", daemon=True).start()
+        self._stage_write(write_queue, all_data, FETCH_BATCH_SIZE if self.batch_fetch else BATCH_SIZE)
+        # Список писем получен целиком, когда выгружены все шарды
+        unfinished = [shard for shard in self.store.load_shards() if shard[3] != 'done']
+        self._listing_complete = not unfinished
+        
+        if self._stop_event.is_set():
+            logger.warning("Процесс прерван пользователем")
+            self._save_interrupted()
+        elif unfinished:
+            # Выгрузка неполная: состояние и план шардов остаются, следующий запуск продолжит их
+            raise RuntimeError(f"Не выгружено шардов: {len(unfinished)} из {len(shards)}, "
+                               f"запустите выгрузку повторно для продолжения")
+        return self._listed_total + finished_estimate
+    
+    def _shard_worker(self, shard_queue: queue.Queue, processed_ids: set, out_queue: queue.Queue):
+        try:
+            with self.services.lease() as service:
+                while not self._stop_event.is_set():
+                    try:
+                        shard = shard_queue.get_nowait()
+                    except queue.Empty:
+                        return
+                    self._export_shard(shard, processed_ids, out_queue, service)
+        except Exception as e:
+            logger.error(f"Ошибка потока шардов: {e}", exc_info=True)
+    
+    def _export_shard(self, shard: tuple, processed_ids: set, out_queue: queue.Queue, service):
+        start_ts, end_ts, estimate = shard
+        label = f"{datetime.fromtimestamp(start_ts):%Y-%m-%d %H:%M} - {datetime.fromtimestamp(end_ts):%Y-%m-%d %H:%M}"
+        logger.info(f"Шард {label}: оценка {estimate} писем")
+        chunk_size = FETCH_BATCH_SIZE if self.batch_fetch else BATCH_SIZE
+        failed = 0
+        pages = self.iter_message_id_pages(shard_query(start_ts, end_ts), service=service)
+        
+        try:
+            while True:
+                try:
+                    page_ids = next(pages)
+                except StopIteration as done:
+                    listed = done.value
+                    break
+                # Слияние с дедупликацией: письмо обрабатывает тот шард, который получил его первым
+                with self._count_lock:
+                    new_ids = [mid for mid in page_ids if mid not in self._claimed]
+                    self._claimed.update(new_ids)
+                    remaining = [mid for mid in new_ids if mid not in processed_ids]
+                    self._listed_total += len(new_ids)
+                    self._already_processed += len(new_ids) - len(remaining)
+                if self.thread_fetch:
+                    remaining = group_by_thread(remaining, self._thread_of)
+                
+                for start in range(0, len(remaining), chunk_size):
+                    if self._stop_event.is_set():
+                        return
+                    for item in self._fetch_items(service, remaining[start:start + chunk_size]):
+                        item = self._extract_item(self._attach_item(item, service))
+                        if item[2] == 'failed':
+                            failed += 1
+                        out_queue.put(item)
+        except Exception as e:
+            logger.error(f"Ошибка шарда {label}: {e}", exc_info=True)
+            self.gui_queue.put({'type': 'status', 'message': f'Ошибка шарда {label}: {e}'})
+            return
+        
+        if self._stop_event.is_set():
+            return
+        if not listed:
+            # Список писем шарда получен не целиком - шард будет выгружен повторно при продолжении
+            logger.warning(f"Шард {label}: список писем получен не полностью")
+            return
+        if failed:
+            # Шард все равно завершен: письма с ошибками остаются со статусом 'failed'
+            # и повторяются следующей выгрузкой, а не держат шард незавершенным
+            logger.warning(f"Шард {label}: писем с ошибками {failed}")
+        out_queue.put(lambda: self._complete_shard(start_ts, end_ts))
+        logger.info(f"Шард {label} выгружен")
+    
+    def _complete_shard(self, start_ts: int, end_ts: int):
+        """Шард отмечается завершенным только после записи его писем в хранилище"""
+        self._flush_records()
+        self.store.mark_shard_done(start_ts, end_ts)
+    
     def run(self, start_date: Optional[datetime], end_date: Optional[datetime]):
+        transfer_meter.reset()
+        metrics.reset(self.metrics_enabled)
+        all_data = None
         try:
             current_dir = os.getcwd()
             test_file = os.path.join(current_dir, ".write_test")
@@ -915,197 +3693,164 @@ class ExportEngine:
                 return
             
             self.gui_queue.put({'type': 'status', 'message': 'Аутентификация...'})
-            creds = authenticate()
+            creds = authenticate(self.token_file, self.credentials_file)
+            self.creds = creds
             
             self.service = create_gmail_service(creds)
+            self.services = ServicePool(creds)
             
-            processed_ids, existing_data = load_state()
+            self.store = ExportStore()
+            if self.archive_enabled:
+                self.archive = MessageArchive()
+            if self.message_cache_enabled:
+                self.message_cache = MessageCache()
+            processed_ids, existing_count = load_state(self.store)
+            self.state.restore_processed(processed_ids, self.store.load_dedup_index())
+            if processed_ids:
+                logger.info(f"Продолжение выгрузки: статусы писем {self.store.status_counts()}")
             
             query = self.build_query(start_date, end_date)
             self.gui_queue.put({'type': 'status', 'message': f'Query: {query}'})
+            if self.incremental and (start_date or end_date) and load_sync_checkpoint():
+                # История изменений не фильтруется по датам: берутся все письма после контрольной точки
+                logger.warning("Инкрементальный режим: выбранный диапазон дат не применяется")
+                self.gui_queue.put({
+                    'type': 'status',
+                    'message': 'Инкрементальный режим: выгружаются все новые письма, диапазон дат не применяется'
+                })
             
-            all_ids = self.fetch_message_ids(query)
-            total = len(all_ids)
-            
-            if total == 0:
-                self.gui_queue.put({'type': 'error', 'message': 'Писем не найдено'})
-                return
-            
-            remaining_ids = [mid for mid in all_ids if mid not in processed_ids]
-            self.gui_queue.put({
-                'type': 'status', 
-                'message': f'Всего писем: {total}, осталось обработать: {len(remaining_ids)}'
-            })
-            
-            if total > 0:
-                self.log_progress(
-                    processed=len(processed_ids),
-                    total=total,
-                    current_id="",
-                    current_subject="Подготовка к обработке...",
-                    current_from=""
-                )
-            
-            all_data = existing_data.copy()
-            logger.info(f"Начало обработки. Существующих данных: {len(existing_data)}, ID для обработки: {len(remaining_ids)}")
-            
-            if existing_data:
-                try:
-                    logger.info(f"Создание начального файла из существующих данных: {len(existing_data)} записей")
-                    df_init = pd.DataFrame([d.to_dict() for d in existing_data])
-                    df_init = df_init.drop_duplicates(subset=['date', 'from_email', 'subject'])
-                    init_file = "gmail_export_final.xlsx"
-                    temp_init = "gmail_export_final.tmp.xlsx"
-                    df_init.to_excel(temp_init, index=False, engine='openpyxl')
-                    if os.path.exists(temp_init):
-                        os.replace(temp_init, init_file)
-                        abs_path = os.path.abspath(init_file)
-                        logger.info(f"Начальный файл создан: {abs_path}")
-                        self.gui_queue.put({
-                            'type': 'status',
-                            'message': f'Начальный файл создан: {len(df_init)} записей'
-                        })
-                except Exception as init_err:
-                    logger.warning(f"Не удалось создать начальный файл: {init_err}")
+            # Контрольную точку берем до получения списка, чтобы не потерять письма, пришедшие во время выгрузки
+            new_history_id = self.get_history_id()
+            # Записи текущего запуска (прошлые - в хранилище); сверх бюджета памяти - на диске
+            all_data = RecordSpool()
             
-            for i in range(0, len(remaining_ids), BATCH_SIZE):
-                if self._stop_event.is_set():
-                    logger.warning("Процесс прерван пользователем")
-                    if all_data:
-                        logger.info(f"Сохранение данных перед прерыванием: {len(all_data)} записей")
-                        try:
-                            save_state(all_data, self.state._processed_ids)
-                            df = pd.DataFrame([d.to_dict() for d in all_data])
-                            df = df.drop_duplicates(subset=['date', 'from_email', 'subject'])
-                            interrupted_file = "gmail_export_interrupted.xlsx"
-                            temp_interrupted = "gmail_export_interrupted.tmp.xlsx"
-                            df.to_excel(temp_interrupted, index=False, engine='openpyxl')
-                            if os.path.exists(temp_interrupted):
-                                os.replace(temp_interrupted, interrupted_file)
-                                abs_path = os.path.abspath(interrupted_file)
-                                logger.info(f"Создан файл после прерывания: {abs_path}")
-                                self.gui_queue.put({
-                                    'type': 'status',
-                                    'message': f'Создан файл после прерывания: {abs_path}'
-                                })
-                        except Exception as save_err:
-                            logger.error(f"Ошибка сохранения при прерывании: {save_err}")
-                    break
-                    
-                batch = remaining_ids[i:i+BATCH_SIZE]
-                batch_num = i // BATCH_SIZE + 1
-                total_batches = (len(remaining_ids) + BATCH_SIZE - 1) // BATCH_SIZE
-                logger.info(f"Обработка батча {batch_num}/{total_batches}: {len(batch)} сообщений")
+            if self.sharded:
+                self._write_initial_file(existing_count)
+                total = self._run_sharded(start_date, end_date, processed_ids, all_data)
+                if total == 0:
+                    self._report_no_messages(new_history_id)
+                    return
+            elif self.streaming:
+                self._write_initial_file(existing_count)
+                total = self._run_pipeline(query, processed_ids, all_data)
+                if total == 0:
+                    self._report_no_messages(new_history_id)
+                    return
+            else:
+                all_ids = []
+                for page_ids in self.iter_id_pages(query):
+                    all_ids.extend(page_ids)
+                total = len(all_ids)
                 
+                if total == 0:
+                    self._report_no_messages(new_history_id)
+                    return
+                
+                remaining_ids = [mid for mid in all_ids if mid not in processed_ids]
+                if self.thread_fetch:
+                    remaining_ids = group_by_thread(remaining_ids, self._thread_of)
                 self.gui_queue.put({
-                    'type': 'status',
-                    'message': f'Обработка батча {batch_num}/{total_batches}...'
+                    'type': 'status', 
+                    'message': f'Всего писем: {total}, осталось обработать: {len(remaining_ids)}'
                 })
                 
-                batch_start_index = len(processed_ids) + i
-                batch_start_time = time.time()
-                try:
-                    logger.info(f"Начало обработки батча {batch_num}, таймаут: 600 секунд")
-                    batch_results = self.process_batch(batch, batch_start_index=batch_start_index, total_count=total)
-                    batch_duration = time.time() - batch_start_time
-                    logger.info(f"Батч {batch_num} обработан за {batch_duration:.1f} сек: получено {len(batch_results)} результатов")
-                    all_data.extend(batch_results)
-                    
-                    # Добавляем задержку между батчами для снижения нагрузки на API
-                    if batch_num < total_batches:
-                        logger.info(f"Пауза {BATCH_DELAY} сек перед следующим батчем...")
-                        time.sleep(BATCH_DELAY)
-                    
-                    processed_count = len(processed_ids) + i + len(batch_results)
-                    
-                    if all_data:
-                        if processed_count % AUTOSAVE_EVERY == 0:
-                            logger.info(f"Автосохранение на {processed_count} записях")
-                            try:
-                                save_state(all_data, self.state._processed_ids)
-                                self.gui_queue.put({'type': 'autosave', 'count': processed_count})
-                            except Exception as save_err:
-                                logger.error(f"Ошибка автосохранения: {save_err}")
+                if total > 0:
+                    self.log_progress(
+                        processed=len(processed_ids),
+                        total=total,
+                        current_id="",
+                        current_subject="Подготовка к обработке...",
+                        current_from=""
+                    )
+                
+                logger.info(f"Начало обработки. Существующих данных: {existing_count}, ID для обработки: {len(remaining_ids)}")
+                self._write_initial_file(existing_count)
+                
+                # В batch-режиме один батч обработки = один multipart-запрос к API
+                batch_size = FETCH_BATCH_SIZE if self.batch_fetch else BATCH_SIZE
+                for i in range(0, len(remaining_ids), batch_size):
+                    if self._stop_event.is_set():
+                        logger.warning("Процесс прерван пользователем")
+                        self._save_interrupted()
+                        break
                         
-                        try:
-                            df_interim = pd.DataFrame([d.to_dict() for d in all_data])
-                            df_interim = df_interim.drop_duplicates(subset=['date', 'from_email', 'subject'])
-                            interim_file = "gmail_export_interim.xlsx"
-                            temp_interim = "gmail_export_interim.tmp.xlsx"
-                            df_interim.to_excel(temp_interim, index=False, engine='openpyxl')
-                            if os.path.exists(temp_interim):
-                                os.replace(temp_interim, interim_file)
-                                abs_interim = os.path.abspath(interim_file)
-                                logger.info(f"✓ Промежуточный файл обновлен: {abs_interim} ({len(df_interim)} записей)")
-                                final_interim = "gmail_export_final.xlsx"
-                                try:
-                                    os.replace(interim_file, final_interim)
-                                    logger.info(f"✓ Финальный файл обновлен: {os.path.abspath(final_interim)}")
-                                except Exception as final_err:
-                                    logger.warning(f"Не удалось обновить финальный файл: {final_err}")
-                        except Exception as interim_err:
-                            logger.warning(f"Не удалось создать промежуточный файл: {interim_err}")
-                            
-                except Exception as batch_err:
-                    logger.error(f"Ошибка обработки батча {batch_num}: {batch_err}", exc_info=True)
+                    batch = remaining_ids[i:i+batch_size]
+                    batch_num = i // batch_size + 1
+                    total_batches = (len(remaining_ids) + batch_size - 1) // batch_size
+                    logger.info(f"Обработка батча {batch_num}/{total_batches}: {len(batch)} сообщений")
+                    
                     self.gui_queue.put({
                         'type': 'status',
-                        'message': f'Ошибка в батче {batch_num}, продолжаем...'
+                        'message': f'Обработка батча {batch_num}/{total_batches}...'
                     })
-                    if all_data:
+                    
+                    batch_start_index = len(processed_ids) + i
+                    batch_start_time = time.time()
+                    try:
+                        logger.info(f"Начало обработки батча {batch_num}, таймаут: 600 секунд")
+                        batch_results = self.process_batch(batch, batch_start_index=batch_start_index, total_count=total)
+                        batch_duration = time.time() - batch_start_time
+                        logger.info(f"Батч {batch_num} обработан за {batch_duration:.1f} сек: получено {len(batch_results)} результатов")
+                        all_data.extend(batch_results)
+                        
+                        processed_count = len(processed_ids) + i + len(batch_results)
+                        self._save_batch_progress(processed_count)
+                                
+                    except Exception as batch_err:
+                        logger.error(f"Ошибка обработки батча {batch_num}: {batch_err}", exc_info=True)
+                        self.gui_queue.put({
+                            'type': 'status',
+                            'message': f'Ошибка в батче {batch_num}, продолжаем...'
+                        })
                         try:
-                            logger.info(f"Экстренное сохранение после ошибки батча: {len(all_data)} записей")
-                            save_state(all_data, self.state._processed_ids)
+                            logger.info("Экстренное сохранение после ошибки батча")
+                            self._flush_records()
                         except:
                             pass
             
             logger.info(f"Обработка завершена. Всего данных: {len(all_data)}")
             
-            if not all_data:
-                chunk_file = "emails_chunk.xlsx"
-                if os.path.exists(chunk_file):
-                    try:
-                        logger.info(f"Загрузка данных из {chunk_file}...")
-                        df_chunk = pd.read_excel(chunk_file)
-                        all_data = [EmailData(**row) for row in df_chunk.to_dict('records')]
-                        logger.info(f"Загружено из {chunk_file}: {len(all_data)} записей")
-                    except Exception as chunk_err:
-                        logger.error(f"Ошибка загрузки {chunk_file}: {chunk_err}")
-                
-            if not all_data:
-                interim_file = "gmail_export_interim.xlsx"
-                if os.path.exists(interim_file):
-                    logger.info(f"Используем промежуточный файл: {interim_file}")
-                    try:
-                        df_interim = pd.read_excel(interim_file)
-                        all_data = [EmailData(**row) for row in df_interim.to_dict('records')]
-                        logger.info(f"Загружено из промежуточного файла: {len(all_data)} записей")
-                    except Exception as load_err:
-                        logger.error(f"Ошибка загрузки промежуточного файла: {load_err}")
+            cache_stats = get_attachment_cache().get_stats()
+            logger.info(f"Кэш вложений: {cache_stats}")
+            self.gui_queue.put({
+                'type': 'status',
+                'message': f"Кэш вложений: попаданий {cache_stats['hits'] + cache_stats['ref_hits']}, промахов {cache_stats['misses']}"
+            })
+            
+            transfer_stats = transfer_meter.get_stats()
+            logger.info(f"Трафик Gmail API: {transfer_stats}")
+            self.gui_queue.put({
+                'type': 'status',
+                'message': f"Трафик: {transfer_stats['wire_bytes'] // 1024} КБ, "
+                           f"в среднем {transfer_stats['bytes_per_message'] // 1024} КБ на письмо"
+            })
+            
+            try:
+                logger.info("Финальное сохранение состояния...")
+                self._flush_records()
+                logger.info("Состояние сохранено успешно")
+            except Exception as save_err:
+                logger.warning(f"Ошибка финального сохранения состояния: {save_err}")
             
-            logger.info(f"Начало создания финального файла... Всего данных: {len(all_data) if all_data else 0}")
+            # Статусы писем уже в хранилище - по ним решается, можно ли сдвинуть контрольную точку
+            if new_history_id and self._can_advance_checkpoint():
+                save_sync_checkpoint(new_history_id)
             
-            if all_data:
-                try:
-                    logger.info("Финальное сохранение состояния...")
-                    save_state(all_data, self.state._processed_ids)
-                    logger.info("Состояние сохранено успешно")
-                except Exception as save_err:
-                    logger.warning(f"Ошибка финального сохранения состояния: {save_err}")
+            record_count = self.store.count()
+            logger.info(f"Начало создания финального файла... Всего данных: {record_count}")
             
             try:
-                if all_data:
+                if record_count:
                     try:
-                        df = pd.DataFrame([d.to_dict() for d in all_data])
-                        df = df.drop_duplicates(subset=['date', 'from_email', 'subject'])
+                        # Итоговый Excel строится один раз - из промежуточного хранилища
+                        final_file = self.output_file
+                        output_stem = os.path.splitext(final_file)[0]
+                        logger.info(f"Создание финального Excel файла: {final_file} ({record_count} записей в хранилище)")
                         
-                        final_file = "gmail_export_final.xlsx"
-                        logger.info(f"Создание финального Excel файла: {final_file} ({len(df)} записей)")
-                        
-                        temp_final = "gmail_export_final.tmp.xlsx"
+                        temp_final = f"{output_stem}.tmp.xlsx"
                         
                         try:
-                            df.to_excel(temp_final, index=False, engine='openpyxl')
+                            written = self.store.write_xlsx(temp_final)
                         except Exception as create_err:
                             error_msg = f"Ошибка создания временного Excel файла: {create_err}"
                             logger.error(error_msg, exc_info=True)
@@ -1120,7 +3865,7 @@ class ExportEngine:
                                     os.remove(final_file)
                                     logger.info(f"Удален старый финальный файл: {final_file}")
                                 except PermissionError:
-                                    backup_name = f"gmail_export_final_backup_{int(time.time())}.xlsx"
+                                    backup_name = f"{output_stem}_backup_{int(time.time())}.xlsx"
                                     try:
                                         os.rename(final_file, backup_name)
                                         logger.info(f"Старый файл переименован в: {backup_name}")
@@ -1134,14 +3879,14 @@ class ExportEngine:
                             except PermissionError as perm_err:
                                 error_msg = f"Нет доступа к файлу {final_file}. Возможно, файл открыт в Excel или другой программе: {perm_err}"
                                 logger.error(error_msg)
-                                alt_file = f"gmail_export_final_{int(time.time())}.xlsx"
+                                alt_file = f"{output_stem}_{int(time.time())}.xlsx"
                                 try:
                                     os.rename(temp_final, alt_file)
                                     abs_path = os.path.abspath(alt_file)
                                     logger.info(f"Файл сохранен под альтернативным именем: {abs_path}")
                                     self.gui_queue.put({
                                         'type': 'complete',
-                                        'count': len(df),
+                                        'count': written,
                                         'file': abs_path
                                     })
                                     return
@@ -1152,20 +3897,23 @@ class ExportEngine:
                             if os.path.exists(final_file):
                                 logger.info(f"Финальный Excel файл успешно создан: {final_file}")
                                 
-                                for f in [STATE_FILE, "emails_chunk.xlsx"]:
-                                    if os.path.exists(f):
-                                        try:
-                                            os.remove(f)
-                                            logger.info(f"Удален временный файл: {f}")
-                                        except Exception as e:
-                                            logger.warning(f"Не удалось удалить временный файл {f}: {e}")
+                                logger.info(f"Статусы писем: {self.store.status_counts()}")
+                                if self._stop_event.is_set():
+                                    # После остановки состояние нужно для продолжения выгрузки
+                                    logger.info("Выгрузка остановлена, состояние сохранено для продолжения")
+                                else:
+                                    self.store.clear()
                                 
                                 abs_file_path = os.path.abspath(final_file)
-                                logger.info(f"✓ Файл успешно создан: {abs_file_path} ({len(df)} записей)")
+                                logger.info(f"✓ Файл успешно создан: {abs_file_path} ({written} записей)")
+                                self.gui_queue.put({
+                                    'type': 'status',
+                                    'message': f'Контактов в таблице: {self.store.contact_count()}'
+                                })
                                 
                                 self.gui_queue.put({
                                     'type': 'complete',
-                                    'count': len(df),
+                                    'count': written,
                                     'file': abs_file_path
                                 })
                                 logger.info("Процесс экспорта завершен успешно")
@@ -1182,13 +3930,11 @@ class ExportEngine:
                         error_msg = f"Ошибка создания финального Excel файла: {excel_error}"
                         logger.exception(error_msg)
                         self.gui_queue.put({'type': 'error', 'message': error_msg})
-                        if all_data:
+                        if len(all_data):
                             try:
                                 logger.info("Попытка создать файл после ошибки...")
-                                df = pd.DataFrame([d.to_dict() for d in all_data])
-                                df = df.drop_duplicates(subset=['date', 'from_email', 'subject'])
                                 error_file = f"gmail_export_error_{int(time.time())}.xlsx"
-                                df.to_excel(error_file, index=False, engine='openpyxl')
+                                write_records_xlsx(error_file, all_data.iter_rows())
                                 abs_path = os.path.abspath(error_file)
                                 logger.info(f"Файл создан после ошибки: {abs_path}")
                                 self.gui_queue.put({
@@ -1198,37 +3944,9 @@ class ExportEngine:
                             except Exception as fallback_err:
                                 logger.error(f"Не удалось создать файл даже после ошибки: {fallback_err}")
                 else:
-                    if existing_data:
-                        logger.info(f"Используем существующие данные: {len(existing_data)} записей")
-                        try:
-                            df = pd.DataFrame([d.to_dict() for d in existing_data])
-                            df = df.drop_duplicates(subset=['date', 'from_email', 'subject'])
-                            
-                            final_file = "gmail_export_final.xlsx"
-                            temp_final = "gmail_export_final.tmp.xlsx"
-                            df.to_excel(temp_final, index=False, engine='openpyxl')
-                            
-                            if os.path.exists(temp_final):
-                                os.replace(temp_final, final_file)
-                                abs_file_path = os.path.abspath(final_file)
-                                logger.info(f"Файл создан из существующих данных: {abs_file_path}")
-                                self.gui_queue.put({
-                                    'type': 'complete',
-                                    'count': len(df),
-                                    'file': abs_file_path
-                                })
-                            else:
-                                error_msg = "Не удалось создать файл из существующих данных"
-                                logger.error(error_msg)
-                                self.gui_queue.put({'type': 'error', 'message': error_msg})
-                        except Exception as e:
-                            error_msg = f"Ошибка создания файла из существующих данных: {e}"
-                            logger.exception(error_msg)
-                            self.gui_queue.put({'type': 'error', 'message': error_msg})
-                    else:
-                        error_msg = "Нет данных для экспорта"
-                        logger.warning(error_msg)
-                        self.gui_queue.put({'type': 'error', 'message': error_msg})
+                    error_msg = "Нет данных для экспорта"
+                    logger.warning(error_msg)
+                    self.gui_queue.put({'type': 'error', 'message': error_msg})
                         
             except Exception as excel_final_error:
                 error_msg = f"Ошибка создания финального файла: {excel_final_error}"
@@ -1241,51 +3959,691 @@ class ExportEngine:
             self.gui_queue.put({'type': 'error', 'message': error_msg})
             
             try:
-                buffer_data = self.state.get_and_clear_buffer()
+                if self.store is None:
+                    logger.warning("Нет данных для сохранения при ошибке")
+                    return
                 
                 try:
-                    _, existing_data = load_state()
-                    if existing_data:
-                        logger.info(f"Найдены существующие данные: {len(existing_data)} записей")
-                        buffer_data.extend(existing_data)
-                except:
-                    pass
+                    self._flush_records()
+                except Exception as flush_err:
+                    logger.error(f"Не удалось сохранить буфер записей: {flush_err}")
                 
-                if buffer_data:
-                    logger.info(f"Сохранение данных при ошибке: {len(buffer_data)} записей")
-                    
-                    try:
-                        save_state(buffer_data, self.state._processed_ids)
-                    except:
-                        pass
-                    
+                stored_count = self.store.count()
+                if stored_count:
+                    logger.info(f"Сохранение данных при ошибке: {stored_count} записей")
                     try:
-                        df = pd.DataFrame([d.to_dict() for d in buffer_data])
-                        df = df.drop_duplicates(subset=['date', 'from_email', 'subject'])
                         partial_file = "gmail_export_partial.xlsx"
-                        temp_partial = "gmail_export_partial.tmp.xlsx"
-                        df.to_excel(temp_partial, index=False, engine='openpyxl')
-                        
-                        if os.path.exists(temp_partial):
-                            os.replace(temp_partial, partial_file)
-                            abs_path = os.path.abspath(partial_file)
-                            logger.info(f"Создан файл с частичными данными: {abs_path} ({len(df)} записей)")
-                            self.gui_queue.put({
-                                'type': 'status',
-                                'message': f'Создан файл с частичными данными: {abs_path}'
-                            })
-                        else:
-                            logger.error("Не удалось создать файл с частичными данными")
+                        count = self.store.export_xlsx(partial_file)
+                        abs_path = os.path.abspath(partial_file)
+                        logger.info(f"Создан файл с частичными данными: {abs_path} ({count} записей)")
+                        self.gui_queue.put({
+                            'type': 'status',
+                            'message': f'Создан файл с частичными данными: {abs_path}'
+                        })
                     except Exception as excel_err:
                         logger.error(f"Ошибка создания файла с частичными данными: {excel_err}")
                 else:
                     logger.warning("Нет данных для сохранения при ошибке")
             except Exception as save_error:
                 logger.error(f"Ошибка при сохранении данных после сбоя: {save_error}")
+        finally:
+            self._write_metrics_report()
+            if all_data is not None:
+                all_data.close()
+            if self.archive is not None:
+                self.archive.close()
+            if self.message_cache is not None:
+                self.message_cache.close()
+            if self.store is not None:
+                self.store.close()
+
+class AsyncExportEngine(ExportEngine):
+    """Движок выгрузки на asyncio: письма и вложения загружаются через REST Gmail API клиентом httpx.
+    
+    Параллелизм задается семафором (ASYNC_CONCURRENCY писем в работе) и общим ограничителем
+    скорости, соединения - ограниченным пулом (по HTTP/2 запросы мультиплексируются).
+    Сотни запросов в полете обходятся корутинами вместо потоков. Список ID, запись
+    в хранилище и сообщения для GUI - те же, что у потокового конвейера ExportEngine.
+    """
+    
+    def __init__(self, gui_queue: queue.Queue, **kwargs):
+        # Пакетные запросы и threads.get не нужны: отдельные запросы мультиплексируются в соединения.
+        # Параллельность задает семафор, а не шарды
+        kwargs.update(streaming=True, batch_fetch=False, thread_fetch=False, sharded=False)
+        super().__init__(gui_queue, **kwargs)
+        self._token_lock: Optional[asyncio.Lock] = None
+    
+    def _run_pipeline(self, query: str, processed_ids: set, all_data: RecordSpool) -> int:
+        """Список ID - в отдельном потоке (в том числе history.list), загрузка и разбор - в цикле
+        событий отдельного потока, запись - в текущем потоке. Возвращает число найденных писем."""
+        if httpx is None:
+            raise RuntimeError("Для асинхронного движка установите httpx: pip install httpx[http2]")
+        
+        id_queue = queue.Queue(maxsize=max(1, PIPELINE_QUEUE_SIZE // FETCH_BATCH_SIZE))
+        write_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        
+        self._listed_total = 0
+        self._already_processed = 0
+        self._pipeline_error = None
+        
+        stages = [
+            threading.Thread(target=self._stage_list, args=(query, processed_ids, FETCH_BATCH_SIZE, id_queue,
+                                                            create_gmail_service(self.creds)),
+                             name="pipeline-list", daemon=True),
+            threading.Thread(target=self._stage_async, args=(id_queue, write_queue),
+                             name="pipeline-async", daemon=True),
+        ]
+        for stage in stages:
+            stage.start()
+        
+        self._stage_write(write_queue, all_data, BATCH_SIZE)
+        
+        for stage in stages:
+            stage.join(timeout=5)
+        
+        self._raise_pipeline_error()
+        if self._stop_event.is_set():
+            logger.warning("Процесс прерван пользователем")
+            self._save_interrupted()
+        return self._listed_total
+    
+    def _stage_async(self, in_queue: queue.Queue, out_queue: queue.Queue):
+        try:
+            asyncio.run(self._fetch_all(in_queue, out_queue))
+        except Exception as e:
+            logger.error(f"Ошибка асинхронной загрузки: {e}", exc_info=True)
+            self.gui_queue.put({'type': 'status', 'message': f'Ошибка асинхронной загрузки: {e}'})
+            self._pipeline_error = e
+            # Стадия списка не должна зависнуть на заполненной очереди
+            self._stop_event.set()
+            while in_queue.get() is not _PIPELINE_DONE:
+                pass
+        finally:
+            out_queue.put(_PIPELINE_DONE)
+    
+    def _open_client(self):
+        return httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS,
+                                max_keepalive_connections=ASYNC_MAX_CONNECTIONS),
+            # Ожидание свободного соединения ограничено семафором, а не таймаутом пула
+            timeout=httpx.Timeout(60.0, pool=None),
+            verify=ssl_context if _ssl_fallback else True,
+            headers={'User-Agent': HTTP_USER_AGENT, 'Accept-Encoding': 'gzip'},
+        )
+    
+    async def _fetch_all(self, in_queue: queue.Queue, out_queue: queue.Queue):
+        self._token_lock = asyncio.Lock()
+        semaphore = asyncio.Semaphore(ASYNC_CONCURRENCY)
+        tasks = set()
+        
+        async with self._open_client() as client:
+            logger.info(f"Асинхронный движок: HTTP/2 {'включен' if HTTP2_AVAILABLE else 'недоступен (нет пакета h2)'}, "
+                        f"писем в работе до {ASYNC_CONCURRENCY}, соединений до {ASYNC_MAX_CONNECTIONS}")
+            while True:
+                chunk = await asyncio.to_thread(in_queue.get)
+                if chunk is _PIPELINE_DONE:
+                    break
+                for msg_id in chunk:
+                    if self._stop_event.is_set():
+                        break
+                    # Новое письмо берется в работу, только когда освободилось место - очередь ID не выбирается вперед
+                    await semaphore.acquire()
+                    task = asyncio.create_task(self._process_async(client, msg_id, out_queue))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    task.add_done_callback(lambda _: semaphore.release())
+            
+            # После остановки начатые письма дорабатываются и сохраняются
+            if tasks:
+                await asyncio.gather(*tasks)
+    
+    async def _emit(self, out_queue: queue.Queue, item: tuple):
+        try:
+            out_queue.put_nowait(item)
+        except queue.Full:
+            await asyncio.to_thread(out_queue.put, item)
+    
+    async def _process_async(self, client, msg_id: str, out_queue: queue.Queue):
+        try:
+            if self.metadata_first:
+                try:
+                    headers_only = await self._api_get(client, f"messages/{msg_id}", _message_get_params('metadata'))
+                except Exception as e:
+                    # Как в split_replies: письмо без заголовков загружается полностью
+                    logger.warning(f"Не удалось загрузить заголовки письма {msg_id}: {e}")
+                    headers_only = None
+                if headers_only is not None and is_reply_message(message_headers(headers_only)):
+                    await self._emit(out_queue, (msg_id, None, 'skipped', "[Ответ - пропущено]"))
+                    return
+            msg = await self._api_get(client, f"messages/{msg_id}", _message_get_params(self.fetch_format))
+            transfer_meter.count_messages(1)
+            if self.message_cache is not None:
+                await asyncio.to_thread(self.message_cache.put_messages, [(msg_id, msg)])
+        except Exception as e:
+            logger.error(f"Ошибка загрузки письма {msg_id}: {e}")
+            await self._emit(out_queue, _fetch_failure_item(msg_id, e))
+            return
+        
+        try:
+            parsed = parse_message(msg, msg_id, self.skip_replies)
+            if parsed is None:
+                item = (msg_id, None, 'skipped', "[Ответ - пропущено]")
+            else:
+                if not self.skip_text and not await self._process_attachments_async(client, parsed):
+                    item = (msg_id, None, 'interrupted', "[Остановлено - будет обработано при продолжении]")
+                else:
+                    item = (msg_id, build_email_data(parsed, self.skip_text), '', "")
+        except Exception as e:
+            logger.error(f"Message processing error {msg_id}: {e}")
+            item = (msg_id, None, 'failed', "[Ошибка - пропущено]")
+        await self._emit(out_queue, item)
+    
+    async def _process_attachments_async(self, client, parsed: ParsedMessage) -> bool:
+        """Асинхронный аналог process_attachments: вложения письма загружаются одновременно"""
+        if not parsed.attachment_parts:
+            return True
+        if self.state.is_cancelled():
+            return False
+        texts = await asyncio.gather(*(self._attachment_text(client, parsed.msg_id, part)
+                                       for part in parsed.attachment_parts))
+        for att_text in texts:
+            if att_text:
+                parsed.body += f"\n\n{ATTACHMENT_MARKER}\n" + att_text
+        return True
+    
+    async def _attachment_text(self, client, msg_id: str, part: Dict) -> str:
+        att_id = part.get('body', {}).get('attachmentId')
+        needs_download = (part.get('filename') and part.get('content') is None and att_id
+                          and int(part['body'].get('size', 0)) <= MAX_ATTACHMENT_SIZE)
+        part_key = part.get('partId') or att_id
+        if needs_download:
+            # Текст из кэша вложений отдаем сразу, если кэшу писем не нужны сами байты
+            cached_text = await asyncio.to_thread(get_attachment_cache().get_by_ref, msg_id, part_key)
+            if cached_text is not None and (
+                    self.message_cache is None
+                    or await asyncio.to_thread(self.message_cache.has_attachment, msg_id, part_key)):
+                metrics.inc('attachment_cache', result='ref_hit')
+                return cached_text
+            # Иначе загружаем сами и дальше разбираем часть как в raw-режиме: запись в кэше
+            # могла быть вытеснена, поэтому на нее не полагаемся
+            try:
+                attachment = await self._api_get(client, f"messages/{msg_id}/attachments/{att_id}",
+                                                 field_mask('attachment'), stage='attachment_download')
+            except Exception as e:
+                logger.error(f"Attachment error: {e}")
+                return f"[Ошибка вложения: {str(e)}]"
+            part = {**part, 'content': base64.urlsafe_b64decode(attachment['data'])}
+            metrics.inc('attachment_bytes', len(part['content']))
+            if self.message_cache is not None:
+                await asyncio.to_thread(self.message_cache.put_attachment, msg_id, part_key, part['content'])
+        # Кэш и разбор в пуле процессов блокируют - выполняем в потоке, не останавливая цикл событий
+        return await asyncio.to_thread(parse_attachment, None, msg_id, part)
+    
+    async def _refresh_token(self, used_token: Optional[str]):
+        async with self._token_lock:
+            # Токен мог обновить другой запрос, пока этот ждал блокировки
+            if self.creds.token == used_token:
+                logger.info("Обновление токена доступа")
+                await asyncio.to_thread(self.creds.refresh, Request())
+    
+    async def _api_get(self, client, path: str, params: Dict[str, Any], quota_units: int = 5,
+                       stage: str = 'api_call') -> Dict:
+        """GET к Gmail API с повторами - асинхронный аналог safe_api_call"""
+        last_exception = None
+        
+        for attempt in range(RETRY_COUNT):
+            if not self.creds.valid:
+                await self._refresh_token(self.creds.token)
+            token = self.creds.token
+            await rate_limiter.acquire_async(quota_units)
+            try:
+                with metrics.timer(stage):
+                    response = await client.get(f"{GMAIL_API_URL}/{path}", params=params,
+                                                headers={'Authorization': f"Bearer {token}"})
+            except httpx.TransportError as e:
+                logger.warning(f"Сетевая ошибка (attempt {attempt+1}/{RETRY_COUNT}): {e}")
+                metrics.inc('retries', cause='network')
+                last_exception = e
+                metrics.inc('backoff_seconds', 3)
+                await asyncio.sleep(3)
+                continue
+            
+            # num_bytes_downloaded - тело до распаковки gzip
+            transfer_meter.add_wire_bytes(response.num_bytes_downloaded)
+            transfer_meter.add_response(len(response.content), 'content-encoding' in response.headers)
+            
+            try:
+                response.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                last_exception = e
+                if response.status_code == 401:
+                    logger.warning(f"HTTP 401 (attempt {attempt+1}/{RETRY_COUNT}): токен отклонен")
+                    metrics.inc('retries', cause='auth')
+                    await self._refresh_token(token)
+                    continue
+                if _is_throttle_status(response.status_code):
+                    logger.warning(f"HTTP {response.status_code} (attempt {attempt+1}/{RETRY_COUNT})")
+                    metrics.inc('retries', cause=_throttle_cause(response.status_code))
+                    rate_limiter.on_throttle()
+                    continue
+                raise
+            
+            rate_limiter.on_success()
+            return response.json()
+        
+        logger.error(f"Все попытки исчерпаны: {last_exception}")
+        raise last_exception if last_exception else Exception("Неизвестная ошибка API")
+
+# ================= MULTI-ACCOUNT =================
+@dataclass
+class MailboxAccount:
+    name: str
+    token_file: str
+    credentials_file: str
+    state_dir: str  # Абсолютный путь: процесс ящика работает внутри этого каталога
+
+def load_accounts(path: str = ACCOUNTS_FILE) -> List[MailboxAccount]:
+    """Список ящиков из JSON; относительные пути к файлам - от каталога файла списка"""
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    accounts = []
+    for entry in entries:
+        name = entry['name']
+        accounts.append(MailboxAccount(
+            name=name,
+            token_file=os.path.join(base_dir, entry.get('token', f"{name}.pickle")),
+            credentials_file=os.path.join(base_dir, entry.get('credentials', CREDENTIALS_FILE)),
+            state_dir=os.path.abspath(os.path.join(ACCOUNTS_DIR, name)),
+        ))
+    if len({a.name for a in accounts}) != len(accounts):
+        raise ValueError(f"Имена ящиков в {path} должны быть уникальными")
+    return accounts
+
+class QuotaManager(SyncManager):
+    """Процесс-менеджер: общий QuotaScheduler и очередь сообщений процессов ящиков"""
+
+QuotaManager.register('QuotaScheduler', QuotaScheduler)
+
+class _AccountQueue:
+    """Очередь сообщений движка с пометкой ящика"""
+    
+    def __init__(self, target, account: str):
+        self._target = target
+        self._account = account
+    
+    def put(self, msg: Dict[str, Any]):
+        self._target.put({**msg, 'account': self._account})
+
+def _run_account_export(account: MailboxAccount, options: Dict[str, Any], messages, scheduler, stop_event,
+                        start_date: Optional[datetime], end_date: Optional[datetime]):
+    """Процесс одного ящика: свой каталог состояния, свой ограничитель (квота пользователя)
+    и доля квоты проекта из общего планировщика"""
+    os.makedirs(account.state_dir, exist_ok=True)
+    # База выгрузки, контрольная точка и итоговый файл задаются относительными путями
+    os.chdir(account.state_dir)
+    rate_limiter.attach_scheduler(scheduler, account.name)
+    engine = ExportEngine(_AccountQueue(messages, account.name), token_file=account.token_file,
+                          credentials_file=account.credentials_file, **options)
+    
+    def watch_stop():
+        stop_event.wait()
+        engine.stop()
+    
+    threading.Thread(target=watch_stop, name="account-stop", daemon=True).start()
+    try:
+        engine.run(start_date, end_date)
+    finally:
+        shutdown_parse_pool()
+        messages.put({'type': 'account_done', 'account': account.name})
+
+class MultiAccountExport:
+    """Одновременная выгрузка нескольких ящиков: по процессу с ExportEngine на ящик
+    (до ACCOUNT_WORKERS сразу). Квота проекта делится QuotaScheduler, у каждого ящика
+    свои контрольные точки в ACCOUNTS_DIR/<имя>. Результаты сводятся в один файл
+    с колонкой mailbox и общим листом контактов. Сообщения в gui_queue - те же, что у ExportEngine.
+    """
+    
+    def __init__(self, gui_queue: queue.Queue, accounts: List[MailboxAccount],
+                 output_file: str = CONSOLIDATED_OUTPUT_FILE, **options):
+        self.gui_queue = gui_queue
+        self.accounts = accounts
+        self.output_file = output_file
+        self.options = options
+        self._stop_requested = threading.Event()
+        self._start_time = time.time()
+    
+    def stop(self):
+        self._stop_requested.set()
+    
+    def run(self, start_date: Optional[datetime], end_date: Optional[datetime]):
+        try:
+            results = self._run_accounts(start_date, end_date)
+            self._write_consolidated(results)
+        except Exception as e:
+            logger.exception("Multi-account export failed")
+            self.gui_queue.put({'type': 'error', 'message': f"Ошибка выгрузки ящиков: {e}"})
+    
+    def _run_accounts(self, start_date: Optional[datetime], end_date: Optional[datetime]) -> Dict[str, str]:
+        """Запуск процессов ящиков и пересылка их сообщений. Возвращает ящик -> итоговый файл"""
+        context = multiprocessing.get_context(ACCOUNT_PROCESS_START)
+        results: Dict[str, str] = {}
+        progress: Dict[str, tuple] = {}
+        
+        with QuotaManager(ctx=context) as manager:
+            scheduler = manager.QuotaScheduler()
+            messages = manager.Queue()
+            stop_event = manager.Event()
+            pending = list(self.accounts)
+            running: Dict[str, Any] = {}
+            
+            while pending or running:
+                if self._stop_requested.is_set():
+                    stop_event.set()
+                    pending.clear()
+                while pending and len(running) < ACCOUNT_WORKERS:
+                    account = pending.pop(0)
+                    process = context.Process(
+                        target=_run_account_export, name=f"account-{account.name}",
+                        args=(account, self.options, messages, scheduler, stop_event, start_date, end_date)
+                    )
+                    process.start()
+                    running[account.name] = process
+                    self.gui_queue.put({'type': 'status', 'message': f'[{account.name}] Выгрузка запущена'})
+                
+                try:
+                    msg = messages.get(timeout=0.5)
+                except queue.Empty:
+                    # Процесс, завершившийся аварийно, не присылает account_done
+                    for name, process in list(running.items()):
+                        if not process.is_alive():
+                            process.join()
+                            del running[name]
+                            self.gui_queue.put({'type': 'status',
+                                                'message': f'[{name}] Процесс завершился с кодом {process.exitcode}'})
+                    continue
+                self._forward(msg, results, progress, running)
+            
+            logger.info(f"Квота проекта по ящикам: {scheduler.get_stats()}")
+        return results
+    
+    def _forward(self, msg: Dict[str, Any], results: Dict[str, str], progress: Dict[str, tuple],
+                 running: Dict[str, Any]):
+        account = msg.pop('account')
+        if msg['type'] == 'account_done':
+            process = running.pop(account, None)
+            if process is not None:
+                process.join()
+        elif msg['type'] == 'progress':
+            # Общий прогресс - сумма по ящикам
+            progress[account] = (msg['processed'], msg['total'], msg['speed'])
+            subject = msg['current_subject']
+            self.gui_queue.put({
+                **msg,
+                'processed': sum(p[0] for p in progress.values()),
+                'total': sum(p[1] for p in progress.values()),
+                'speed': sum(p[2] for p in progress.values()),
+                'current_subject': f"[{account}] {subject}" if subject else f"[{account}]",
+            })
+        elif msg['type'] == 'complete':
+            if msg['file']:
+                results[account] = msg['file']
+            summary = msg.get('message') or f"Готово: {msg['count']} писем"
+            self.gui_queue.put({'type': 'status', 'message': f"[{account}] {summary}"})
+        elif msg['type'] == 'error':
+            # Ошибка одного ящика не останавливает остальные
+            self.gui_queue.put({'type': 'status', 'message': f"[{account}] Ошибка: {msg['message']}"})
+        elif msg['type'] == 'status':
+            self.gui_queue.put({'type': 'status', 'message': f"[{account}] {msg['message']}"})
+        elif msg['type'] == 'metrics':
+            self.gui_queue.put({**msg, 'summary': f"[{account}] {msg['summary']}"})
+        else:
+            self.gui_queue.put(msg)
+    
+    def _write_consolidated(self, results: Dict[str, str]):
+        """Общий файл: записи всех ящиков с колонкой mailbox; письмо, пришедшее
+        в несколько ящиков, - одна строка с перечнем ящиков. Лист контактов - контакты
+        всех ящиков, объединенные по ключу контакта.
+        
+        Два потоковых прохода по файлам ящиков: первый собирает ящики каждого ключа
+        (по дайджесту DedupIndex) и контакты, второй пишет первую запись ключа.
+        """
+        if not results:
+            self.gui_queue.put({'type': 'error', 'message': 'Нет данных для экспорта'})
+            return
+        from openpyxl import load_workbook
+        
+        dedup = DedupIndex()
+        
+        def account_rows():
+            for account in self.accounts:
+                if account.name not in results:
+                    continue
+                workbook = load_workbook(results[account.name], read_only=True)
+                try:
+                    rows = workbook.active.iter_rows(values_only=True)
+                    header = next(rows, None) or ()
+                    positions = [header.index(name) if name in header else None for name in RECORD_COLUMNS]
+                    for row in rows:
+                        values = tuple(None if i is None else row[i] for i in positions)
+                        yield account.name, dedup.digest_values(dict(zip(RECORD_COLUMNS, values))), values
+                finally:
+                    workbook.close()
+        
+        mailboxes: Dict[bytes, List[str]] = {}
+        for name, digest, _ in account_rows():
+            names = mailboxes.setdefault(digest, [])
+            if name not in names:
+                names.append(name)
+        
+        contacts: Dict[tuple, Dict[str, Any]] = {}
+        for account in self.accounts:
+            if account.name not in results:
+                continue
+            workbook = load_workbook(results[account.name], read_only=True)
+            try:
+                if 'contacts' not in workbook.sheetnames:
+                    continue
+                rows = workbook['contacts'].iter_rows(values_only=True)
+                header = next(rows, None) or ()
+                positions = [header.index(name) if name in header else None for name in CONTACT_COLUMNS]
+                for row in rows:
+                    contact = {name: "" if i is None or row[i] is None else row[i]
+                               for name, i in zip(CONTACT_COLUMNS, positions)}
+                    contact['email'] = str(contact['email']).strip().lower()
+                    if not contact['email']:
+                        continue
+                    contact['inn'] = str(contact['inn'])
+                    contact['message_count'] = int(contact['message_count'] or 0)
+                    key = (contact['email'], contact['inn'] if CONTACT_KEY_INN else "")
+                    contacts[key] = merge_contact_rows(contacts.get(key), contact)
+            finally:
+                workbook.close()
+        
+        def merged_rows():
+            for _, digest, values in account_rows():
+                if dedup.add_digest(digest):
+                    yield (", ".join(mailboxes[digest]),) + values
+        
+        temp_path = os.path.splitext(self.output_file)[0] + ".tmp.xlsx"
+        contact_rows = (tuple(contact[name] for name in CONTACT_COLUMNS) for _, contact in sorted(contacts.items()))
+        count = write_records_xlsx(temp_path, merged_rows(), columns=['mailbox'] + RECORD_COLUMNS, contacts=contact_rows)
+        os.replace(temp_path, self.output_file)
+        abs_path = os.path.abspath(self.output_file)
+        logger.info(f"Общий файл ящиков: {abs_path} ({count} записей из {len(results)} ящиков, "
+                    f"{len(contacts)} контактов)")
+        self.gui_queue.put({'type': 'complete', 'count': count, 'file': abs_path})
+
+# ================= RE-EXTRACT =================
+_reextract_cache: Optional[MessageCache] = None  # Кэш писем рабочего процесса повторного извлечения
+
+def _init_reextract_worker(cache_file: str):
+    global _reextract_cache
+    _reextract_cache = MessageCache(cache_file)
+
+def _cached_attachment_text(cache: MessageCache, msg_id: str, part: Dict) -> str:
+    """Текст вложения из байтов в кэше писем (аналог parse_attachment без API и пула разбора)"""
+    filename = part.get("filename", "").lower()
+    if not filename:
+        return ""
+    if int(part.get('body', {}).get('size', 0)) > MAX_ATTACHMENT_SIZE:
+        return f"[Вложение слишком большое: {filename}]"
+    content = part.get('content')
+    if content is None:
+        content = cache.get_attachment(msg_id, part.get('partId') or part.get('body', {}).get('attachmentId'))
+        if content is None:
+            # Вложение не скачивалось (выгрузка с "не читать текст") или вытеснено
+            return ""
+    try:
+        return extract_attachment_text(filename, content)
+    except Exception as e:
+        logger.error(f"Attachment error: {e}")
+        return f"[Ошибка вложения: {str(e)}]"
+
+def _reextract_chunk(msg_ids: List[str], skip_replies: bool, skip_text: bool,
+                     start: str = "", end: str = "") -> List[tuple]:
+    """Задание рабочего процесса: разбор писем из кэша и извлечение данных.
+    Возвращает (msg_id, запись или None, статус); start/end - границы дат в виде sortable_date"""
+    results = []
+    for msg_id in msg_ids:
+        try:
+            msg = _reextract_cache.get_message(msg_id)
+            if msg is None:
+                results.append((msg_id, None, 'evicted'))
+                continue
+            parsed = parse_message(msg, msg_id, skip_replies)
+            if parsed is None:
+                results.append((msg_id, None, 'skipped'))
+                continue
+            sent_at = sortable_date(parsed.date)
+            if (start and sent_at < start) or (end and sent_at >= end):
+                results.append((msg_id, None, 'out_of_range'))
+                continue
+            if not skip_text:
+                for part in parsed.attachment_parts:
+                    att_text = _cached_attachment_text(_reextract_cache, msg_id, part)
+                    if att_text:
+                        parsed.body += f"\n\n{ATTACHMENT_MARKER}\n" + att_text
+            results.append((msg_id, build_email_data(parsed, skip_text), 'done'))
+        except Exception as e:
+            logger.error(f"Message processing error {msg_id}: {e}")
+            results.append((msg_id, None, 'failed'))
+    return results
+
+class ReextractEngine:
+    """Повторное извлечение данных из кэша писем без обращений к API - после улучшения
+    extract_data или смены "не читать текст". Разбор писем, вложений и извлечение идут
+    в пуле процессов (по ядрам). Результат - Excel-файл с листом контактов по этим письмам.
+    Сообщения в gui_queue - те же, что у ExportEngine.
+    """
+    
+    def __init__(self, gui_queue: queue.Queue, skip_replies: bool = False, skip_text: bool = False,
+                 output_file: str = OUTPUT_FILE, cache_file: str = MESSAGE_CACHE_FILE, workers: int = PARSE_WORKERS):
+        self.gui_queue = gui_queue
+        self.skip_replies = skip_replies
+        self.skip_text = skip_text
+        self.output_file = output_file
+        self.cache_file = cache_file
+        self.workers = workers
+        self._stop_event = threading.Event()
+        self._start_time = time.time()
+    
+    def stop(self):
+        self._stop_event.set()
+    
+    def run(self, start_date: Optional[datetime], end_date: Optional[datetime]):
+        records = None
+        try:
+            if not os.path.exists(self.cache_file):
+                self.gui_queue.put({'type': 'error', 'message': f"Кэш писем {self.cache_file} не найден"})
+                return
+            cache = MessageCache(self.cache_file)
+            try:
+                msg_ids = cache.message_ids()
+            finally:
+                cache.close()
+            total = len(msg_ids)
+            if not total:
+                self.gui_queue.put({'type': 'error', 'message': 'Кэш писем пуст'})
+                return
+            self.gui_queue.put({'type': 'status', 'message': f'Повторное извлечение из кэша: {total} писем'})
+            logger.info(f"Повторное извлечение: {total} писем, процессов {self.workers}, "
+                        f"skip_replies={self.skip_replies}, skip_text={self.skip_text}")
+            
+            start = start_date.strftime("%Y-%m-%d") if start_date else ""
+            end = (end_date + timedelta(days=1)).strftime("%Y-%m-%d") if end_date else ""
+            task = partial(_reextract_chunk, skip_replies=self.skip_replies, skip_text=self.skip_text,
+                           start=start, end=end)
+            chunks = [msg_ids[i:i + REEXTRACT_CHUNK] for i in range(0, total, REEXTRACT_CHUNK)]
+            dedup = DedupIndex()
+            records = RecordSpool()
+            contacts: Dict[tuple, Dict[str, Any]] = {}
+            statuses: Dict[str, int] = {}
+            processed = 0
+            
+            pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_reextract_worker,
+                                       initargs=(self.cache_file,))
+            try:
+                for results in pool.map(task, chunks):
+                    for msg_id, record, status in results:
+                        if record is not None and not dedup.add(record):
+                            status = 'duplicate'
+                        elif record is not None:
+                            records.append(record)
+                            key = contact_key(record)
+                            if key[0]:
+                                contacts[key] = merge_contact(contacts.get(key), record, key)
+                        statuses[status] = statuses.get(status, 0) + 1
+                    processed += len(results)
+                    self.gui_queue.put({
+                        'type': 'progress', 'processed': processed, 'total': total,
+                        'current_id': results[-1][0], 'current_subject': "Извлечение из кэша...",
+                        'current_from': "", 'speed': processed / max((time.time() - self._start_time) / 60, 1e-9)
+                    })
+                    if self._stop_event.is_set():
+                        logger.warning("Повторное извлечение прервано пользователем")
+                        break
+            finally:
+                pool.shutdown(wait=True, cancel_futures=True)
+            logger.info(f"Повторное извлечение: статусы писем {statuses}")
+            
+            if not len(records):
+                self.gui_queue.put({'type': 'error', 'message': 'Нет данных для экспорта'})
+                return
+            temp_path = os.path.splitext(self.output_file)[0] + ".tmp.xlsx"
+            contact_rows = (tuple(contact[name] for name in CONTACT_COLUMNS) for _, contact in sorted(contacts.items()))
+            count = write_records_xlsx(temp_path, records.iter_rows(), contacts=contact_rows)
+            os.replace(temp_path, self.output_file)
+            abs_path = os.path.abspath(self.output_file)
+            logger.info(f"Файл повторного извлечения: {abs_path} ({count} записей, {len(contacts)} контактов)")
+            self.gui_queue.put({'type': 'complete', 'count': count, 'file': abs_path})
+        except Exception as e:
+            logger.exception("Re-extraction failed")
+            self.gui_queue.put({'type': 'error', 'message': f"Ошибка повторного извлечения: {e}"})
+        finally:
+            if records is not None:
+                records.close()
 
 # ================= GUI =================
+def require_openpyxl():
+    """Проверка наличия openpyxl для работы с Excel - при запуске выгрузки, а не при импорте модуля"""
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        print("ОШИБКА: openpyxl не установлен. Установите его командой: pip install openpyxl")
+        sys.exit(1)
+
+def load_gui_modules():
+    """Импорт GUI-библиотек: нужны только окну приложения и требуют дисплей"""
+    global ctk, tk, DateEntry
+    import customtkinter as ctk
+    import tkinter as tk
+    from tkcalendar import DateEntry
+
 class GmailExportApp:
     def __init__(self):
+        load_gui_modules()
         try:
             logger.info("Инициализация GUI...")
             self.root = ctk.CTk()
@@ -1363,6 +4721,73 @@ class GmailExportApp:
                 variable=self.skip_text_var
             )
             self.skip_text_checkbox.pack(side='left', padx=10)
+            
+            self.incremental_var = ctk.BooleanVar(value=False)
+            self.incremental_checkbox = ctk.CTkCheckBox(
+                options_frame,
+                text="Только новые письма (с прошлой выгрузки)",
+                variable=self.incremental_var
+            )
+            self.incremental_checkbox.pack(side='left', padx=10)
+            
+            self.raw_format_var = ctk.BooleanVar(value=FETCH_FORMAT == 'raw')
+            self.raw_format_checkbox = ctk.CTkCheckBox(
+                options_frame,
+                text="Загружать письма целиком (RFC822, точные кодировки)",
+                variable=self.raw_format_var
+            )
+            self.raw_format_checkbox.pack(side='left', padx=10)
+            
+            self.async_engine_var = ctk.BooleanVar(value=ASYNC_ENGINE and httpx is not None)
+            self.async_engine_checkbox = ctk.CTkCheckBox(
+                options_frame,
+                text="Асинхронная загрузка (HTTP/2)",
+                variable=self.async_engine_var,
+                state="normal" if httpx is not None else "disabled"
+            )
+            self.async_engine_checkbox.pack(side='left', padx=10)
+            
+            self.sharded_var = ctk.BooleanVar(value=SHARDED_EXPORT)
+            self.sharded_checkbox = ctk.CTkCheckBox(
+                options_frame,
+                text="Параллельно по периодам",
+                variable=self.sharded_var
+            )
+            self.sharded_checkbox.pack(side='left', padx=10)
+            
+            self.all_accounts_var = ctk.BooleanVar(value=False)
+            self.all_accounts_checkbox = ctk.CTkCheckBox(
+                options_frame,
+                text=f"Все ящики из {ACCOUNTS_FILE}",
+                variable=self.all_accounts_var,
+                state="normal" if os.path.exists(ACCOUNTS_FILE) else "disabled"
+            )
+            self.all_accounts_checkbox.pack(side='left', padx=10)
+            
+            self.archive_var = ctk.BooleanVar(value=ARCHIVE_ENABLED)
+            self.archive_checkbox = ctk.CTkCheckBox(
+                options_frame,
+                text="Архив с поиском",
+                variable=self.archive_var
+            )
+            self.archive_checkbox.pack(side='left', padx=10)
+            
+            self.message_cache_var = ctk.BooleanVar(value=MESSAGE_CACHE_ENABLED)
+            self.message_cache_checkbox = ctk.CTkCheckBox(
+                options_frame,
+                text="Кэш писем",
+                variable=self.message_cache_var
+            )
+            self.message_cache_checkbox.pack(side='left', padx=10)
+            
+            self.reextract_var = ctk.BooleanVar(value=False)
+            self.reextract_checkbox = ctk.CTkCheckBox(
+                options_frame,
+                text="Извлечь из кэша (без загрузки)",
+                variable=self.reextract_var,
+                state="normal" if os.path.exists(MESSAGE_CACHE_FILE) else "disabled"
+            )
+            self.reextract_checkbox.pack(side='left', padx=10)
         except Exception as e:
             logger.exception(f"Ошибка создания элементов дат: {e}")
             raise
@@ -1380,6 +4805,9 @@ class GmailExportApp:
         self.current_label = ctk.CTkLabel(self.root, text="")
         self.current_label.pack()
         
+        self.metrics_label = ctk.CTkLabel(self.root, text="", font=("Arial", 10), wraplength=760)
+        self.metrics_label.pack()
+        
         btn_frame = ctk.CTkFrame(self.root)
         btn_frame.pack(pady=20)
         
@@ -1431,14 +4859,37 @@ class GmailExportApp:
         self.start_btn.configure(state="disabled")
         self.stop_btn.configure(state="normal")
         self.progress.set(0)
+        self.metrics_label.configure(text="")
         
         # Получаем значения галочек
         skip_replies = self.skip_replies_var.get()
         skip_text = self.skip_text_var.get()
+        incremental = self.incremental_var.get()
+        fetch_format = 'raw' if self.raw_format_var.get() else 'full'
+        engine_class = AsyncExportEngine if self.async_engine_var.get() else ExportEngine
+        sharded = self.sharded_var.get()
+        archive = self.archive_var.get()
+        message_cache = self.message_cache_var.get()
         
-        logger.info(f"Запуск экспорта: skip_replies={skip_replies}, skip_text={skip_text}")
+        logger.info(f"Запуск экспорта: skip_replies={skip_replies}, skip_text={skip_text}, incremental={incremental}, "
+                    f"format={fetch_format}, engine={engine_class.__name__}, sharded={sharded}, archive={archive}, "
+                    f"message_cache={message_cache}")
         
-        self.engine = ExportEngine(self.gui_queue, skip_replies=skip_replies, skip_text=skip_text)
+        options = dict(skip_replies=skip_replies, skip_text=skip_text, incremental=incremental,
+                       fetch_format=fetch_format, sharded=sharded, archive=archive, message_cache=message_cache)
+        if self.reextract_var.get():
+            self.engine = ReextractEngine(self.gui_queue, skip_replies=skip_replies, skip_text=skip_text)
+        elif self.all_accounts_var.get():
+            try:
+                accounts = load_accounts()
+            except Exception as e:
+                self.show_error(f"Ошибка списка ящиков {ACCOUNTS_FILE}: {e}")
+                self.reset_ui()
+                return
+            logger.info(f"Выгрузка ящиков: {[a.name for a in accounts]}")
+            self.engine = MultiAccountExport(self.gui_queue, accounts, **options)
+        else:
+            self.engine = engine_class(self.gui_queue, **options)
         self.processing_thread = threading.Thread(
             target=self.engine.run,
             args=(start, end),
@@ -1501,11 +4952,19 @@ class GmailExportApp:
                 elif msg['type'] == 'autosave':
                     self.log(f"Автосохранение: {msg['count']} писем")
                     
+                elif msg['type'] == 'metrics':
+                    self.metrics_label.configure(text=msg['summary'])
+                    
                 elif msg['type'] == 'complete':
                     self.progress.set(1)
-                    file_path = msg.get('file', 'gmail_export_final.xlsx')
-                    self.show_success(f"Готово! Экспортировано {msg['count']} писем\n\nФайл сохранен:\n{file_path}")
-                    self.log(f"✓ Файл успешно создан: {file_path}")
+                    if msg.get('message'):
+                        # Завершение без файла (например, новых писем нет)
+                        self.show_success(msg['message'])
+                        self.log(msg['message'])
+                    else:
+                        file_path = msg.get('file', 'gmail_export_final.xlsx')
+                        self.show_success(f"Готово! Экспортировано {msg['count']} писем\n\nФайл сохранен:\n{file_path}")
+                        self.log(f"✓ Файл успешно создан: {file_path}")
                     self.reset_ui()
                     
                 elif msg['type'] == 'error':
@@ -1588,7 +5047,178 @@ class GmailExportApp:
             logger.exception(f"Ошибка в главном цикле GUI: {e}")
             raise
 
-if __name__ == "__main__":
+# ================= CLI =================
+CLI_PROGRESS_INTERVAL = 1.0  # Как часто печатать прогресс в текстовом режиме CLI, сек
+
+def _parse_cli_date(value: str) -> datetime:
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается дата ГГГГ-ММ-ДД: {value}")
+
+def build_cli_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="gmailer",
+        description="Выгрузка писем Gmail в Excel. Без аргументов запускается графический интерфейс."
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    export = commands.add_parser('export', help="выгрузка без графического интерфейса")
+    export.add_argument('--from', dest='start_date', type=_parse_cli_date, help="начальная дата, ГГГГ-ММ-ДД")
+    export.add_argument('--to', dest='end_date', type=_parse_cli_date, help="конечная дата включительно, ГГГГ-ММ-ДД")
+    export.add_argument('--skip-replies', action='store_true', help="не парсить ответы на письма")
+    export.add_argument('--skip-text', action='store_true', help="не сохранять текст письма, только извлеченные данные")
+    export.add_argument('--incremental', action='store_true', help="только новые письма с прошлой выгрузки")
+    export.add_argument('--format', dest='fetch_format', choices=('full', 'raw'), default=FETCH_FORMAT,
+                        help="формат загрузки писем (по умолчанию %(default)s)")
+    export.add_argument('--async', dest='async_engine', action='store_true', default=ASYNC_ENGINE,
+                        help="асинхронная загрузка через httpx (HTTP/2)")
+    export.add_argument('--sharded', action='store_true', default=SHARDED_EXPORT,
+                        help="делить диапазон дат на окна и выгружать их параллельно")
+    export.add_argument('--accounts', nargs='?', const=ACCOUNTS_FILE, metavar='FILE',
+                        help=f"выгрузить все ящики из списка (по умолчанию {ACCOUNTS_FILE}) в общий файл")
+    export.add_argument('-o', '--output',
+                        help=f"итоговый Excel-файл (по умолчанию {OUTPUT_FILE}, для --accounts - {CONSOLIDATED_OUTPUT_FILE})")
+    export.add_argument('--archive', action='store_true', default=ARCHIVE_ENABLED,
+                        help=f"пополнять архив писем с поиском ({ARCHIVE_DB_FILE})")
+    export.add_argument('--cache', dest='message_cache', action='store_true', default=MESSAGE_CACHE_ENABLED,
+                        help=f"сохранять письма и вложения в кэш ({MESSAGE_CACHE_FILE}) для команды reextract")
+    export.add_argument('--no-metrics', dest='metrics', action='store_false', default=METRICS_ENABLED,
+                        help=f"не замерять стадии и не писать отчет {METRICS_REPORT_FILE}")
+    export.add_argument('--json', action='store_true', help="сообщения о ходе выгрузки - JSON-строками в stdout")
+    
+    reextract = commands.add_parser('reextract', help="повторное извлечение данных из кэша писем, без обращений к API")
+    reextract.add_argument('--from', dest='start_date', type=_parse_cli_date, help="письма с даты, ГГГГ-ММ-ДД")
+    reextract.add_argument('--to', dest='end_date', type=_parse_cli_date, help="письма по дату включительно, ГГГГ-ММ-ДД")
+    reextract.add_argument('--skip-replies', action='store_true', help="не парсить ответы на письма")
+    reextract.add_argument('--skip-text', action='store_true', help="не сохранять текст письма, только извлеченные данные")
+    reextract.add_argument('--cache', dest='cache_file', default=MESSAGE_CACHE_FILE,
+                           help="файл кэша писем (по умолчанию %(default)s)")
+    reextract.add_argument('--workers', type=int, default=PARSE_WORKERS, help="процессов разбора (по умолчанию %(default)s)")
+    reextract.add_argument('-o', '--output', default=OUTPUT_FILE, help="итоговый Excel-файл (по умолчанию %(default)s)")
+    reextract.add_argument('--json', action='store_true', help="сообщения о ходе работы - JSON-строками в stdout")
+    
+    search = commands.add_parser('search', help="поиск по архиву писем")
+    search.add_argument('text', nargs='*', help="слова в теме, тексте или вложениях (слово* - по началу слова)")
+    search.add_argument('--phone', help="телефон в любом формате")
+    search.add_argument('--inn', help="ИНН")
+    search.add_argument('--email', help="адрес отправителя")
+    search.add_argument('--from', dest='start_date', type=_parse_cli_date, help="письма с даты, ГГГГ-ММ-ДД")
+    search.add_argument('--to', dest='end_date', type=_parse_cli_date, help="письма по дату включительно, ГГГГ-ММ-ДД")
+    search.add_argument('--limit', type=int, default=ARCHIVE_SEARCH_LIMIT, help="максимум результатов (по умолчанию %(default)s)")
+    search.add_argument('--db', default=ARCHIVE_DB_FILE, help="файл архива (по умолчанию %(default)s)")
+    search.add_argument('--json', action='store_true', help="результаты - JSON-строками")
+    return parser
+
+class CliReporter:
+    """Вывод сообщений движка (те же, что получает GUI) в stdout: текстом или JSON-строками"""
+    
+    def __init__(self, as_json: bool = False):
+        self.as_json = as_json
+        self.completed = False
+        self.failed = False
+        self._last_progress = 0.0
+    
+    def handle(self, msg: Dict[str, Any]):
+        if msg['type'] == 'complete':
+            self.completed = True
+        elif msg['type'] == 'error':
+            self.failed = True
+        
+        if self.as_json:
+            print(json.dumps(msg, ensure_ascii=False, default=str), flush=True)
+            return
+        
+        if msg['type'] == 'progress':
+            # Прогресс приходит на каждое письмо - печатаем не чаще CLI_PROGRESS_INTERVAL
+            now = time.monotonic()
+            if now - self._last_progress < CLI_PROGRESS_INTERVAL and msg['processed'] < msg['total']:
+                return
+            self._last_progress = now
+            print(f"Письмо {msg['processed']} из {msg['total']} | {msg['speed']:.1f} писем/мин", flush=True)
+        elif msg['type'] == 'status':
+            print(msg['message'], flush=True)
+        elif msg['type'] == 'autosave':
+            print(f"Автосохранение: {msg['count']} писем", flush=True)
+        elif msg['type'] == 'complete':
+            print(msg.get('message') or f"Готово! Экспортировано {msg['count']} писем: {msg['file']}", flush=True)
+        elif msg['type'] == 'error':
+            print(f"Ошибка: {msg['message']}", file=sys.stderr, flush=True)
+
+def run_cli_export(args: argparse.Namespace) -> int:
+    """Выгрузка без GUI"""
+    require_openpyxl()
+    logger.info(f"Запуск экспорта из командной строки: {vars(args)}")
+    
+    gui_queue = queue.Queue()
+    options = dict(skip_replies=args.skip_replies, skip_text=args.skip_text, incremental=args.incremental,
+                   fetch_format=args.fetch_format, sharded=args.sharded, archive=args.archive,
+                   message_cache=args.message_cache, metrics_enabled=args.metrics)
+    if args.accounts:
+        engine = MultiAccountExport(gui_queue, load_accounts(args.accounts),
+                                    output_file=args.output or CONSOLIDATED_OUTPUT_FILE, **options)
+    else:
+        engine_class = AsyncExportEngine if args.async_engine else ExportEngine
+        engine = engine_class(gui_queue, output_file=args.output or OUTPUT_FILE, **options)
+    return _run_cli_engine(engine, args)
+
+def run_cli_reextract(args: argparse.Namespace) -> int:
+    """Повторное извлечение из кэша писем без GUI"""
+    require_openpyxl()
+    logger.info(f"Запуск повторного извлечения из командной строки: {vars(args)}")
+    engine = ReextractEngine(queue.Queue(), skip_replies=args.skip_replies, skip_text=args.skip_text,
+                             output_file=args.output, cache_file=args.cache_file, workers=args.workers)
+    return _run_cli_engine(engine, args)
+
+def _run_cli_engine(engine, args: argparse.Namespace) -> int:
+    """Движок работает в отдельном потоке, сообщения его очереди печатаются здесь"""
+    gui_queue = engine.gui_queue
+    worker = threading.Thread(target=engine.run, args=(args.start_date, args.end_date), daemon=True)
+    worker.start()
+    
+    reporter = CliReporter(as_json=args.json)
+    while worker.is_alive() or not gui_queue.empty():
+        try:
+            reporter.handle(gui_queue.get(timeout=0.2))
+        except queue.Empty:
+            continue
+        except KeyboardInterrupt:
+            # Как кнопка "Остановить": обработанные письма сохраняются, затем движок завершается
+            print("Остановка запрошена...", file=sys.stderr, flush=True)
+            engine.stop()
+    return 0 if reporter.completed else 1
+
+def run_cli_search(args: argparse.Namespace) -> int:
+    """Поиск по архиву писем: результаты в stdout, время запроса - в stderr"""
+    if not os.path.exists(args.db):
+        print(f"Ошибка: архив {args.db} не найден (выгрузка с параметром --archive)", file=sys.stderr)
+        return 1
+    if not (args.text or args.phone or args.inn or args.email or args.start_date or args.end_date):
+        print("Ошибка: задайте слова для поиска или хотя бы один фильтр", file=sys.stderr)
+        return 2
+    archive = MessageArchive(args.db)
+    try:
+        started = time.perf_counter()
+        results = archive.search(text=" ".join(args.text), phone=args.phone, inn=args.inn, email=args.email,
+                                 start_date=args.start_date, end_date=args.end_date, limit=args.limit)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+    finally:
+        archive.close()
+    for result in results:
+        if args.json:
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+            continue
+        print(f"{result['date']} | {result['from_email']} | {result['subject']}")
+        details = ", ".join(f"{name}: {result[name]}" for name in ('phone', 'inn', 'company') if result[name])
+        if details:
+            print(f"    {details}")
+        if result['snippet']:
+            print(f"    {result['snippet']}")
+    print(f"Найдено: {len(results)} за {elapsed_ms:.1f} мс", file=sys.stderr)
+    return 0
+
+def run_gui():
+    require_openpyxl()
     try:
         logger.info("Запуск приложения...")
         app = GmailExportApp()
@@ -1602,3 +5232,20 @@ if __name__ == "__main__":
         import traceback
         traceback.print_exc()
         input("Нажмите Enter для выхода...")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        run_gui()
+        return 0
+    args = build_cli_parser().parse_args(argv)
+    if args.command == 'export':
+        return run_cli_export(args)
+    if args.command == 'reextract':
+        return run_cli_reextract(args)
+    if args.command == 'search':
+        return run_cli_search(args)
+    return 2
+
+if __name__ == "__main__":
+    sys.exit(main())
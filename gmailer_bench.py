@@ -0,0 +1,400 @@
+"""Замеры и эталонные реализации для gmailer.
+
+Синтетический корпус писем, прежние реализации извлечения и очистки текста (эталоны
+для сверки) и микробенчмарки стадий выгрузки. Запуск: python gmailer_bench.py extract
+"""
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import subprocess
+import tempfile
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from typing import Optional, List, Dict, Any
+
+from gmailer import (
+    PHONE_PATTERNS, EXCLUDED_WEBSITE_DOMAINS, ARCHIVE_DB_FILE, FETCH_BATCH_SIZE, OUTPUT_FILE,
+    EmailData, ExportStore, RecordSpool, MessageArchive, normalize_phone, scan_phones, extract_data, clean_text, lxml_html, parse_message,
+)
+
+def _find_phones_reference(text: str) -> List[str]:
+    """Эталон: последовательный re.findall по каждому паттерну телефона"""
+    found = set()
+    for pattern in PHONE_PATTERNS:
+        for match in pattern.findall(text):
+            normalized = normalize_phone(match)
+            if normalized:
+                found.add(normalized)
+    return sorted(found)
+
+def _extract_data_reference(text: str) -> tuple:
+    """Эталон: прежний extract_data - re.findall по каждому паттерну без предварительной компиляции"""
+    if not text:
+        return "", "", "", "", "", ""
+    phones_str = ", ".join(_find_phones_reference(text))
+    
+    inns = re.findall(r'(?<!\d)\d{10}(?!\d)|(?<!\d)\d{12}(?!\d)', text)
+    inn = inns[0] if inns else ""
+    
+    fio = ""
+    for match in re.findall(r'\b[А-ЯЁ][а-яё]+\s+[А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?\b', text):
+        if len(match.strip()) >= 6:
+            fio = match.strip()
+            break
+    
+    website = ""
+    for w in re.findall(r'(?:https?://)?(?:www\.)?([a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.(?:[a-zA-Z]{2,}))', text):
+        if w.lower() not in EXCLUDED_WEBSITE_DOMAINS:
+            website = w.lower()
+            break
+    
+    company = ""
+    for pattern in [
+        r'(ООО|ИП|ЗАО|ПАО|АО|ОАО|НПО|НТЦ|ОП|ТД|ИЧП|ЧП|ЧУП|ТОО|АОЗТ)\s*["«]([^"»\n]{3,50})["»]',
+        r'(ООО|ИП|ЗАО|ПАО|АО|ОАО|НПО|НТЦ|ОП|ТД|ИЧП|ЧП|ЧУП|ТОО|АОЗТ)\s+([А-ЯЁ][А-ЯЁа-яё\s\-]{2,40}?)(?:\s|$|,|\.|«|")',
+    ]:
+        matches = re.findall(pattern, text, re.IGNORECASE)
+        if matches:
+            comp_name = re.sub(r'["«»"]', '', matches[0][1].strip()).strip()
+            if comp_name:
+                company = f"{matches[0][0].upper()} {comp_name}".strip()
+                break
+    
+    address = ""
+    found_addresses = []
+    for pattern in [
+        r'\d{6}[^,\n]*(?:,\s*[^,\n]+){0,5}(?:,\s*(?:г\.|город|г\s)[^,\n]+)?(?:,\s*(?:ул\.|улица|пр\.|проспект|пер\.|переулок|вн\.тер\.г\.)[^,\n]+)?(?:,\s*(?:д\.|дом)[^,\n]+)?(?:,\s*(?:лит\.|литера|лит)[^,\n]+)?(?:,\s*(?:помещ\.|помещение|офис|оф\.)[^,\n]+)?',
+        r'(?:г\.|город|г\s|ул\.|улица|пр\.|проспект|пер\.|переулок|вн\.тер\.г\.)[^,\n]+(?:,\s*[^,\n]+){0,6}(?:,\s*(?:д\.|дом)[^,\n]+)?(?:,\s*(?:лит\.|литера|лит)[^,\n]+)?(?:,\s*(?:помещ\.|помещение|офис|оф\.)[^,\n]+)?',
+    ]:
+        found_addresses.extend(re.findall(pattern, text, re.IGNORECASE))
+    if found_addresses:
+        address = re.sub(r'[,\s]+$', '', re.sub(r'^[,\s]+', '', max(found_addresses, key=len).strip()))
+        if len(address) > 200:
+            address = address[:200] + "..."
+    
+    return phones_str, inn, fio, website, company, address
+
+def _bench_corpus(count: int, seed: int = 0) -> List[str]:
+    """Детерминированный синтетический корпус писем для проверки и замеров извлечения"""
+    rng = random.Random(seed)
+    phone_formats = [
+        "+7 ({a}) {b}-{c}-{d}", "+7({a}){b}{c}{d}", "8 ({a}) {b}-{c}{d}", "8{a}{b}{c}{d}",
+        "+7 {a} {b} {c} {d}", "8 {a} {b}-{c}-{d}", "+7{a}-{b}-{c}{d}", "8 {a}{b} {c} {d}",
+    ]
+    words = ["заказ", "поставка", "счет", "оплата", "договор", "прайс", "доставка", "склад",
+             "Иванов", "Петр", "Сергеевич", "order", "invoice", "price", "www.example.ru", "gmail.com"]
+    templates = [
+        "С уважением, Иванов Петр Сергеевич, ООО «Ромашка», тел. {phone}",
+        "ИНН {inn}, адрес: {index}, г. Москва, ул. Ленина, д. 5, офис 12",
+        "Звоните {phone} или {phone2}, сайт https://www.company-{n}.ru",
+        "ИП Сидоров Алексей, {phone}, ИНН {inn12}",
+        "Номер заказа {digits}, сумма {digits}, телефон {phone}",
+    ]
+    corpus = []
+    for n in range(count):
+        def phone():
+            fmt = rng.choice(phone_formats)
+            return fmt.format(a=rng.randint(900, 999), b=rng.randint(100, 999),
+                              c=f"{rng.randint(0, 99):02d}", d=f"{rng.randint(0, 99):02d}")
+        parts = []
+        for _ in range(rng.randint(1, 6)):
+            parts.append(" ".join(rng.choice(words) for _ in range(rng.randint(5, 60))))
+            parts.append(rng.choice(templates).format(
+                phone=phone(), phone2=phone(), n=n,
+                inn=rng.randint(10 ** 9, 10 ** 10 - 1), inn12=rng.randint(10 ** 11, 10 ** 12 - 1),
+                index=rng.randint(100000, 999999), digits=rng.randint(10 ** 8, 10 ** 14)))
+        corpus.append("\n".join(parts))
+    return corpus
+
+def bench_extract(count: int = 2000, seed: int = 0) -> Dict[str, float]:
+    """Микробенчмарк extract_data: сверка телефонов с эталоном и время на письмо"""
+    corpus = _bench_corpus(count, seed)
+    
+    mismatches = sum(1 for text in corpus if scan_phones(text) != _find_phones_reference(text))
+    if mismatches:
+        raise AssertionError(f"scan_phones расходится с эталоном на {mismatches} письмах")
+    
+    started = time.perf_counter()
+    for text in corpus:
+        _find_phones_reference(text)
+    reference_time = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    for text in corpus:
+        scan_phones(text)
+    scan_time = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    for text in corpus:
+        extract_data(text)
+    extract_time = time.perf_counter() - started
+    
+    result = {
+        'messages': count,
+        'phones_reference_us': reference_time / count * 1e6,
+        'phones_scan_us': scan_time / count * 1e6,
+        'extract_data_us': extract_time / count * 1e6,
+    }
+    print(f"Писем: {count}")
+    print(f"Телефоны, эталон (findall x{len(PHONE_PATTERNS)}): {result['phones_reference_us']:.1f} мкс/письмо")
+    print(f"Телефоны, один проход: {result['phones_scan_us']:.1f} мкс/письмо")
+    print(f"extract_data целиком: {result['extract_data_us']:.1f} мкс/письмо")
+    return result
+
+def _clean_text_reference(text: str) -> str:
+    """Эталон: прежняя очистка - полный разбор html.parser на каждый вызов"""
+    if not text:
+        return ""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(text, "html.parser")
+    for script in soup(["script", "style", "head", "meta", "link"]):
+        script.decompose()
+    text = ' '.join(soup.get_text(separator=' ', strip=True).split())
+    text = ' '.join(re.sub(r'[\u200b\u200c\u200d\ufeff\u00a0\u2060]', '', text).split())
+    return text[:10000] + "... [текст обрезан]" if len(text) > 10000 else text.strip()
+
+def bench_clean(count: int = 500, seed: int = 0) -> Dict[str, float]:
+    """Микробенчмарк очистки тела письма: прежний путь (разбор при каждой очистке) против нового"""
+    plain = _bench_corpus(count, seed)
+    html = [
+        "<html><head><style>p {color: red}</style></head><body><div>"
+        + "".join(f"<p>{line}&nbsp;</p>" for line in text.split("\n"))
+        + "<script>track()</script></div></body></html>"
+        for text in plain
+    ]
+    bodies = plain + html
+    
+    started = time.perf_counter()
+    for body in bodies:
+        # Раньше тело чистилось в parse_message и еще раз в build_email_data
+        _clean_text_reference(_clean_text_reference(body))
+    reference_time = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    for body in bodies:
+        clean_text(clean_text(body), html=False)
+    new_time = time.perf_counter() - started
+    
+    result = {
+        'messages': len(bodies),
+        'reference_us': reference_time / len(bodies) * 1e6,
+        'clean_us': new_time / len(bodies) * 1e6,
+    }
+    print(f"Писем: {len(bodies)} (половина - HTML), парсер: {'lxml' if lxml_html is not None else 'html.parser'}")
+    print(f"Прежняя очистка: {result['reference_us']:.1f} мкс/письмо")
+    print(f"Новая очистка: {result['clean_us']:.1f} мкс/письмо")
+    return result
+
+def _as_gmail_payload(part, part_id: str = "") -> Dict:
+    """Часть письма в виде payload ответа messages.get format='full'"""
+    node = {
+        'partId': part_id,
+        'mimeType': part.get_content_type(),
+        'filename': part.get_filename() or "",
+        'headers': [{'name': name, 'value': str(value)} for name, value in part.items()],
+    }
+    if part.is_multipart():
+        node['body'] = {'size': 0}
+        node['parts'] = [_as_gmail_payload(sub, f"{part_id}.{n}" if part_id else str(n))
+                         for n, sub in enumerate(part.iter_parts())]
+    else:
+        data = part.get_payload(decode=True) or b""
+        # Как в Gmail: данные вложений - по attachmentId, текстовые части с именем файла - внутри
+        if node['filename'] and (part.get_content_disposition() == 'attachment'
+                                 or node['mimeType'] not in ('text/plain', 'text/html')):
+            node['body'] = {'attachmentId': f"att-{part_id}", 'size': len(data)}
+        else:
+            node['body'] = {'size': len(data), 'data': base64.urlsafe_b64encode(data).decode()}
+    return node
+
+def bench_fetch_formats(count: int = 300, seed: int = 0) -> Dict[str, float]:
+    """Сравнение разбора format='full' (JSON) и format='raw' (RFC822): скорость и кодировки.
+    
+    Половина писем в cp1251. В JSON-режиме вложение только описано (загружается
+    отдельно), в raw-режиме его байты разбираются вместе с письмом.
+    """
+    texts = _bench_corpus(count, seed)
+    json_messages, raw_messages = [], []
+    for i, text in enumerate(texts):
+        charset = 'cp1251' if i % 2 else 'utf-8'
+        message = EmailMessage()
+        message['From'] = f"Отправитель {i} <sender{i}@example.ru>"
+        message['To'] = "me@example.ru"
+        message['Subject'] = f"Заказ №{i}"
+        message['Date'] = "Mon, 01 Jan 2024 10:00:00 +0300"
+        message.set_content(text, charset=charset)
+        message.add_alternative(f"<html><body><p>{text}</p></body></html>", subtype='html', charset=charset)
+        message.add_attachment(text.encode('utf-8'), maintype='text', subtype='plain', filename=f"file{i}.txt")
+        json_messages.append({'id': f"m{i}", 'payload': _as_gmail_payload(message)})
+        raw_messages.append({'id': f"m{i}", 'raw': base64.urlsafe_b64encode(message.as_bytes()).decode()})
+    
+    result = {'messages': count}
+    for name, messages in (('full', json_messages), ('raw', raw_messages)):
+        started = time.perf_counter()
+        parsed = [parse_message(msg, msg['id']) for msg in messages]
+        elapsed = time.perf_counter() - started
+        intact = sum(1 for text, p in zip(texts, parsed) if ' '.join(text.split())[:80] in p.body)
+        result[f'{name}_per_sec'] = count / elapsed
+        result[f'{name}_intact'] = intact
+        print(f"format='{name}': {count / elapsed:.0f} писем/сек, текст без искажений: {intact}/{count}")
+    return result
+
+def bench_archive(count: int = 1_000_000, seed: int = 0, path: Optional[str] = None) -> Dict[str, Any]:
+    """Наполнение архива count синтетическими письмами и время типовых запросов к нему"""
+    rng = random.Random(seed)
+    corpus = [" ".join(text.split()) for text in _bench_corpus(500, seed)]
+    extracted = [extract_data(text) for text in corpus]
+    senders = [f"sender{n}@company{n % 1000}.ru" for n in range(20000)]
+    with tempfile.TemporaryDirectory() as work_dir:
+        archive = MessageArchive(path or os.path.join(work_dir, ARCHIVE_DB_FILE))
+        started = time.perf_counter()
+        probe = None
+        for start in range(0, count, 10000):
+            entries = []
+            for i in range(start, min(start + 10000, count)):
+                phone, inn, fio, website, company, address = extracted[i % len(corpus)]
+                sent = datetime(2015, 1, 1) + timedelta(minutes=rng.randrange(5_000_000))
+                # Артикул - редкое слово: такие и ищут в архиве
+                text = f"{corpus[i % len(corpus)]} Артикул A{rng.randrange(200000)}"
+                record = EmailData(date=sent.strftime("%d %b %Y %H:%M"), from_email=rng.choice(senders),
+                                   subject=f"Заказ №{i}", phone=phone, inn=inn, text=text,
+                                   fio=fio, website=website, company=company, address=address)
+                entries.append((f"m{i}", record))
+                if probe is None and phone and inn:
+                    probe = record
+            archive.add(entries)
+        fill_time = time.perf_counter() - started
+        
+        queries = {
+            'phone': dict(phone=probe.phone.split(",")[0]),
+            'inn': dict(inn=probe.inn),
+            'email': dict(email=probe.from_email),
+            'email_period': dict(email=probe.from_email, start_date=datetime(2018, 1, 1), end_date=datetime(2019, 12, 31)),
+            'text': dict(text="A12345"),
+            'text_prefix': dict(text="A1234*"),
+            'text_email': dict(text="A12345", email=probe.from_email),
+            'text_common': dict(text="договор поставка"),
+        }
+        result = {'messages': count, 'fill_per_sec': count / fill_time,
+                  'db_mb': os.path.getsize(archive.path) / 2 ** 20}
+        print(f"Архив: {count} писем за {fill_time:.0f} сек ({result['fill_per_sec']:.0f} писем/сек), "
+              f"{result['db_mb']:.0f} МБ")
+        for name, params in queries.items():
+            timings = []
+            for _ in range(5):
+                started = time.perf_counter()
+                found = archive.search(**params)
+                timings.append((time.perf_counter() - started) * 1000)
+            result[f'{name}_ms'] = min(timings)
+            print(f"{name}: {min(timings):.2f} мс, найдено {len(found)}")
+        archive.close()
+    return result
+
+# Библиотеки, которые раньше импортировались вместе с модулем
+DEFERRED_MODULES = ['customtkinter', 'tkinter', 'tkcalendar', 'pandas', 'bs4', 'pdfplumber', 'docx',
+                    'openpyxl', 'google_auth_oauthlib.flow', 'googleapiclient.discovery']
+
+def bench_import(repeat: int = 3) -> Dict[str, Any]:
+    """Время запуска: import gmailer в чистом интерпретаторе против импорта вместе с отложенными библиотеками"""
+    # Из временного каталога, чтобы журнал запуска не попадал рядом с модулем
+    run_options = dict(cwd=tempfile.gettempdir(), check=True, capture_output=True, text=True,
+                       env={**os.environ, 'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))})
+    
+    def measure(imports: str) -> float:
+        code = f"import time; start = time.perf_counter(); import {imports}; print(time.perf_counter() - start)"
+        return min(
+            float(subprocess.run([sys.executable, '-c', code], **run_options).stdout)
+            for _ in range(repeat)
+        )
+    
+    probe = f"import gmailer, sys; print(','.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))"
+    loaded = subprocess.run([sys.executable, '-c', probe], **run_options).stdout.strip()
+    result = {
+        'lazy_s': measure("gmailer"),
+        'eager_s': measure(", ".join(["gmailer"] + DEFERRED_MODULES)),
+        'loaded_deferred': [m for m in loaded.split(',') if m],
+    }
+    print(f"import gmailer: {result['lazy_s']:.3f} сек")
+    print(f"import gmailer со всеми библиотеками (как раньше): {result['eager_s']:.3f} сек")
+    print(f"Отложенные библиотеки, загруженные при импорте: {result['loaded_deferred'] or 'нет'}")
+    return result
+
+def peak_rss_mb() -> float:
+    """Пиковый размер резидентной памяти текущего процесса, МБ"""
+    try:
+        import resource
+    except ImportError:  # Windows
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+
+def _bench_memory_run(mode: str, count: int, text_size: int):
+    """Синтетическая выгрузка в текущем каталоге; печатает JSON с пиком памяти.
+    'list' - прежний путь (все записи списком, итоговый файл через DataFrame), 'spool' - RecordSpool
+    и потоковая запись Excel"""
+    samples = [" ".join(text.split()) for text in _bench_corpus(200)]
+    samples = [(text * (text_size // len(text) + 1))[:text_size - 8] for text in samples]
+    store = ExportStore()
+    records = [] if mode == 'list' else RecordSpool()
+    started = time.perf_counter()
+    entries = []
+    for i in range(count):
+        record = EmailData(
+            date=f"2024-01-{i % 28 + 1:02d} 10:{i % 60:02d}", from_email=f"sender{i}@example.ru",
+            subject=f"Заказ №{i}", phone="+7 (900) 123-45-67", inn="7707083893",
+            text=f"{samples[i % len(samples)]} #{i:06d}", fio="Иванов Петр Сергеевич",
+            company="ООО «Ромашка»", has_attachments=bool(i % 3), processed_at=datetime.now().isoformat()
+        )
+        records.append(record)
+        entries.append((f"m{i}", record))
+        if len(entries) == FETCH_BATCH_SIZE:
+            store.append(entries)
+            entries = []
+    store.append(entries)
+    collected_mb = peak_rss_mb()
+    if mode == 'list':
+        df = store.to_dataframe()
+        df.to_excel(OUTPUT_FILE, index=False, engine='openpyxl')
+        written = len(df)
+    else:
+        written = store.export_xlsx(OUTPUT_FILE)
+        records.close()
+    store.close()
+    print(json.dumps({'written': written, 'seconds': time.perf_counter() - started,
+                      'collect_peak_mb': collected_mb, 'peak_mb': peak_rss_mb()}))
+
+def bench_memory(count: int = 200_000, text_size: int = 2000, modes: tuple = ('spool', 'list')) -> Dict[str, Any]:
+    """Пик памяти синтетической выгрузки count писем (текст - text_size символов): прежний путь против RecordSpool.
+    Каждый режим - в отдельном процессе и своем временном каталоге"""
+    result = {'messages': count, 'text_size': text_size}
+    for mode in modes:
+        with tempfile.TemporaryDirectory() as work_dir:
+            code = f"import gmailer_bench; gmailer_bench._bench_memory_run({mode!r}, {count}, {text_size})"
+            output = subprocess.run(
+                [sys.executable, '-c', code], cwd=work_dir, check=True, capture_output=True, text=True,
+                env={**os.environ, 'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))}
+            ).stdout
+        result[mode] = json.loads(output.strip().splitlines()[-1])
+        print(f"{mode}: пик {result[mode]['peak_mb']:.0f} МБ (после сбора записей {result[mode]['collect_peak_mb']:.0f} МБ), "
+              f"{result[mode]['seconds']:.0f} сек, строк {result[mode]['written']}")
+    return result
+
+BENCHMARKS = {
+    'extract': bench_extract,
+    'clean': bench_clean,
+    'fetch-formats': bench_fetch_formats,
+    'archive': bench_archive,
+    'import': bench_import,
+    'memory': bench_memory,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замеры стадий выгрузки gmailer")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS), help="какой замер запустить")
+    BENCHMARKS[parser.parse_args().benchmark]()
@@ -0,0 +1,25 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# gmailer при импорте открывает журнал export_log.txt в текущем каталоге - уводим его из репозитория
+os.chdir(tempfile.mkdtemp(prefix="gmailer_tests_"))
+
+import pytest
+
+import gmailer
+from fake_gmail import FakeGmail
+
+@pytest.fixture
+def gmail(tmp_path, monkeypatch):
+    """Заглушка Gmail API вместо авторизации и сервиса; файлы выгрузки - во временном каталоге"""
+    service = FakeGmail()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(gmailer, 'authenticate', lambda *args, **kwargs: None)
+    monkeypatch.setattr(gmailer, 'create_gmail_service', lambda *args, **kwargs: service)
+    monkeypatch.setattr(gmailer, 'rate_limiter', gmailer.RateLimiter(start_rate=1000))
+    # Кэш вложений - свой у каждого теста, в его каталоге
+    monkeypatch.setattr(gmailer, '_attachment_cache', None)
+    return service
@@ -0,0 +1,162 @@
+"""Заглушка сервиса Gmail API для тестов выгрузки: тот же интерфейс цепочек вызовов
+(service.users().messages().get(...).execute()), письма и история - в памяти"""
+import base64
+import queue
+import re
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+START_TS = 1704067200  # 2024-01-01 00:00 UTC
+
+def http_error(status: int) -> HttpError:
+    response = httplib2.Response({'status': status})
+    response.reason = "fake"
+    return HttpError(response, b'{}')
+
+def b64(data) -> str:
+    return base64.urlsafe_b64encode(data.encode() if isinstance(data, str) else data).decode()
+
+class Request:
+    def __init__(self, run):
+        self._run = run
+
+    def execute(self):
+        return self._run()
+
+class FakeGmail:
+    """Почтовый ящик из count писем, по одному в час с START_TS.
+
+    mailbox - письма по ID, errors - код ошибки HTTP для ID (при каждом запросе письма), history_records - записи
+    history.list, expired - контрольная точка устарела (history.list отвечает 404).
+    """
+    def __init__(self, count: int = 30):
+        self.mailbox = {}
+        self.order = []
+        for i in range(count):
+            msg_id = f"m{i:04d}"
+            body = f"Письмо {i}: Иванов Петр, тел. +7 (912) 345-67-{i % 100:02d}, ИНН 77071{i % 100:05d}"
+            parts = [{'partId': '0', 'mimeType': 'text/plain', 'filename': '',
+                      'body': {'data': b64(body), 'size': len(body)}}]
+            if i % 3 == 0:
+                parts.append({'partId': '1', 'mimeType': 'text/plain', 'filename': 'card.txt',
+                              'body': {'attachmentId': f"a{i}", 'size': 20}})
+            headers = [{'name': 'Subject', 'value': f"Тема {i}"},
+                       {'name': 'From', 'value': f"Отправитель <sender{i % 5}@example.ru>"},
+                       {'name': 'Date', 'value': f"Mon, {1 + i // 24:02d} Jan 2024 {i % 24:02d}:00:00 +0000"}]
+            self.mailbox[msg_id] = {
+                'id': msg_id, 'threadId': f"t{i}", 'internalDate': str((START_TS + i * 3600) * 1000),
+                'payload': {'partId': '', 'mimeType': 'multipart/mixed', 'filename': '', 'headers': headers,
+                            'body': {'size': 0}, 'parts': parts},
+            }
+            self.order.append(msg_id)
+        self.errors = {}
+        self.history_records = []
+        self.history_id = '1000'
+        self.expired = False
+        self.calls = {}
+
+    def add_history(self, history_id: str, msg_ids: list):
+        """Запись истории: письма msg_ids добавлены в ящик, historyId ящика - history_id"""
+        self.history_records.append({'id': history_id, 'messagesAdded': [
+            {'message': {'id': m, 'threadId': self.mailbox[m]['threadId'], 'labelIds': ['INBOX']}} for m in msg_ids]})
+        self.history_id = history_id
+
+    def _count(self, kind: str):
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    # Цепочки вызовов googleapiclient
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def attachments(self):
+        return _Attachments(self)
+
+    def history(self):
+        return _History(self)
+
+    def getProfile(self, userId='me', **kwargs):
+        return Request(lambda: {'emailAddress': 'me@example.ru', 'historyId': self.history_id})
+
+    def list(self, userId='me', q='', maxResults=500, pageToken=None, **kwargs):
+        def run():
+            self._count('list')
+            ids = self.order
+            after = re.search(r'after:(\d+)(?!/)', q or '')
+            before = re.search(r'before:(\d+)(?!/)', q or '')
+            if after:
+                ids = [m for m in ids if int(self.mailbox[m]['internalDate']) // 1000 > int(after.group(1))]
+            if before:
+                ids = [m for m in ids if int(self.mailbox[m]['internalDate']) // 1000 < int(before.group(1))]
+            start = int(pageToken or 0)
+            page = ids[start:start + maxResults]
+            result = {'resultSizeEstimate': len(ids)}
+            if page:
+                result['messages'] = [{'id': m, 'threadId': self.mailbox[m]['threadId']} for m in page]
+            if start + maxResults < len(ids):
+                result['nextPageToken'] = str(start + maxResults)
+            return result
+        return Request(run)
+
+    def get(self, userId='me', id=None, format='full', **kwargs):
+        def run():
+            self._count('get')
+            if id in self.errors:
+                raise http_error(self.errors[id])
+            message = self.mailbox[id]
+            if format == 'metadata':
+                return {**message, 'payload': {'headers': message['payload']['headers']}}
+            return message
+        return Request(run)
+
+    def new_batch_http_request(self, callback=None):
+        return _Batch(callback)
+
+class _Batch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None, callback=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.requests:
+            try:
+                response, error = request.execute(), None
+            except Exception as e:
+                response, error = None, e
+            self.callback(request_id, response, error)
+
+class _Attachments:
+    def __init__(self, service: FakeGmail):
+        self.service = service
+
+    def get(self, userId='me', messageId=None, id=None, **kwargs):
+        return Request(lambda: {'data': b64(f"Карточка {messageId}: тел. 8 800 555 35 35"), 'size': 40})
+
+class _History:
+    def __init__(self, service: FakeGmail):
+        self.service = service
+
+    def list(self, userId='me', startHistoryId=None, pageToken=None, **kwargs):
+        def run():
+            self.service._count('history')
+            if self.service.expired:
+                raise http_error(404)
+            records = [h for h in self.service.history_records if int(h['id']) > int(startHistoryId)]
+            return {'history': records, 'historyId': self.service.history_id}
+        return Request(run)
+
+def run_export(engine_cls, start_date=None, end_date=None, **options) -> tuple:
+    """Выгрузка целиком; возвращает последнее сообщение (complete или error) и все сообщения"""
+    gui_queue = queue.Queue()
+    engine_cls(gui_queue, **options).run(start_date, end_date)
+    messages = []
+    while not gui_queue.empty():
+        messages.append(gui_queue.get())
+    final = [m for m in messages if m['type'] in ('complete', 'error')]
+    return final[-1], messages
@@ -0,0 +1,84 @@
+import random
+import re
+from datetime import datetime, timedelta
+
+import pytest
+
+from gmailer import ATTACHMENT_MARKER, EmailData, MessageArchive, extract_data, sortable_date
+from gmailer_bench import _bench_corpus
+
+CORPUS = [" ".join(text.split()) for text in _bench_corpus(60, seed=4)]
+
+def make_entries(count: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    entries = []
+    for i in range(count):
+        text = CORPUS[i % len(CORPUS)]
+        phone, inn, fio, website, company, address = extract_data(text)
+        sent = datetime(2023, 1, 1) + timedelta(hours=rng.randrange(24 * 365))
+        if i % 4 == 0:
+            text += f"\n\n{ATTACHMENT_MARKER}\nАртикул A{i:05d} из вложения"
+        entries.append((f"m{i}", EmailData(
+            date=sent.strftime("%d %b %Y %H:%M"), from_email=f"sender{i % 9}@company.ru", subject=f"Заказ №{i}",
+            phone=phone, inn=inn, text=text, fio=fio, website=website, company=company, address=address,
+            has_attachments=i % 4 == 0)))
+    return entries
+
+def words(text: str) -> set:
+    return {word.lower() for word in re.findall(r"\w+", text)}
+
+@pytest.fixture(scope="module")
+def archive(tmp_path_factory):
+    archive = MessageArchive(str(tmp_path_factory.mktemp("archive") / "archive.db"))
+    entries = make_entries(400)
+    archive.add(entries[:250])
+    assert archive.add(entries) == 150  # Уже архивированные письма пропускаются
+    yield archive, dict(entries)
+    archive.close()
+
+def found(results: list) -> set:
+    return {row['msg_id'] for row in results}
+
+def test_search_by_indexed_fields(archive):
+    archive, records = archive
+    probe = next(r for r in records.values() if r.phone and r.inn)
+    phone = probe.phone.split(", ")[-1]
+    assert found(archive.search(phone=phone, limit=1000)) == \
+           {msg_id for msg_id, r in records.items() if phone in r.phone.split(", ")}
+    assert found(archive.search(inn=probe.inn, limit=1000)) == \
+           {msg_id for msg_id, r in records.items() if r.inn == probe.inn}
+    assert found(archive.search(email="Sender3@Company.ru ", limit=1000)) == \
+           {msg_id for msg_id, r in records.items() if r.from_email == "sender3@company.ru"}
+
+def test_search_by_period_includes_end_date(archive):
+    archive, records = archive
+    start, end = datetime(2023, 3, 1), datetime(2023, 3, 31)
+    expected = {msg_id for msg_id, r in records.items()
+                if start.strftime("%Y-%m-%d") <= sortable_date(r.date)[:10] <= end.strftime("%Y-%m-%d")}
+    results = archive.search(start_date=start, end_date=end, limit=1000)
+    assert found(results) == expected
+    dates = [sortable_date(row['date']) for row in results]
+    assert dates == sorted(dates, reverse=True)
+
+@pytest.mark.parametrize("query", ["договор", "A00012", "поставка склад"])
+def test_full_text_search(archive, query):
+    archive, records = archive
+    expected = {msg_id for msg_id, r in records.items()
+                if words(query) <= words(f"{r.subject} {r.text.replace(ATTACHMENT_MARKER, ' ')}")}
+    assert found(archive.search(text=query, limit=1000)) == expected
+
+def test_full_text_prefix_and_combined_conditions(archive):
+    archive, records = archive
+    expected = {msg_id for msg_id, r in records.items() if r.from_email == "sender0@company.ru"
+                and any(word.startswith("a000") for word in words(r.text))}
+    results = archive.search(text="A000*", email="sender0@company.ru", limit=1000)
+    assert expected and found(results) == expected
+    assert all(row['snippet'] for row in results)
+
+@pytest.mark.parametrize("text, query", [
+    ('ООО "Ромашка"', '"ООО" """Ромашка"""'),
+    ("цена* -скидка", '"цена"* "-скидка"'),
+    ("*", ""),
+])
+def test_fts_query_escapes_user_input(text, query):
+    assert MessageArchive.fts_query(text) == query
@@ -0,0 +1,53 @@
+import asyncio
+import queue
+
+import pytest
+
+import gmailer
+from gmailer import AsyncExportEngine, parse_attachment
+
+httpx = pytest.importorskip("httpx")
+
+class Credentials:
+    token = "token"
+    valid = True
+
+def attachment_transport(gmail):
+    """REST-ответы attachments.get из той же заглушки, что и у синхронного движка"""
+    def handler(request):
+        parts = request.url.path.split('/')
+        body = gmail.attachments().get(messageId=parts[-3], id=parts[-1]).execute()
+        return httpx.Response(200, json=body)
+    return httpx.MockTransport(handler)
+
+def async_attachment_text(gmail, msg_id: str, part: dict) -> str:
+    engine = AsyncExportEngine(queue.Queue())
+    engine.creds = Credentials()
+    
+    async def run():
+        async with httpx.AsyncClient(transport=attachment_transport(gmail)) as client:
+            return await engine._attachment_text(client, msg_id, part)
+    return asyncio.run(run())
+
+PARTS = {
+    'small': {'partId': '1', 'mimeType': 'text/plain', 'filename': 'card.txt',
+              'body': {'attachmentId': 'a1', 'size': 40}},
+    'oversized': {'partId': '2', 'mimeType': 'application/pdf', 'filename': 'scan.pdf',
+                  'body': {'attachmentId': 'a2', 'size': gmailer.MAX_ATTACHMENT_SIZE + 1}},
+    'no_data': {'partId': '3', 'mimeType': 'text/plain', 'filename': 'empty.txt', 'body': {'size': 0}},
+}
+
+@pytest.mark.parametrize("kind", sorted(PARTS))
+def test_async_and_sync_attachment_text_match(gmail, monkeypatch, kind):
+    part = PARTS[kind]
+    sync_text = parse_attachment(gmail, 'm0001', part)
+    # Второй вызов без кэша: оба пути считают текст сами
+    monkeypatch.setattr(gmailer, '_attachment_cache', None)
+    assert async_attachment_text(gmail, 'm0001', part) == sync_text
+    if kind == 'oversized':
+        assert sync_text == "[Вложение слишком большое: scan.pdf]"
+
+def test_async_attachment_uses_cached_text(gmail):
+    part = PARTS['small']
+    expected = parse_attachment(gmail, 'm0001', part)
+    assert async_attachment_text(gmail, 'm0001', part) == expected
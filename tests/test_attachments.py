@@ -0,0 +1,73 @@
+import threading
+import time
+
+import pytest
+
+import gmailer
+from gmailer import ATTACHMENT_MARKER, ParsedMessage, ServicePool, ThreadSafeState, process_attachments
+from fake_gmail import FakeGmail, Request, b64
+
+class GuardedGmail(FakeGmail):
+    """Заглушка, замечающая одновременное использование сервиса из разных потоков"""
+    def __init__(self):
+        super().__init__(count=0)
+        self._busy = threading.Lock()
+        self.conflicts = 0
+        self.threads = set()
+    
+    def attachments(self):
+        return self
+    
+    def get(self, userId='me', messageId=None, id=None, **kwargs):
+        def run():
+            if not self._busy.acquire(blocking=False):
+                self.conflicts += 1
+                return {'data': b64(""), 'size': 0}
+            try:
+                self.threads.add(threading.get_ident())
+                time.sleep(0.02)
+                return {'data': b64(f"Вложение {id}"), 'size': 20}
+            finally:
+                self._busy.release()
+        return Request(run)
+
+def parsed_message(count: int) -> ParsedMessage:
+    parts = [{'partId': str(i), 'mimeType': 'text/plain', 'filename': f"file{i}.txt",
+              'body': {'attachmentId': f"a{i}", 'size': 20}} for i in range(count)]
+    return ParsedMessage(msg_id='m1', date="", from_email="", subject="", body="Текст", attachment_parts=parts)
+
+@pytest.fixture
+def attachment_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(gmailer, '_attachment_cache', None)
+    monkeypatch.setattr(gmailer, 'ATTACHMENT_WORKERS', 4)
+
+def attachment_texts(parsed: ParsedMessage) -> list:
+    return [text.strip() for text in parsed.body.split(ATTACHMENT_MARKER)[1:]]
+
+def test_without_pool_attachments_load_sequentially(attachment_cache):
+    service = GuardedGmail()
+    parsed = parsed_message(4)
+    assert process_attachments(service, parsed, ThreadSafeState())
+    assert service.conflicts == 0
+    assert service.threads == {threading.get_ident()}
+    assert attachment_texts(parsed) == [f"Вложение a{i}" for i in range(4)]
+
+def test_with_pool_each_thread_leases_its_own_service(attachment_cache, monkeypatch):
+    created = []
+    
+    def create_service(creds):
+        created.append(GuardedGmail())
+        return created[-1]
+    
+    monkeypatch.setattr(gmailer, 'create_gmail_service', create_service)
+    parsed = parsed_message(8)
+    assert process_attachments(None, parsed, ThreadSafeState(), services=ServicePool(None))
+    assert len(created) > 1
+    assert sum(service.conflicts for service in created) == 0
+    assert attachment_texts(parsed) == [f"Вложение a{i}" for i in range(8)]
+
+def test_cancelled_state_skips_attachments(attachment_cache):
+    state = ThreadSafeState()
+    state.cancel()
+    assert not process_attachments(GuardedGmail(), parsed_message(2), state)
@@ -0,0 +1,44 @@
+import pytest
+
+import gmailer
+from gmailer import clean_text
+from gmailer_bench import _bench_corpus, _clean_text_reference
+
+PLAIN = _bench_corpus(100, seed=2)
+HTML = [
+    "<html><head><style>p {color: red}</style></head><body><div>"
+    + "".join(f"<p>{line}&nbsp;</p>" for line in text.split("\n"))
+    + "<script>track()</script></div></body></html>"
+    for text in PLAIN
+]
+EDGE_CASES = [
+    "",
+    "&nbsp;",
+    "a &amp; b <b>x</b>",
+    "Цена < 5 и > 3",
+    "x​y⁠ z﻿",
+    "<p>1</p><p>2</p>",
+    "<!-- комментарий -->текст<?php echo 1; ?>",
+    "<br>строка<br/>вторая",
+    "<?xml version='1.0' encoding='utf-8'?><html><body>кодировка в строке</body></html>",
+    "а" * 12000,
+    "<p>" + "б " * 6000 + "</p>",
+]
+
+@pytest.fixture(params=['lxml', 'html.parser'])
+def parser(request, monkeypatch):
+    if request.param == 'html.parser':
+        monkeypatch.setattr(gmailer, 'lxml_html', None)
+    elif gmailer.lxml_html is None:
+        pytest.skip("lxml не установлен")
+    return request.param
+
+@pytest.mark.parametrize("body", PLAIN + HTML + EDGE_CASES)
+def test_clean_text_matches_reference(parser, body):
+    assert clean_text(body) == _clean_text_reference(body)
+
+@pytest.mark.parametrize("body", HTML + EDGE_CASES)
+def test_second_clean_of_clean_text_is_noop(body):
+    # build_email_data чистит уже очищенное тело повторно, но без разбора разметки
+    cleaned = clean_text(body)
+    assert clean_text(cleaned, html=False) == _clean_text_reference(_clean_text_reference(body))
@@ -0,0 +1,38 @@
+import pytest
+
+from gmailer import scan_phones, extract_data
+from gmailer_bench import _bench_corpus, _find_phones_reference, _extract_data_reference
+
+CORPUS = _bench_corpus(300, seed=1)
+
+EDGE_CASES = [
+    "",
+    "тел. +7 (912) 345-67-89, +7(912)3456789 и 8 912 345 67 89",
+    "+7 912 345 6789 8-912-345-67-89 89123456789 +79123456789",
+    "88005553535 и 8 (800) 555-35-35 - один номер",
+    "номер 8912345678901234 не телефон, ИНН 770708389312, 7707083893",
+    "+7 (912) 345-67-8",
+    "ООО «Ромашка» ИНН 7707083893, 123456, г. Москва, ул. Ленина, д. 5, офис 12",
+    "ИП Сидоров Алексей, сайт https://www.shop-1.ru, почта gmail.com",
+    "Город Тверь, улица Советская, дом 1",
+]
+
+@pytest.mark.parametrize("text", CORPUS + EDGE_CASES)
+def test_scan_phones_matches_findall_reference(text):
+    assert scan_phones(text) == _find_phones_reference(text)
+
+@pytest.mark.parametrize("text", CORPUS + EDGE_CASES)
+def test_extract_data_matches_reference(text):
+    assert extract_data(text) == _extract_data_reference(text)
+
+def test_extract_data_fields():
+    phone, inn, fio, website, company, address = extract_data(
+        "С уважением, Иванов Петр Сергеевич, ООО «Ромашка», тел. 8 (912) 345-67-89, "
+        "+7 912 111 22 33\nИНН 7707083893, сайт www.romashka.ru\n123456, г. Москва, ул. Ленина, д. 5"
+    )
+    assert phone == "+79121112233, +79123456789"
+    assert inn == "7707083893"
+    assert fio == "Иванов Петр Сергеевич"
+    assert website == "romashka.ru"
+    assert company == "ООО Ромашка"
+    assert address.startswith("123456, г. Москва")
@@ -0,0 +1,85 @@
+import copy
+from email.message import EmailMessage
+
+import gmailer
+from gmailer import FIELD_MASKS, MESSAGE_PARTS_DEPTH, parse_message, message_headers, is_reply_message
+from gmailer_bench import _as_gmail_payload
+
+def _split(mask: str) -> list:
+    """Элементы маски верхнего уровня (запятые внутри скобок не делят)"""
+    items, depth, start = [], 0, 0
+    for i, char in enumerate(mask):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            items.append(mask[start:i])
+            start = i + 1
+    items.append(mask[start:])
+    return items
+
+def apply_mask(value, mask: str):
+    """Частичный ответ, как его собирает Google API по параметру fields"""
+    if isinstance(value, list):
+        return [apply_mask(item, mask) for item in value]
+    result = {}
+    for item in _split(mask):
+        path, _, sub = item.partition('(')
+        name, _, rest = path.partition('/')
+        if name not in value:
+            continue
+        if rest:
+            sub_mask = f"{rest}({sub}" if sub else rest
+        else:
+            sub_mask = sub[:-1] if sub else None
+        result[name] = apply_mask(value[name], sub_mask) if sub_mask else copy.deepcopy(value[name])
+    return result
+
+def nested_message(depth: int) -> EmailMessage:
+    """Письмо из depth вложенных multipart/mixed: на каждом уровне текст и вложение"""
+    inner = None
+    for level in reversed(range(depth)):
+        part = EmailMessage()
+        part.set_content(f"Уровень {level}")
+        part.add_attachment(b"data", maintype='application', subtype='pdf', filename=f"file{level}.pdf")
+        if inner is not None:
+            part.attach(inner)
+        inner = part
+    inner['From'] = "sender@example.ru"
+    inner['Subject'] = "Вложенное письмо"
+    inner['Date'] = "Mon, 01 Jan 2024 10:00:00 +0300"
+    return inner
+
+def full_response(message: EmailMessage) -> dict:
+    return {'id': 'm1', 'threadId': 't1', 'labelIds': ['INBOX'], 'sizeEstimate': 1000, 'snippet': "...",
+            'historyId': '1', 'internalDate': '0', 'payload': _as_gmail_payload(message)}
+
+def parsed_view(msg: dict) -> tuple:
+    """Результат разбора; у вложений - только поля, которые читает parse_attachment"""
+    parsed = parse_message(msg, 'm1')
+    parts = [(p['partId'], p['filename'], p['mimeType'], p['body']) for p in parsed.attachment_parts]
+    return parsed.date, parsed.from_email, parsed.subject, parsed.body, parts
+
+def test_full_mask_keeps_everything_parse_message_reads():
+    for depth in (1, MESSAGE_PARTS_DEPTH + 2):
+        msg = full_response(nested_message(depth))
+        masked = apply_mask(msg, FIELD_MASKS['full'])
+        assert 'snippet' not in masked and 'labelIds' not in masked
+        assert parsed_view(masked) == parsed_view(msg)
+
+def test_thread_mask_keeps_messages():
+    thread = {'id': 't1', 'historyId': '1', 'messages': [full_response(nested_message(2))]}
+    masked = apply_mask(thread, FIELD_MASKS['thread'])
+    assert parsed_view(masked['messages'][0]) == parsed_view(thread['messages'][0])
+
+def test_metadata_mask_keeps_reply_headers():
+    message = nested_message(1)
+    message['In-Reply-To'] = "<original@example.ru>"
+    masked = apply_mask(full_response(message), FIELD_MASKS['metadata'])
+    assert set(masked) == {'id', 'threadId', 'payload'}
+    assert is_reply_message(message_headers(masked))
+
+def test_field_mask_disabled(monkeypatch):
+    monkeypatch.setattr(gmailer, 'PARTIAL_RESPONSE', False)
+    assert gmailer.field_mask('full') == {}
@@ -0,0 +1,98 @@
+import json
+
+import pytest
+
+import gmailer
+from gmailer import ExportEngine, ExportStore, load_sync_checkpoint, save_sync_checkpoint
+from fake_gmail import FakeGmail, run_export
+
+def statuses(messages) -> list:
+    return [m['message'] for m in messages if m['type'] == 'status']
+
+def test_first_run_lists_everything_and_saves_checkpoint(gmail):
+    final, messages = run_export(ExportEngine, incremental=True)
+    assert final['type'] == 'complete' and final['count'] == len(gmail.mailbox)
+    assert 'Контрольной точки нет, полная выгрузка списка писем' in statuses(messages)
+    assert load_sync_checkpoint() == gmail.history_id
+
+def test_clean_run_advances_checkpoint(gmail):
+    save_sync_checkpoint('1000')
+    gmail.add_history('1010', ['m0001', 'm0002'])
+    final, _ = run_export(ExportEngine, incremental=True)
+    # Только письма из истории, без полного списка
+    assert final['type'] == 'complete' and final['count'] == 2
+    assert 'list' not in gmail.calls
+    assert load_sync_checkpoint() == '1010'
+
+def test_no_new_messages_advances_checkpoint(gmail):
+    save_sync_checkpoint('1000')
+    gmail.history_id = '1005'
+    final, _ = run_export(ExportEngine, incremental=True)
+    assert final['type'] == 'complete' and final['count'] == 0
+    assert load_sync_checkpoint() == '1005'
+
+def test_expired_checkpoint_falls_back_to_full_listing(gmail):
+    save_sync_checkpoint('1000')
+    gmail.expired = True
+    gmail.history_id = '2000'
+    final, messages = run_export(ExportEngine, incremental=True)
+    assert 'Контрольная точка устарела, полная выгрузка списка писем' in statuses(messages)
+    assert gmail.calls['list'] >= 1
+    assert final['type'] == 'complete' and final['count'] == len(gmail.mailbox)
+    assert load_sync_checkpoint() == '2000'
+
+def test_failed_message_keeps_checkpoint(gmail):
+    save_sync_checkpoint('1000')
+    gmail.add_history('1010', ['m0001', 'm0002'])
+    gmail.errors['m0002'] = 400
+    run_export(ExportEngine, incremental=True)
+    assert ExportStore().load_failed_ids() == ['m0002']
+    assert load_sync_checkpoint() == '1000'
+    
+    # Письмо загружается - контрольная точка сдвигается
+    del gmail.errors['m0002']
+    final, _ = run_export(ExportEngine, incremental=True)
+    assert final['type'] == 'complete'
+    assert ExportStore().load_failed_ids() == []
+    assert load_sync_checkpoint() == '1010'
+
+def test_failed_message_is_retried_after_history_moves_on(gmail):
+    save_sync_checkpoint('1000')
+    gmail.add_history('1010', ['m0001', 'm0002'])
+    gmail.errors['m0002'] = 400
+    run_export(ExportEngine, incremental=True)
+    
+    # Контрольную точку сдвинула выгрузка без ошибок в истории, но письмо с ошибкой осталось
+    save_sync_checkpoint('1010')
+    gmail.add_history('1020', ['m0003'])
+    del gmail.errors['m0002']
+    final, _ = run_export(ExportEngine, incremental=True)
+    assert final['type'] == 'complete' and final['count'] == 2
+    assert ExportStore().load_failed_ids() == []
+    assert load_sync_checkpoint() == '1020'
+
+@pytest.fixture
+def large_gmail(gmail, monkeypatch):
+    """Ящик на две страницы списка; вторая страница не загружается (SSL ошибка)"""
+    service = FakeGmail(count=520)
+    monkeypatch.setattr(gmailer, 'create_gmail_service', lambda *args, **kwargs: service)
+    safe_api_call = gmailer.safe_api_call
+    
+    def flaky(func, *args, **kwargs):
+        if func.__name__ == 'list' and kwargs.get('pageToken') and 'q' in kwargs:
+            return None
+        return safe_api_call(func, *args, **kwargs)
+    
+    monkeypatch.setattr(gmailer, 'safe_api_call', flaky)
+    monkeypatch.setattr(gmailer, 'rate_limiter', gmailer.RateLimiter(start_rate=10 ** 6, max_rate=10 ** 6))
+    return service
+
+def test_incomplete_listing_keeps_checkpoint(large_gmail):
+    save_sync_checkpoint('1000')
+    large_gmail.expired = True
+    large_gmail.history_id = '2000'
+    final, _ = run_export(ExportEngine, incremental=True)
+    assert final['type'] == 'complete' and final['count'] == 500
+    assert load_sync_checkpoint() == '1000'
+    with open(gmailer.SYNC_STATE_FILE, encoding='utf-8') as f:
+        assert json.load(f)['history_id'] == '1000'
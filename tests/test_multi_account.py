@@ -0,0 +1,52 @@
+import queue
+
+import pytest
+
+from gmailer import CONTACT_COLUMNS, EmailData, ExportStore, MailboxAccount, MultiAccountExport
+
+openpyxl = pytest.importorskip("openpyxl")
+
+def record(n: int, **fields) -> EmailData:
+    values = dict(date=f"{n % 28 + 1:02d} Mar 2024 10:00", from_email=f"sender{n % 4}@example.ru",
+                  subject=f"Заказ №{n}", phone=f"+7912345{n % 6:04d}", inn="7707083893" if n % 3 else "",
+                  text=f"Текст {n}", fio=f"Иванов {n}" if n % 2 else "", company=f"ООО Ромашка {n % 5}")
+    values.update(fields)
+    return EmailData(**values)
+
+def sheet(path: str, title: str) -> list:
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        rows = list(workbook[title].iter_rows(values_only=True))
+    finally:
+        workbook.close()
+    return [dict(zip(rows[0], row)) for row in rows[1:]]
+
+def test_consolidated_file_merges_mailbox_contacts(tmp_path):
+    mailboxes = {'alpha': [record(n) for n in range(0, 30)], 'beta': [record(n) for n in range(20, 45)]}
+    results = {}
+    combined = ExportStore(str(tmp_path / "combined.db"))
+    try:
+        for name, records in mailboxes.items():
+            store = ExportStore(str(tmp_path / f"{name}.db"))
+            try:
+                store.append([(f"m{i}", r) for i, r in enumerate(records)])
+                results[name] = str(tmp_path / f"{name}.xlsx")
+                store.export_xlsx(results[name])
+            finally:
+                store.close()
+            # Эталон: все письма всех ящиков в одном хранилище (общие письма - по разу на ящик)
+            combined.append([(f"{name}-{i}", r) for i, r in enumerate(records)])
+        expected = [dict(zip(CONTACT_COLUMNS, row)) for row in combined.iter_contact_rows()]
+    finally:
+        combined.close()
+    
+    accounts = [MailboxAccount(name, "", "", str(tmp_path / name)) for name in mailboxes]
+    gui_queue = queue.Queue()
+    output_file = str(tmp_path / "all.xlsx")
+    MultiAccountExport(gui_queue, accounts, output_file=output_file)._write_consolidated(results)
+    assert gui_queue.get()['count'] == 45
+    
+    rows = sheet(output_file, "Sheet1")
+    assert {row['mailbox'] for row in rows if row['subject'] in ("Заказ №20", "Заказ №29")} == {"alpha, beta"}
+    contacts = [{name: row[name] or "" for name in CONTACT_COLUMNS} for row in sheet(output_file, "contacts")]
+    assert contacts == [{name: value or "" for name, value in contact.items()} for contact in expected]
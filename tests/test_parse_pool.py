@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+
+import pytest
+
+import gmailer
+
+def fake_extract(filename: str, file_data: bytes) -> str:
+    """Разбор в рабочем процессе: hang - зависает, slow - долгий, но укладывается в лимит.
+    Каждый запуск отмечается в журнале (file_data - путь к нему)"""
+    with open(file_data, 'a') as log:
+        log.write(f"{filename} {os.getpid()}\n")
+    if filename.startswith("hang"):
+        time.sleep(600)
+    if filename.startswith("slow"):
+        time.sleep(2)
+    return f"текст {filename}"
+
+def started(journal) -> list:
+    return [line.split() for line in journal.read_text().splitlines()] if journal.exists() else []
+
+def alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+@pytest.fixture
+def parse_pool(monkeypatch):
+    # Рабочие процессы получают подмененный разбор при fork
+    monkeypatch.setattr(gmailer, 'extract_attachment_text', fake_extract)
+    monkeypatch.setattr(gmailer, 'ATTACHMENT_PARSE_TIMEOUT', 1)
+    monkeypatch.setattr(gmailer, 'PARSE_WORKERS', 2)
+    monkeypatch.setattr(gmailer, '_parse_pool', None)
+    yield
+    gmailer.shutdown_parse_pool()
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="подмена разбора передается рабочим процессам через fork")
+def test_hung_parse_kills_only_its_worker(parse_pool, tmp_path):
+    journal = tmp_path / "journal.txt"
+    results = {}
+    
+    def parse(filename):
+        try:
+            results[filename] = gmailer.parse_attachment_data(filename, str(journal))
+        except Exception as e:
+            results[filename] = e
+    
+    hung = threading.Thread(target=parse, args=("hang.txt",))
+    hung.start()
+    # Долгий разбор начинается до истечения лимита зависшего и заканчивается после
+    time.sleep(2)
+    slow = threading.Thread(target=parse, args=("slow.txt",))
+    slow.start()
+    hung.join()
+    assert isinstance(results["hang.txt"], TimeoutError)
+    retired = gmailer._parse_pool
+    assert retired.retired
+    
+    # Новый разбор идет в новый пул, не дожидаясь старого
+    assert gmailer.parse_attachment_data("next.txt", str(journal)) == "текст next.txt"
+    assert gmailer._parse_pool is not retired
+    
+    slow.join()
+    assert results["slow.txt"] == "текст slow.txt"
+    names = [name for name, pid in started(journal)]
+    assert names.count("slow.txt") == 1
+    
+    hung_pid = int(dict(started(journal))["hang.txt"])
+    deadline = time.monotonic() + 10
+    while alive(hung_pid) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert not alive(hung_pid)
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="подмена разбора передается рабочим процессам через fork")
+def test_parse_without_pool_is_not_done_in_process(parse_pool, tmp_path, monkeypatch):
+    class ClosedPool:
+        retired = False
+        
+        def submit(self, filename, file_data):
+            raise RuntimeError("cannot schedule new futures after shutdown")
+    
+    monkeypatch.setattr(gmailer, 'get_parse_pool', lambda: ClosedPool())
+    journal = tmp_path / "journal.txt"
+    with pytest.raises(RuntimeError):
+        gmailer.parse_attachment_data("card.txt", str(journal))
+    assert started(journal) == []
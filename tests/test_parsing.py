@@ -0,0 +1,67 @@
+import base64
+from email.message import EmailMessage
+
+import pytest
+
+from gmailer import parse_message
+from gmailer_bench import _as_gmail_payload, _bench_corpus
+
+def make_message(text: str, charset: str = 'utf-8') -> EmailMessage:
+    message = EmailMessage()
+    message['From'] = "Иванов Петр <ivanov@example.ru>"
+    message['To'] = "me@example.ru"
+    message['Subject'] = "Заказ №1 - счет"
+    message['Date'] = "Mon, 01 Jan 2024 10:00:00 +0300"
+    message.set_content(text, charset=charset)
+    return message
+
+def parse_both(message: EmailMessage):
+    full = parse_message({'id': 'm1', 'payload': _as_gmail_payload(message)}, 'm1')
+    raw = parse_message({'id': 'm1', 'raw': base64.urlsafe_b64encode(message.as_bytes()).decode()}, 'm1')
+    return full, raw
+
+def assert_same(full, raw):
+    assert (full.date, full.from_email, full.subject, full.body) == (raw.date, raw.from_email, raw.subject, raw.body)
+    assert [(p['filename'], p['mimeType']) for p in full.attachment_parts] == \
+           [(p['filename'], p['mimeType']) for p in raw.attachment_parts]
+    assert full.has_attachments == raw.has_attachments
+
+@pytest.mark.parametrize("text", _bench_corpus(20, seed=3))
+def test_full_and_raw_agree_on_multipart(text):
+    message = make_message(text)
+    message.add_alternative(f"<html><body><p>{text}</p></body></html>", subtype='html')
+    message.add_attachment(b"%PDF-1.4", maintype='application', subtype='pdf', filename="счет.pdf")
+    message.add_attachment(text.encode('utf-8'), maintype='text', subtype='plain', filename="file.txt")
+    full, raw = parse_both(message)
+    assert_same(full, raw)
+    assert [p['filename'] for p in raw.attachment_parts] == ["счет.pdf", "file.txt"]
+
+def test_full_and_raw_agree_on_single_part():
+    assert_same(*parse_both(make_message("Просто текст, тел. 8 (912) 345-67-89")))
+
+def test_text_part_with_filename_goes_to_body_in_both_modes():
+    message = make_message("Основной текст")
+    message.add_attachment("Подпись из файла".encode('utf-8'), maintype='text', subtype='plain',
+                           filename="signature.txt", disposition='inline')
+    full, raw = parse_both(message)
+    assert_same(full, raw)
+    assert "Подпись из файла" in raw.body
+    assert not raw.attachment_parts
+
+def test_raw_carries_attachment_bytes():
+    message = make_message("Текст")
+    message.add_attachment(b"\x00\x01binary", maintype='application', subtype='octet-stream', filename="data.bin")
+    _, raw = parse_both(message)
+    assert raw.attachment_parts[0]['content'] == b"\x00\x01binary"
+    assert raw.attachment_parts[0]['body']['size'] == len(b"\x00\x01binary")
+
+def test_raw_decodes_declared_charset():
+    text = "Поставка товара, ИНН 7707083893"
+    _, raw = parse_both(make_message(text, charset='cp1251'))
+    assert text in raw.body
+
+def test_skip_replies_in_raw_mode():
+    message = make_message("Ответ")
+    message['In-Reply-To'] = "<original@example.ru>"
+    raw = {'id': 'm1', 'raw': base64.urlsafe_b64encode(message.as_bytes()).decode()}
+    assert parse_message(raw, 'm1', skip_replies=True) is None
@@ -0,0 +1,118 @@
+import types
+
+import pytest
+
+import gmailer
+from gmailer import QuotaScheduler, RateLimiter
+
+class Clock:
+    """Управляемые часы вместо time.monotonic"""
+    def __init__(self):
+        self.now = 1000.0
+    
+    def __call__(self):
+        return self.now
+    
+    def advance(self, seconds: float):
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(gmailer, 'time', types.SimpleNamespace(monotonic=clock))
+    return clock
+
+def test_reserve_spends_tokens_and_reports_wait(clock):
+    limiter = RateLimiter(start_rate=10)
+    assert limiter.reserve(5) == 0
+    assert limiter.reserve(5) == 0
+    assert limiter.reserve(5) == pytest.approx(0.5)
+    clock.advance(0.5)
+    assert limiter.reserve(5) == 0
+    assert limiter.get_stats()['wait_time'] == 0.5
+
+def test_request_larger_than_bucket_goes_into_debt(clock):
+    limiter = RateLimiter(start_rate=10)
+    assert limiter.reserve(20) == 0
+    # Долг 10 единиц и сам запрос 5 единиц - полторы секунды на скорости 10
+    assert limiter.reserve(5) == pytest.approx(1.5)
+
+def test_throttle_halves_rate_and_backs_off(clock):
+    limiter = RateLimiter(start_rate=40, min_rate=5)
+    limiter.on_throttle()
+    assert limiter.get_stats()['rate'] == 20
+    assert limiter.reserve(1) == pytest.approx(gmailer.RATE_LIMIT_BACKOFF)
+    limiter.on_throttle()
+    assert limiter.reserve(1) == pytest.approx(gmailer.RATE_LIMIT_BACKOFF * 2)
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert limiter.get_stats() == {'rate': 5, 'throttles': 4, 'wait_time': 3.0}
+    
+    # Успешный ответ сбрасывает удвоение паузы
+    clock.advance(60)
+    limiter.on_success()
+    limiter.on_throttle()
+    assert limiter.reserve(1) == pytest.approx(gmailer.RATE_LIMIT_BACKOFF)
+
+def test_rate_recovers_once_per_interval(clock):
+    limiter = RateLimiter(start_rate=20, max_rate=23)
+    limiter.on_throttle()
+    # Сразу после снижения и в течение интервала скорость не растет, сколько бы ответов ни пришло
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.get_stats()['rate'] == 10
+    clock.advance(gmailer.RATE_LIMIT_INTERVAL / 2)
+    limiter.on_success()
+    assert limiter.get_stats()['rate'] == 10
+    
+    for second in range(1, 21):
+        clock.advance(gmailer.RATE_LIMIT_INTERVAL)
+        for _ in range(50):
+            limiter.on_success()
+        assert limiter.get_stats()['rate'] == min(23, 10 + second * gmailer.RATE_LIMIT_INCREASE)
+
+def test_scheduler_refusal_returns_tokens(clock):
+    class Scheduler:
+        wait = 0.3
+        
+        def reserve(self, account, units):
+            self.account = account
+            return self.wait
+    
+    scheduler = Scheduler()
+    limiter = RateLimiter(start_rate=10)
+    limiter.attach_scheduler(scheduler, 'a@example.ru')
+    assert limiter.reserve(10) == pytest.approx(0.3)
+    assert scheduler.account == 'a@example.ru'
+    # Доля проекта не выделена - своя квота не потрачена
+    scheduler.wait = 0.0
+    assert limiter.reserve(10) == 0
+    assert limiter.reserve(10) > 0
+
+def greedy(scheduler: QuotaScheduler, clock: Clock, accounts: list, seconds: float, units: int = 5,
+           step: float = 0.01) -> dict:
+    """Ящики запрашивают квоту, пока она выделяется, каждые step секунд"""
+    granted = dict.fromkeys(accounts, 0)
+    for _ in range(round(seconds / step)):
+        clock.advance(step)
+        for account in accounts:
+            while scheduler.reserve(account, units) == 0:
+                granted[account] += units
+    return granted
+
+def test_scheduler_splits_quota_between_accounts(clock):
+    scheduler = QuotaScheduler(units_per_second=100)
+    granted = greedy(scheduler, clock, ['a', 'b'], seconds=10)
+    # Каждому по половине квоты: 50 ед/сек, плюс емкость корзины
+    assert granted['a'] == pytest.approx(500, abs=60)
+    assert granted['b'] == pytest.approx(500, abs=60)
+    assert abs(granted['a'] - granted['b']) <= 10
+    assert scheduler.get_stats() == granted
+
+def test_scheduler_gives_idle_share_back(clock):
+    scheduler = QuotaScheduler(units_per_second=100)
+    greedy(scheduler, clock, ['a', 'b'], seconds=2)
+    # b перестал обращаться к API: по истечении окна активности вся квота - у a
+    clock.advance(QuotaScheduler.ACTIVE_WINDOW + 0.1)
+    granted = greedy(scheduler, clock, ['a'], seconds=10)
+    assert granted['a'] == pytest.approx(1000, abs=110)
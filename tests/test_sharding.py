@@ -0,0 +1,56 @@
+import os
+from datetime import datetime
+
+import pytest
+
+import gmailer
+from gmailer import ExportEngine, ExportStore
+from fake_gmail import run_export
+
+START, END = datetime(2023, 12, 31), datetime(2024, 1, 5)
+
+@pytest.fixture
+def shard_log(monkeypatch):
+    """Шарды, отмеченные завершенными (план удаляется из хранилища после успешной выгрузки)"""
+    monkeypatch.setattr(gmailer, 'SHARD_TARGET_SIZE', 10)
+    done = []
+    mark_shard_done = ExportStore.mark_shard_done
+    
+    def record(store, start_ts, end_ts):
+        done.append((start_ts, end_ts))
+        mark_shard_done(store, start_ts, end_ts)
+    
+    monkeypatch.setattr(ExportStore, 'mark_shard_done', record)
+    return done
+
+def test_sharded_export(gmail, shard_log):
+    final, messages = run_export(ExportEngine, START, END, sharded=True)
+    assert final['type'] == 'complete' and final['count'] == len(gmail.mailbox)
+    assert len(shard_log) > 1
+    assert os.path.exists(final['file'])
+
+def test_bad_message_does_not_hold_its_shard(gmail, shard_log):
+    # Письмо, которое не загружается никогда: шард все равно завершается, выгрузка пишет файл
+    gmail.errors['m0007'] = 400
+    final, _ = run_export(ExportEngine, START, END, sharded=True)
+    assert final['type'] == 'complete' and final['count'] == len(gmail.mailbox) - 1
+    assert os.path.exists(final['file'])
+    planned = len(shard_log)
+    
+    store = ExportStore()
+    try:
+        assert store.load_shards() == []
+        assert store.load_failed_ids() == ['m0007']
+    finally:
+        store.close()
+    
+    # Следующая выгрузка снова не падает, а письмо с ошибкой повторяется
+    del gmail.errors['m0007']
+    final, _ = run_export(ExportEngine, START, END, sharded=True)
+    assert final['type'] == 'complete' and final['count'] == len(gmail.mailbox)
+    assert len(shard_log) == 2 * planned
+    store = ExportStore()
+    try:
+        assert store.load_failed_ids() == []
+    finally:
+        store.close()
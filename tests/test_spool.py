@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from gmailer import EmailData, RecordSpool, RECORD_COLUMNS, write_records_xlsx
+
+def make_records(count: int) -> list:
+    return [
+        EmailData(date=f"0{i % 9 + 1} Jan 2024 10:{i % 60:02d}", from_email=f"sender{i}@example.ru",
+                  subject=f"Заказ №{i}", phone="+79123456789" if i % 2 else "", inn="7707083893",
+                  text=f"Текст письма {i} " * (i % 7 + 1), fio="Иванов Петр", has_attachments=bool(i % 3),
+                  processed_at=f"2024-01-01T10:00:{i % 60:02d}")
+        for i in range(count)
+    ]
+
+@pytest.mark.parametrize("budget_bytes", [10 ** 9, 4096, 1])
+def test_spool_round_trip(budget_bytes):
+    records = make_records(250)
+    spool = RecordSpool(budget_bytes=budget_bytes)
+    spool.extend(records[:100])
+    for record in records[100:]:
+        spool.append(record)
+    try:
+        assert len(spool) == len(records)
+        assert list(spool) == records
+        assert list(spool.iter_rows(chunk_size=7)) == [tuple(getattr(r, name) for name in RECORD_COLUMNS)
+                                                        for r in records]
+        stats = spool.get_stats()
+        assert stats['records'] == stats['in_memory'] + stats['spilled'] == len(records)
+        assert (stats['spilled'] > 0) == (budget_bytes < 10 ** 9)
+    finally:
+        spool.close()
+
+def test_spool_close_removes_spill_file():
+    spool = RecordSpool(budget_bytes=1)
+    spool.extend(make_records(10))
+    path = spool._path
+    assert os.path.exists(path)
+    spool.close()
+    assert not os.path.exists(path)
+
+def test_xlsx_from_spilled_spool(tmp_path):
+    openpyxl = pytest.importorskip("openpyxl")
+    records = make_records(50)
+    spool = RecordSpool(budget_bytes=2048)
+    spool.extend(records)
+    path = str(tmp_path / "out.xlsx")
+    try:
+        assert write_records_xlsx(path, spool.iter_rows()) == len(records)
+    finally:
+        spool.close()
+    rows = list(openpyxl.load_workbook(path, read_only=True)["Sheet1"].values)
+    assert list(rows[0]) == RECORD_COLUMNS
+    flag_index = RECORD_COLUMNS.index('has_attachments')
+    assert [row[flag_index] for row in rows[1:]] == [r.has_attachments for r in records]
+    assert [row[RECORD_COLUMNS.index('subject')] for row in rows[1:]] == [r.subject for r in records]
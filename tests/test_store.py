@@ -0,0 +1,149 @@
+import sqlite3
+
+import pytest
+
+import gmailer
+from gmailer import (DEDUP_KEY, RECORD_COLUMNS, CONTACT_COLUMNS, CONTACT_TEXT_FIELDS, DedupIndex, EmailData,
+                     ExportStore, ThreadSafeState)
+
+def record(n: int, **fields) -> EmailData:
+    values = dict(date=f"0{n % 3 + 1} Jan 2024 10:00", from_email=f"sender{n % 5}@example.ru",
+                  subject=f"Заказ №{n % 4}", phone="", inn="", text=f"Текст {n}")
+    values.update(fields)
+    return EmailData(**values)
+
+@pytest.fixture
+def store(tmp_path):
+    store = ExportStore(str(tmp_path / "export.db"))
+    yield store
+    store.close()
+
+def export_run(store: ExportStore, entries: list) -> ThreadSafeState:
+    """Запуск выгрузки в миниатюре: восстановление состояния, отсев и контрольные точки"""
+    state = ThreadSafeState()
+    state.restore_processed(store.load_processed_ids(), store.load_dedup_index())
+    for start in range(0, len(entries), 10):
+        for msg_id, data in entries[start:start + 10]:
+            state.add_processed(msg_id, data)
+        store.append(*state.get_and_clear_buffer())
+    return state
+
+def test_dedup_index():
+    index = DedupIndex()
+    assert index.add(record(1))
+    assert not index.add(record(1, text="другой текст"))
+    assert index.add(record(1, subject="Другая тема"))
+    assert len(index) == 2
+    with pytest.raises(ValueError):
+        DedupIndex(('date', 'нет такого поля'))
+
+def test_store_matches_drop_duplicates(store):
+    pd = pytest.importorskip("pandas")
+    entries = [(f"m{n}", record(n)) for n in range(300)]
+    # Первая половина - прерванный запуск, вторая - продолжение с восстановленным индексом
+    export_run(store, entries[:150])
+    export_run(store, entries)
+    expected = pd.DataFrame([r.to_dict() for _, r in entries]).drop_duplicates(subset=list(DEDUP_KEY))
+    assert [r.to_dict() for r in store.load_records()] == expected.to_dict('records')
+    counts = store.status_counts()
+    assert counts['done'] == len(expected)
+    assert counts['duplicate'] == len(entries) - len(expected)
+
+def test_repeated_message_id_is_not_counted_twice(store):
+    state = export_run(store, [("m1", record(1)), ("m1", record(1)), ("m2", record(1))])
+    assert state.get_stats() == (2, 1)
+    assert store.status_counts() == {'done': 1, 'duplicate': 1}
+
+def test_migration_fills_digests_and_drops_duplicates(tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute(f"CREATE TABLE records (id INTEGER PRIMARY KEY AUTOINCREMENT, msg_id TEXT, "
+                 f"{', '.join(f'{name} TEXT' for name in RECORD_COLUMNS)})")
+    rows = [(f"m{n}",) + tuple(str(getattr(record(n), name)) for name in RECORD_COLUMNS) for n in range(100)]
+    conn.executemany(f"INSERT INTO records (msg_id, {', '.join(RECORD_COLUMNS)}) "
+                     f"VALUES (?, {', '.join('?' for _ in RECORD_COLUMNS)})", rows)
+    conn.commit()
+    conn.close()
+    
+    store = ExportStore(path)
+    try:
+        kept = store.load_records()
+        index = DedupIndex()
+        assert all(index.add(r) for r in kept)
+        assert len(kept) == len({tuple(getattr(record(n), name) for name in DEDUP_KEY) for n in range(100)})
+        assert len(store.load_dedup_index()) == len(kept)
+    finally:
+        store.close()
+    
+    # Смена ключа пересчитывает дайджесты: записи одного отправителя становятся повторами
+    store = ExportStore(path, dedup_key=('from_email',))
+    try:
+        assert len(store.load_records()) == 5
+    finally:
+        store.close()
+
+def contact_records(count: int) -> list:
+    return [
+        (f"m{n}", record(n, date=f"{n % 28 + 1:02d} Feb 2024 10:00", from_email=f"Sender{n % 4}@Example.ru",
+                         subject=f"Тема {n}", phone=f"+7912345{n % 6:04d}", inn="7707083893" if n % 3 else "",
+                         fio=f"Иванов {n}" if n % 2 else "", company=f"ООО Ромашка {n % 5}"))
+        for n in range(count)
+    ]
+
+def contacts_reference(entries: list) -> dict:
+    """Контакты, собранные заново по всем письмам: телефоны и ИНН объединяются, текстовые поля -
+    из последнего по дате письма, где они заполнены"""
+    contacts = {}
+    for _, r in entries:
+        contact = contacts.setdefault(r.from_email.lower(), {'phones': [], 'inn': [], 'dates': [], 'fields': {}})
+        contact['phones'] += [p for p in [r.phone] if p and p not in contact['phones']]
+        contact['inn'] += [i for i in [r.inn] if i and i not in contact['inn']]
+        contact['dates'].append(gmailer.sortable_date(r.date))
+        for name in CONTACT_TEXT_FIELDS:
+            value = getattr(r, name)
+            if value and gmailer.sortable_date(r.date) >= contact['fields'].get(name, ("", ""))[0]:
+                contact['fields'][name] = (gmailer.sortable_date(r.date), value)
+    return {
+        email: {'email': email, 'phones': ", ".join(c['phones']), 'inn': ", ".join(c['inn']),
+                'first_seen': min(c['dates']), 'last_seen': max(c['dates']), 'message_count': len(c['dates']),
+                **{name: c['fields'].get(name, ("", ""))[1] for name in CONTACT_TEXT_FIELDS}}
+        for email, c in contacts.items()
+    }
+
+def stored_contacts(store: ExportStore) -> dict:
+    return {row[0]: dict(zip(CONTACT_COLUMNS, row)) for row in store.iter_contact_rows(chunk_size=3)}
+
+def test_contacts_match_full_recount(store):
+    entries = contact_records(120)
+    for start in range(0, len(entries), 25):
+        store.append(entries[start:start + 25])
+    assert stored_contacts(store) == contacts_reference(entries)
+
+def test_contacts_count_each_message_once_and_survive_clear(store):
+    entries = contact_records(40)
+    store.append(entries)
+    store.clear()
+    # Повторная выгрузка того же периода и несколько новых писем
+    store.append(entries + contact_records(48)[40:])
+    assert store.count() == 48
+    assert stored_contacts(store) == contacts_reference(contact_records(48))
+
+def test_contact_key_with_inn(tmp_path):
+    store = ExportStore(str(tmp_path / "export.db"), contact_inn=True)
+    try:
+        store.append(contact_records(12))
+        keys = {(row[0], row[1]) for row in store.iter_contact_rows()}
+    finally:
+        store.close()
+    assert keys == {(f"sender{n % 4}@example.ru", "7707083893" if n % 3 else "") for n in range(12)}
+
+def test_clear_keeps_failed_statuses(store):
+    store.append([("m1", record(1))], [("m2", 'failed', "HttpError 500"), ("m3", 'skipped', "")])
+    store.clear()
+    assert store.count() == 0
+    assert store.status_counts() == {'failed': 1}
+    assert store.load_failed_ids() == ["m2"]
+    assert "m2" not in store.load_processed_ids()
+    # Успешный повтор заменяет статус
+    store.append([("m2", record(2))])
+    assert store.load_failed_ids() == []